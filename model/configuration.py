@@ -62,6 +62,27 @@ class ModelConfig(object):
         # If < 1.0, the dropout keep probability applied to LSTM variables.
         self.lstm_dropout_keep_prob = 0.7
 
+        # LSTM cell implementation: "basic" for tf.nn.rnn_cell.BasicLSTMCell or
+        # "block" for tf.contrib.rnn.LSTMBlockCell, which runs each step as one
+        # fused op. Both read the same checkpoint variables.
+        self.lstm_implementation = "basic"
+
+        # Whether the inference graph also contains a complete beam search decoder
+        # built with tf.while_loop, so that captions are generated by a single
+        # session run.
+        self.in_graph_beam_search = False
+        # Beam search parameters of the in-graph decoder.
+        self.beam_size = 3
+        self.max_caption_length = 20
+        self.length_normalization_factor = 0.0
+
+        # Whether the inference graph reads the lstm, logits and seq_embedding
+        # weights as int8 values with per-channel float scales, from a checkpoint
+        # written by quantize_decoder.py. TensorFlow sessions also hold the
+        # dequantized float32 weights, so only the files shrink; the NumPy
+        # decoder keeps the weights in memory as int8.
+        self.quantize_decoder_weights = False
+
 
 class TrainingConfig(object):
     """Wrapper class for training hyperparameters."""
@@ -0,0 +1,110 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-5 上午10:15
+
+# @Author  : Swing
+
+
+import os
+
+import tensorflow as tf
+
+from model import configuration, show_and_tell_model
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string("checkpoint_path", "",
+                       "Model checkpoint file or directory containing a "
+                       "model checkpoint file.")
+tf.flags.DEFINE_string("output_dir", "",
+                       "Directory to write the converted checkpoint to.")
+tf.flags.DEFINE_string("lstm_implementation", "block",
+                       "ModelConfig.lstm_implementation the converted checkpoint "
+                       "is read with.")
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+def lstm_variable_names(model_config):
+    """Returns the {rank: name} of the kernel (rank 2) and bias (rank 1) variables
+    of the LSTM cell selected by model_config."""
+    g = tf.Graph()
+    with g.as_default():
+        model = show_and_tell_model.ShowAndTellModel(model_config, mode='inference')
+        with tf.variable_scope('lstm'):
+            lstm_cell = model.build_lstm_cell()
+            lstm_cell(tf.zeros([1, model_config.embedding_size]),
+                      lstm_cell.zero_state(1, tf.float32))
+        return {v.shape.ndims: v.op.name for v in tf.global_variables()}
+
+
+def convert_checkpoint(checkpoint_path, output_dir, model_config):
+    """Writes a copy of a checkpoint whose LSTM kernel and bias are renamed to the
+    variables of the cell selected by model_config.lstm_implementation.
+    The kernel and bias of all cells hold the same gate layout, so only names
+    change; checkpoints of a cell with different variable names, such as
+    LSTMBlockCell's default "lstm_cell" scope, become readable. All other
+    variables are copied unchanged.
+    Args:
+      checkpoint_path: Model checkpoint file or directory containing a model
+        checkpoint file.
+      output_dir: Directory to write the converted checkpoint to.
+      model_config: ModelConfig of the model that will read the checkpoint.
+    Returns:
+      The path of the written checkpoint.
+    Raises:
+      ValueError: If no checkpoint is found, or its LSTM variables cannot be
+        identified.
+    """
+    if tf.gfile.IsDirectory(checkpoint_path):
+        checkpoint_dir = checkpoint_path
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_dir)
+        if not checkpoint_path:
+            raise ValueError("No checkpoint file found in: %s" % checkpoint_dir)
+
+    target_names = lstm_variable_names(model_config)
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    shapes = reader.get_variable_to_shape_map()
+
+    # The LSTM variables of the checkpoint, by rank. Optimizer slots are skipped.
+    source_names = {}
+    for name, shape in shapes.items():
+        if name.startswith("lstm/") and name.count("/") == 2:
+            if len(shape) in source_names:
+                raise ValueError("Ambiguous LSTM variables in %s: %s, %s" % (
+                    checkpoint_path, source_names[len(shape)], name))
+            source_names[len(shape)] = name
+    if sorted(source_names) != [1, 2]:
+        raise ValueError("No LSTM kernel and bias found in: %s" % checkpoint_path)
+    renames = {source_names[rank]: target_names[rank] for rank in source_names}
+
+    g = tf.Graph()
+    with g.as_default():
+        for name in sorted(shapes):
+            new_name = renames.get(name, name)
+            if new_name != name:
+                tf.logging.info("Renaming %s to %s", name, new_name)
+            tf.Variable(reader.get_tensor(name), name=new_name)
+        saver = tf.train.Saver()
+
+    if not tf.gfile.IsDirectory(output_dir):
+        tf.gfile.MakeDirs(output_dir)
+    with tf.Session(graph=g) as sess:
+        sess.run(tf.variables_initializer(g.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)))
+        output_path = saver.save(sess, os.path.join(output_dir, "model.ckpt"),
+                                 global_step=reader.get_tensor("global_step"))
+    tf.logging.info("Wrote converted checkpoint: %s", output_path)
+    return output_path
+
+
+def main(unused_argv):
+    assert FLAGS.checkpoint_path, "--checkpoint_path is required"
+    assert FLAGS.output_dir, "--output_dir is required"
+
+    model_config = configuration.ModelConfig()
+    model_config.lstm_implementation = FLAGS.lstm_implementation
+    convert_checkpoint(FLAGS.checkpoint_path, FLAGS.output_dir, model_config)
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,52 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-10 下午5:20
+
+# @Author  : Swing
+
+
+import tensorflow as tf
+
+from model.inference_interface import Captioner
+from model.serving_utils import encoder_stage
+
+FLAGS = tf.flags.FLAGS
+
+# --checkpoint_path and --vocab_file are defined by inference_interface.
+tf.flags.DEFINE_string("address", "localhost:6006",
+                       "host:port or Unix socket path to serve initial states on.")
+tf.flags.DEFINE_string("authkey", "",
+                       "Key shared with the decoder stages; none if empty.")
+tf.flags.DEFINE_string("frozen_graph_file", "",
+                       "Optional graph written by export_inference_graph.py.")
+tf.flags.DEFINE_integer("intra_op_threads", 0,
+                        "Threads used within an op; 0 lets TensorFlow decide.")
+tf.flags.DEFINE_integer("inter_op_threads", 0,
+                        "Threads used across ops; 0 lets TensorFlow decide.")
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+def main(unused_argv):
+    assert FLAGS.checkpoint_path or FLAGS.frozen_graph_file, \
+        "--checkpoint_path or --frozen_graph_file is required"
+    assert FLAGS.vocab_file or FLAGS.frozen_graph_file, "--vocab_file is required"
+
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                                    inter_op_parallelism_threads=FLAGS.inter_op_threads)
+    captioner = Captioner(FLAGS.checkpoint_path, FLAGS.vocab_file,
+                          session_config=session_config,
+                          frozen_graph_file=FLAGS.frozen_graph_file or None)
+    server = encoder_stage.EncoderServer(captioner,
+                                         encoder_stage.parse_address(FLAGS.address),
+                                         authkey=FLAGS.authkey.encode("utf-8") or None)
+    tf.logging.info("Encoder stage listening on %s", server.address)
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+        captioner.close()
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,167 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-1 下午7:20
+
+# @Author  : Swing
+
+
+import os
+
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from model import configuration
+from model.inference_utils import inference_wrapper
+from model.inference_utils import numpy_decoder
+from model.inference_utils import quantization
+
+FLAGS = tf.flags.FLAGS
+
+tf.flags.DEFINE_string("checkpoint_path", "",
+                       "Model checkpoint file or directory containing a "
+                       "model checkpoint file.")
+tf.flags.DEFINE_string("vocab_file", "", "Text file containing the vocabulary.")
+tf.flags.DEFINE_string("output_file", "",
+                       "File to write the frozen inference graph to.")
+tf.flags.DEFINE_boolean("in_graph_beam_search", False,
+                        "Whether to include the in-graph beam search decoder.")
+tf.flags.DEFINE_boolean("quantize_decoder_weights", False,
+                        "Whether --checkpoint_path was written by "
+                        "quantize_decoder.py; the int8 weights are kept as int8 "
+                        "constants.")
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+# Placeholders fed by InferenceWrapper.
+INPUT_NODES = ["image_feed", "image_batch_feed", "input_feed", "lstm/state_feed"]
+
+# Tensors fetched by InferenceWrapper, and the vocabulary.
+OUTPUT_NODES = ["lstm/initial_state", "softmax", "lstm/state", "vocabulary"]
+
+BEAM_SEARCH_INPUT_NODES = ["beam_search/start_id", "beam_search/end_id"]
+
+BEAM_SEARCH_OUTPUT_NODES = ["beam_search/sequences", "beam_search/lengths",
+                            "beam_search/logprobs", "beam_search/scores"]
+
+# Graph transforms applied after freezing. Batch normalization is folded into the
+# Inception convolution weights and constant subgraphs are precomputed.
+TRANSFORMS = [
+    "fold_constants(ignore_errors=true)",
+    "fold_batch_norms",
+    "fold_old_batch_norms",
+    "fold_constants(ignore_errors=true)",
+    "sort_by_execution_order",
+]
+
+
+def _variable_to_constant(node, value):
+    """Turns a variable NodeDef into a Const NodeDef holding `value`."""
+    dtype = node.attr["dtype"]
+    node.op = "Const"
+    node.ClearField("attr")
+    node.attr["dtype"].CopyFrom(dtype)
+    node.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(value))
+
+
+def _check_decoder_weights(graph_def):
+    """Checks that the decoder weights read by NumpyDecoderWrapper kept their
+    names through the graph transforms.
+    Raises:
+      ValueError: If a decoder weight can no longer be found by name.
+    """
+    names = set(node.name for node in graph_def.node)
+    missing = [name for name in numpy_decoder.DECODER_WEIGHTS
+               if name not in names and name + "/read" not in names]
+    if missing:
+        raise ValueError("Decoder weights not found after the graph transforms, the "
+                         "NumPy decoder could not load them: %s" % ", ".join(missing))
+
+
+def export_inference_graph(checkpoint_path, vocab_file, output_file,
+                           model_config=None):
+    """Writes a frozen, inference-only graph holding the weights and vocabulary.
+    The result can be loaded with one file read by
+    InferenceWrapperBase.build_graph_from_frozen.
+    Args:
+      checkpoint_path: Model checkpoint file or directory containing a model
+        checkpoint file.
+      vocab_file: Text file containing the vocabulary.
+      output_file: File to write the serialized GraphDef to.
+      model_config: Optional ModelConfig; defaults to ModelConfig().
+    Raises:
+      ValueError: If the transforms renamed the decoder weights.
+    """
+    if model_config is None:
+        model_config = configuration.ModelConfig()
+
+    input_nodes = list(INPUT_NODES)
+    output_nodes = list(OUTPUT_NODES)
+    if model_config.in_graph_beam_search:
+        input_nodes += BEAM_SEARCH_INPUT_NODES
+        output_nodes += BEAM_SEARCH_OUTPUT_NODES
+
+    g = tf.Graph()
+    with g.as_default():
+        model = inference_wrapper.InferenceWrapper()
+        restore_fn = model.build_graph_from_config(model_config, checkpoint_path)
+
+        # Store the vocabulary file lines in the graph.
+        with tf.gfile.GFile(vocab_file, mode="r") as f:
+            tf.constant([line.rstrip("\n") for line in f], name="vocabulary")
+
+        # Kept as variables until the transforms have run, so fold_constants does
+        # not turn their dequantized values back into float constants.
+        quantized_variables = [v for v in tf.global_variables()
+                               if v.op.name.endswith(quantization.QUANTIZED_SUFFIX)]
+        # The float variables they are dequantized into stay variables, assigned
+        # once by the dequantize op when the frozen graph is loaded.
+        dequantized_names = [v.op.name for v in tf.local_variables()
+                             if v.op.name in quantization.QUANTIZED_VARIABLES]
+        if dequantized_names:
+            output_nodes.append(quantization.DEQUANTIZE_OP)
+
+    with tf.Session(graph=g) as sess:
+        restore_fn(sess)
+        graph_def = g.as_graph_def()
+        original_size = graph_def.ByteSize()
+        original_nodes = len(graph_def.node)
+
+        # Variables become constants; everything the outputs do not depend on,
+        # such as the saver and global step, is dropped.
+        quantized_values = dict(zip([v.op.name for v in quantized_variables],
+                                    sess.run(quantized_variables)))
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            sess, graph_def, output_nodes,
+            variable_names_blacklist=list(quantized_values) + dequantized_names)
+
+    graph_def = TransformGraph(graph_def, input_nodes, output_nodes, TRANSFORMS)
+    _check_decoder_weights(graph_def)
+    for node in graph_def.node:
+        if node.name in quantized_values:
+            _variable_to_constant(node, quantized_values[node.name])
+
+    output_dir = os.path.dirname(output_file)
+    if output_dir and not tf.gfile.IsDirectory(output_dir):
+        tf.gfile.MakeDirs(output_dir)
+    with tf.gfile.GFile(output_file, "wb") as f:
+        f.write(graph_def.SerializeToString())
+
+    tf.logging.info("Wrote %s: %d nodes, %d bytes (graph without weights was %d "
+                    "nodes, %d bytes)", output_file, len(graph_def.node),
+                    graph_def.ByteSize(), original_nodes, original_size)
+
+
+def main(unused_argv):
+    assert FLAGS.checkpoint_path, "--checkpoint_path is required"
+    assert FLAGS.vocab_file, "--vocab_file is required"
+    assert FLAGS.output_file, "--output_file is required"
+
+    model_config = configuration.ModelConfig()
+    model_config.in_graph_beam_search = FLAGS.in_graph_beam_search
+    model_config.quantize_decoder_weights = FLAGS.quantize_decoder_weights
+    export_inference_graph(FLAGS.checkpoint_path, FLAGS.vocab_file, FLAGS.output_file,
+                           model_config)
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -24,6 +24,9 @@ tf.flags.DEFINE_string("vocab_file", "", "Text file containing the vocabulary.")
 tf.flags.DEFINE_string("input_files", "",
                        "File pattern or comma-separated list of file patterns "
                        "of image files.")
+tf.flags.DEFINE_integer("batch_size", 16,
+                        "Number of images captioned together by each beam "
+                        "search.")
 
 tf.logging.set_verbosity(tf.logging.INFO)
 
@@ -59,16 +62,20 @@ def main(_):
         # available beam search parameters.
         generator = caption_generator.CaptionGenerator(model, vocab)
 
-        for filename in filenames:
-            with tf.gfile.GFile(filename, "rb") as f:
-                image = f.read()
-            captions = generator.beam_search(sess, image)
-            print("Captions for image %s:" % os.path.basename(filename))
-            for i, caption in enumerate(captions):
-                # Ignore begin and end words.
-                sentence = [vocab.id_to_word(w) for w in caption.sentence[1:-1]]
-                sentence = " ".join(sentence)
-                print("  %d) %s (p=%f)" % (i, sentence, math.exp(caption.logprob)))
+        for start in range(0, len(filenames), FLAGS.batch_size):
+            batch_filenames = filenames[start:start + FLAGS.batch_size]
+            images = []
+            for filename in batch_filenames:
+                with tf.gfile.GFile(filename, "rb") as f:
+                    images.append(f.read())
+            batch_captions = generator.beam_search_batch(sess, images)
+            for filename, captions in zip(batch_filenames, batch_captions):
+                print("Captions for image %s:" % os.path.basename(filename))
+                for i, caption in enumerate(captions):
+                    # Ignore begin and end words.
+                    sentence = [vocab.id_to_word(w) for w in caption.sentence[1:-1]]
+                    sentence = " ".join(sentence)
+                    print("  %d) %s (p=%f)" % (i, sentence, math.exp(caption.logprob)))
 
 
 if __name__ == "__main__":
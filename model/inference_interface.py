@@ -5,15 +5,24 @@
 # @Author  : Swing
 
 
+import copy
 import math
 import os
+import threading
+import time
 
 import tensorflow as tf
 
 from model import configuration
 from model.inference_utils import inference_wrapper
+from model.inference_utils import numpy_decoder
 from model.inference_utils import caption_generator
 from model.inference_utils import vocabulary
+from model.serving_utils import batch_scheduler
+from model.serving_utils import caption_cache
+from model.serving_utils import encoder_stage
+from model.serving_utils import metrics
+from model.serving_utils import single_flight
 
 FLAGS = tf.flags.FLAGS
 
@@ -27,37 +36,476 @@ tf.flags.DEFINE_string("input_files", "",
 
 tf.logging.set_verbosity(tf.logging.INFO)
 
+_VOCAB_DECODE_SECONDS = metrics.REGISTRY.histogram(
+    "caption_vocab_decode_seconds", "Time of converting word ids to caption strings.")
 
-def inference(file, checkpoint_path, vocab_file):
-    # Build the inference_utils graph.
-    g = tf.Graph()
-    with g.as_default():
-        model = inference_wrapper.InferenceWrapper()
-        restore_fn = model.build_graph_from_config(configuration.ModelConfig(),
-                                                   checkpoint_path)
-    g.finalize()
-
-    # Create the vocabulary.
-    vocab = vocabulary.Vocabulary(vocab_file)
-
-    with tf.Session(graph=g) as sess:
-        # Load the model from checkpoint.
-        restore_fn(sess)
+
+class Captioner(object):
+    """Long-lived captioner holding one restored inference session.
+
+    The inference graph is built, the checkpoint restored and the vocabulary
+    loaded once, in the constructor. Every call afterwards reuses the same
+    session. tf.Session.run may be called from several threads at once and all
+    beam search state lives in local variables, so a single Captioner can serve
+    concurrent requests.
+    """
+
+    def __init__(self, checkpoint_path, vocab_file, model_config=None,
+                 session_config=None, max_batch_size=1, batch_timeout_secs=0.0,
+                 cache=None, warm_up=False, frozen_graph_file=None,
+                 use_numpy_decoder=False, encoder_addresses=None, encoder_authkey=None):
+        """Builds the graph and restores the model.
+        Args:
+          checkpoint_path: Model checkpoint file or directory containing a model
+            checkpoint file.
+          vocab_file: Text file containing the vocabulary.
+          model_config: Optional ModelConfig; defaults to ModelConfig().
+          session_config: Optional tf.ConfigProto for the session.
+          max_batch_size: If > 1, concurrent requests are decoded together by a
+            BatchScheduler holding up to this many images per batch.
+          batch_timeout_secs: How long the BatchScheduler waits to fill a batch.
+          cache: Optional CaptionCache holding formatted results of previously
+            captioned images.
+          warm_up: If True, warm_up() is run before the constructor returns.
+          frozen_graph_file: Optional graph written by export_inference_graph.py.
+            If given, the graph, weights and vocabulary are all loaded from it;
+            checkpoint_path and vocab_file are then only used as names.
+          use_numpy_decoder: If True, the decoder steps of beam search run in NumPy
+            (see NumpyDecoderWrapper) and the session only encodes images.
+          encoder_addresses: Optional addresses of encoder stages (see
+            encoder_stage.EncoderServer). If given, this Captioner is a decoder
+            stage: images are sent to the encoder stages for their initial
+            states, the decoder runs in NumPy on weights read from
+            checkpoint_path, and no TensorFlow session is created.
+          encoder_authkey: Optional bytes shared with the encoder stages.
+        Raises:
+          ValueError: If both encoder_addresses and frozen_graph_file are given.
+        """
+        if encoder_addresses and frozen_graph_file:
+            raise ValueError("A decoder stage reads its weights from checkpoint_path, "
+                             "not from a frozen graph")
+        if model_config is None:
+            model_config = configuration.ModelConfig()
+
+        self.checkpoint_path = checkpoint_path
+        self.vocab_file = vocab_file
+        self.model_config = model_config
+        self.max_batch_size = max_batch_size
+        self.cache = cache
+        self.flights = single_flight.SingleFlight()
+        self.ready = False
+
+        if encoder_addresses:
+            # Decoder stage: the images are encoded elsewhere and only the decoder
+            # weights are read from the checkpoint, without a graph or session.
+            self.graph = None
+            self.sess = None
+            self.model = numpy_decoder.RemoteEncoderWrapper(
+                encoder_stage.EncoderClient(encoder_addresses, authkey=encoder_authkey))
+            self.model.load_decoder_weights_from_checkpoint(checkpoint_path)
+            self.memory_bytes = self.model.decoder_bytes()
+        else:
+            self._restore_session(model_config, session_config, frozen_graph_file,
+                                  use_numpy_decoder)
+
+        # Create the vocabulary.
+        if frozen_graph_file:
+            vocab_lines = self.sess.run("vocabulary:0")
+            self.vocab = vocabulary.Vocabulary(
+                None, vocab_lines=[line.decode("utf-8") for line in vocab_lines])
+        else:
+            self.vocab = vocabulary.Vocabulary(vocab_file)
 
         # Prepare the caption generator. Here we are implicitly using the default
         # beam search parameters. See caption_generator.py for a description of the
         # available beam search parameters.
-        generator = caption_generator.CaptionGenerator(model, vocab)
+        self.in_graph = model_config.in_graph_beam_search and not encoder_addresses
+        self.generator = self._create_generator(metrics.BEAM_SEARCH_METRICS)
 
-        with tf.gfile.GFile(file, "rb") as f:
-            image = f.read()
-        captions = generator.beam_search(sess, image)
+        self.scheduler = None
+        if max_batch_size > 1:
+            self.scheduler = batch_scheduler.BatchScheduler(
+                self.generator, self.sess,
+                max_batch_size=max_batch_size,
+                batch_timeout_secs=batch_timeout_secs)
+
+        # Identifies the results of this model in the cache: the checkpoint file
+        # actually restored and the beam parameters used.
+        if frozen_graph_file:
+            checkpoint_path = frozen_graph_file
+        elif tf.gfile.IsDirectory(checkpoint_path):
+            checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+        in_graph_beam = None
+        if self.generator.in_graph:
+            in_graph_beam = (model_config.beam_size, model_config.max_caption_length,
+                             model_config.length_normalization_factor)
+        self.model_key = caption_cache.model_key(checkpoint_path, vocab_file,
+                                                 self.generator.beam_size,
+                                                 self.generator.max_caption_length,
+                                                 self.generator.length_normalization_factor,
+                                                 in_graph_beam)
+
+        if warm_up:
+            self.warm_up()
+        self.ready = True
+
+    def _restore_session(self, model_config, session_config, frozen_graph_file,
+                         use_numpy_decoder):
+        """Builds the inference graph and restores it into a new session."""
+        # Build the inference_utils graph.
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            if use_numpy_decoder:
+                self.model = numpy_decoder.NumpyDecoderWrapper()
+            else:
+                self.model = inference_wrapper.InferenceWrapper()
+            if frozen_graph_file:
+                restore_fn = self.model.build_graph_from_frozen(frozen_graph_file)
+            else:
+                restore_fn = self.model.build_graph_from_config(model_config,
+                                                                self.checkpoint_path)
+        self.graph.finalize()
+
+        # Size of the model variables, the bulk of a session's resident memory.
+        # A quantized model holds both its int8 decoder weights and, in local
+        # variables, their dequantized float32 copies, so it is larger than the
+        # float model.
+        if frozen_graph_file:
+            self.memory_bytes = sum(len(op.get_attr("value").tensor_content)
+                                    for op in self.graph.get_operations()
+                                    if op.type == "Const")
+            self.memory_bytes += sum(
+                tf.TensorShape(op.get_attr("shape")).num_elements() * op.get_attr("dtype").size
+                for op in self.graph.get_operations() if op.type == "VariableV2")
+        else:
+            with self.graph.as_default():
+                self.memory_bytes = sum(v.shape.num_elements() * v.dtype.base_dtype.size
+                                        for v in tf.global_variables() + tf.local_variables())
 
-        results = []
-        for i, caption in enumerate(captions):
-            # Ignore begin and end words.
-            sentence = [vocab.id_to_word(w) for w in caption.sentence[1:-1]]
-            sentence = " ".join(sentence)
+        # Load the model from checkpoint.
+        self.sess = tf.Session(graph=self.graph, config=session_config)
+        restore_fn(self.sess)
+        if use_numpy_decoder:
+            # Its copy of the decoder weights, int8 for a quantized model.
+            self.memory_bytes += self.model.decoder_bytes()
+
+    def _create_generator(self, beam_search_metrics):
+        """Returns a CaptionGenerator of this model recording its searches in
+        `beam_search_metrics`, or nowhere if None."""
+        return caption_generator.CaptionGenerator(self.model, self.vocab,
+                                                  in_graph=self.in_graph,
+                                                  early_stopping=True,
+                                                  metrics=beam_search_metrics)
+
+    def synthetic_image(self):
+        """Returns a random image encoded in the model's image format."""
+        height = self.model_config.image_height
+        width = self.model_config.image_width
+        graph = tf.Graph()
+        with graph.as_default():
+            pixels = tf.cast(tf.random_uniform([height, width, 3], maxval=256,
+                                               dtype=tf.int32), tf.uint8)
+            if self.model_config.image_format == "png":
+                encoded = tf.image.encode_png(pixels)
+            else:
+                encoded = tf.image.encode_jpeg(pixels)
+        with tf.Session(graph=graph) as sess:
+            return sess.run(encoded)
+
+    def warm_up(self, batch_sizes=None, num_steps=3):
+        """Runs synthetic images through the model so that TensorFlow initializes
+        its kernels and grows its allocator before real requests arrive.
+        Args:
+          batch_sizes: Numbers of images fed together; defaults to the powers of
+            two up to max_batch_size. Each exercises feed_images and
+            inference_step with batch_size * beam_size rows.
+          num_steps: Number of inference steps run for each batch size.
+        The warm-up searches are not recorded in the beam search metrics.
+        """
+        if batch_sizes is None:
+            batch_sizes = [1]
+            while batch_sizes[-1] * 2 <= self.max_batch_size:
+                batch_sizes.append(batch_sizes[-1] * 2)
+
+        encoded_image = self.synthetic_image()
+        generator = self._create_generator(None)
+        start = time.time()
+        for batch_size in batch_sizes:
+            generator.beam_search_batch(self.sess, [encoded_image] * batch_size,
+                                             max_caption_length=num_steps + 1)
+        tf.logging.info("Warmed up batch sizes %s in %.2f s", batch_sizes,
+                        time.time() - start)
+
+    def caption(self, encoded_image, beam_size=None, max_caption_length=None,
+                deadline=None):
+        """Runs beam search on an encoded image.
+        Args:
+          encoded_image: An encoded image string.
+          beam_size: Optional beam size; defaults to the generator's.
+          max_caption_length: Optional maximum caption length; defaults to the
+            generator's.
+          deadline: Optional time.time() value by which the search should end.
+        Returns:
+          A list of Caption sorted by descending score.
+        """
+        if self.scheduler is not None:
+            return self.scheduler.caption(encoded_image,
+                                          beam_size=beam_size,
+                                          max_caption_length=max_caption_length,
+                                          deadline=deadline)
+        return self.generator.beam_search(self.sess, encoded_image,
+                                          beam_size=beam_size,
+                                          max_caption_length=max_caption_length,
+                                          deadline=deadline)
+
+    def _result_key(self, encoded_image, beam_size, max_caption_length):
+        """Returns the key of an image's results, as used by CaptionCache.key."""
+        return (caption_cache.image_digest(encoded_image),
+                caption_cache.settings_key(self.model_key, beam_size, max_caption_length))
+
+    def _cache_put(self, key, results):
+        # Results cut short by a deadline, possibly of another request in their
+        # batch, are not kept.
+        if not results.deadline_exceeded:
+            self.cache.put(key, copy.copy(results))
+
+    def search_settings(self, beam_size=None, max_caption_length=None):
+        """Returns the (beam_size, max_caption_length) a search given these
+        optional overrides runs with. The in-graph decoder ignores overrides."""
+        if self.in_graph:
+            return self.model_config.beam_size, self.model_config.max_caption_length
+        return (beam_size or self.generator.beam_size,
+                max_caption_length or self.generator.max_caption_length)
+
+    def format_captions(self, captions, beam_size=None, max_caption_length=None):
+        """Converts Captions to "sentence (p=...)" strings.
+        Args:
+          captions: A list of Caption sorted by descending score, usually the
+            CaptionResults of a search, whose deadline_exceeded flag is kept.
+          beam_size: Optional beam size override the search was given.
+          max_caption_length: Optional maximum caption length override.
+        Returns:
+          A CaptionResults holding the strings and the settings that actually
+          produced them.
+        """
+        start = time.time()
+        beam_size, max_caption_length = self.search_settings(beam_size, max_caption_length)
+        results = caption_generator.CaptionResults(beam_size=beam_size,
+                                                   max_caption_length=max_caption_length,
+                                                   deadline_exceeded=getattr(
+                                                       captions, "deadline_exceeded", False))
+        for caption in captions:
+            # Ignore the begin word, and the end word of a complete caption.
+            word_ids = caption.sentence[1:]
+            if word_ids and word_ids[-1] == self.vocab.end_id:
+                word_ids = word_ids[:-1]
+            else:
+                results.truncated = True
+            sentence = " ".join(self.vocab.id_to_word(w) for w in word_ids)
             results.append("%s (p=%f)" % (sentence, math.exp(caption.logprob)))
+        _VOCAB_DECODE_SECONDS.observe(time.time() - start)
+        return results
+
+    def stream_image(self, encoded_image, beam_size=None, max_caption_length=None,
+                     deadline=None):
+        """Captions an encoded image, reporting the best partial caption after
+        every beam search step. Closing the generator stops the search. Beam
+        settings and deadline are as in caption().
+        Yields:
+          ("partial", "sentence (p=...)") after each step, then ("final",
+          results) with the formatted results of caption_image().
+        """
+        if isinstance(encoded_image, memoryview):
+            encoded_image = encoded_image.tobytes()
+
+        key = None
+        if self.cache is not None:
+            key = self._result_key(encoded_image, beam_size, max_caption_length)
+            results = self.cache.get(key)
+            if results is not None:
+                yield "final", copy.copy(results)
+                return
 
+        steps = self.generator.beam_search_steps(self.sess, encoded_image,
+                                                 beam_size=beam_size,
+                                                 max_caption_length=max_caption_length,
+                                                 deadline=deadline)
+        for kind, value in steps:
+            if kind == "partial":
+                # Ignore the begin word; a partial caption has no end word.
+                sentence = " ".join(self.vocab.id_to_word(w) for w in value.sentence[1:])
+                yield kind, "%s (p=%f)" % (sentence, math.exp(value.logprob))
+            else:
+                results = self.format_captions(value, beam_size, max_caption_length)
+                if key is not None:
+                    self._cache_put(key, results)
+                yield kind, results
+
+    def caption_image(self, encoded_image, beam_size=None, max_caption_length=None,
+                      deadline=None):
+        """Captions an encoded image and returns formatted results.
+        The cache, if any, is checked before any model work, and concurrent calls
+        for the same image and beam settings share one computation.
+        Args:
+          encoded_image: An encoded image, as a bytes object or a memoryview (for
+            example of an upload held in memory); nothing is written to disk.
+          beam_size: Optional beam size, as in caption().
+          max_caption_length: Optional maximum caption length, as in caption().
+          deadline: Optional deadline, as in caption().
+        """
+        if isinstance(encoded_image, memoryview):
+            encoded_image = encoded_image.tobytes()
+
+        key = self._result_key(encoded_image, beam_size, max_caption_length)
+        if self.cache is not None:
+            results = self.cache.get(key)
+            if results is not None:
+                return copy.copy(results)
+
+        def _caption():
+            results = self.format_captions(self.caption(encoded_image,
+                                                        beam_size=beam_size,
+                                                        max_caption_length=max_caption_length,
+                                                        deadline=deadline),
+                                           beam_size, max_caption_length)
+            if self.cache is not None:
+                self._cache_put(key, results)
+            return results
+
+        def _shareable(results):
+            # A result cut short by a deadline is only taken by a caller that has
+            # no time left for a search of its own.
+            return (not results.deadline_exceeded or
+                    (deadline is not None and time.time() >= deadline))
+
+        return copy.copy(self.flights.do(key, _caption, deadline, shareable=_shareable))
+
+    def caption_images(self, encoded_images, batch_size=16, beam_size=None,
+                       max_caption_length=None, deadline=None):
+        """Captions many encoded images with batched beam search.
+        Cached images are answered from the cache; the others are captioned
+        batch_size at a time with CaptionGenerator.beam_search_batch. If a batch
+        fails, its images are retried one at a time so that only the broken
+        images fail. Batches that would start after the deadline are not run;
+        their images fail with TimeoutError.
+        Args:
+          encoded_images: A list of encoded images (bytes or memoryview).
+          batch_size: Maximum number of images per beam_search_batch call.
+          beam_size: Optional beam size, as in caption().
+          max_caption_length: Optional maximum caption length, as in caption().
+          deadline: Optional deadline, as in caption().
+        Returns:
+          A list with, for each image, its formatted results, or the exception
+          raised while captioning it.
+        """
+        encoded_images = [image.tobytes() if isinstance(image, memoryview) else image
+                          for image in encoded_images]
+        results = [None] * len(encoded_images)
+        keys = [None] * len(encoded_images)
+        todo = []
+        for i, encoded_image in enumerate(encoded_images):
+            if self.cache is not None:
+                keys[i] = self._result_key(encoded_image, beam_size, max_caption_length)
+                results[i] = self.cache.get(keys[i])
+                if results[i] is not None:
+                    results[i] = copy.copy(results[i])
+                    continue
+            todo.append(i)
+
+        for start in range(0, len(todo), batch_size):
+            if deadline is not None and time.time() >= deadline:
+                for i in todo[start:]:
+                    results[i] = TimeoutError("Deadline passed before the image was captioned")
+                break
+            batch = todo[start:start + batch_size]
+            try:
+                batch_captions = self.generator.beam_search_batch(
+                    self.sess, [encoded_images[i] for i in batch],
+                    beam_size=beam_size,
+                    max_caption_length=max_caption_length,
+                    deadline=deadline)
+            except Exception:  # pylint: disable=broad-except
+                batch_captions = []
+                for i in batch:
+                    try:
+                        batch_captions.append(self.caption(encoded_images[i],
+                                                           beam_size=beam_size,
+                                                           max_caption_length=max_caption_length,
+                                                           deadline=deadline))
+                    except Exception as err:  # pylint: disable=broad-except
+                        batch_captions.append(err)
+
+            for i, captions in zip(batch, batch_captions):
+                if isinstance(captions, Exception):
+                    results[i] = captions
+                    continue
+                results[i] = self.format_captions(captions, beam_size, max_caption_length)
+                if keys[i] is not None:
+                    self._cache_put(keys[i], results[i])
         return results
+
+    def caption_file(self, file):
+        """Captions the image stored at `file` and returns formatted results."""
+        with tf.gfile.GFile(file, "rb") as f:
+            image = f.read()
+        return self.caption_image(image)
+
+    def close(self):
+        """Stops the scheduler and releases the session."""
+        if self.scheduler is not None:
+            self.scheduler.close()
+        if self.sess is not None:
+            self.sess.close()
+        if isinstance(self.model, numpy_decoder.RemoteEncoderWrapper):
+            self.model.encoder_client.close()
+
+
+# Leading bytes of the image formats the model can decode.
+_IMAGE_SIGNATURES = {
+    "jpeg": b"\xff\xd8\xff",
+    "png": b"\x89PNG\r\n\x1a\n",
+}
+
+
+def validate_image(encoded_image, image_format="jpeg"):
+    """Checks that an encoded image has the signature of `image_format`, so a
+    broken image can be rejected before it joins a batch.
+    Raises:
+      ValueError: If the image is empty or not in the expected format.
+    """
+    if not encoded_image:
+        raise ValueError("Empty image")
+    signature = _IMAGE_SIGNATURES.get(image_format)
+    if signature is not None and bytes(encoded_image[:len(signature)]) != signature:
+        raise ValueError("Not a %s image" % image_format)
+
+
+_captioners = {}
+_captioners_lock = threading.Lock()
+
+
+def get_captioner(checkpoint_path, vocab_file, **kwargs):
+    """Returns the process-wide Captioner for a checkpoint and vocabulary.
+
+    The Captioner is created on first use and cached for the lifetime of the
+    process. Keyword arguments are passed to the Captioner constructor and only
+    take effect on that first call.
+    """
+    key = (checkpoint_path, vocab_file)
+    with _captioners_lock:
+        captioner = _captioners.get(key)
+        if captioner is None:
+            captioner = Captioner(checkpoint_path, vocab_file, **kwargs)
+            _captioners[key] = captioner
+    return captioner
+
+
+def inference(file, checkpoint_path, vocab_file):
+    captioner = get_captioner(checkpoint_path, vocab_file)
+    return captioner.caption_file(file)
+
+
+def inference_image(encoded_image, checkpoint_path, vocab_file):
+    """Captions an encoded image (bytes or memoryview) held in memory."""
+    captioner = get_captioner(checkpoint_path, vocab_file)
+    return captioner.caption_image(encoded_image)
@@ -5,15 +5,39 @@
 # @Author  : Swing
 
 
+import contextlib
 import heapq
-import math
+import threading
+import time
 
 import numpy as np
 
 
+class _NoMetric(object):
+    """Histogram and counter that records nothing."""
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    @contextlib.contextmanager
+    def time(self):
+        yield
+
+
+class _NoMetrics(object):
+    """Metrics of a CaptionGenerator created without any."""
+    feed_image_seconds = inference_step_seconds = beam_search_seconds = _NoMetric()
+    beam_steps = batch_size = steps_saved = deadline_exceeded = _NoMetric()
+
+
 class Caption(object):
     """Represents a complete or partial caption."""
 
+    __slots__ = ("sentence", "state", "logprob", "score", "metadata")
+
     def __init__(self, sentence, state, logprob, score, metadata=None):
         """Initializes the Caption.
         Args:
@@ -51,6 +75,37 @@ class Caption(object):
         return self.score == other.score
 
 
+class CaptionResults(list):
+    """Captions of an image, best first, with the settings they were produced
+    with. CaptionGenerator returns Captions; Captioner formats them as strings.
+
+    Attributes:
+      beam_size: Beam size the search ran with.
+      max_caption_length: Maximum caption length the search ran with.
+      truncated: True if the captions are partial captions: none had ended when
+        the search was stopped by its deadline or by max_caption_length.
+      deadline_exceeded: True if the search was stopped by a deadline before it
+        ended. In a batch this may be the deadline of another request, so such
+        results must not be cached or handed to other requests.
+    """
+
+    def __init__(self, captions=(), beam_size=None, max_caption_length=None,
+                 truncated=False, deadline_exceeded=False):
+        super(CaptionResults, self).__init__(captions)
+        self.beam_size = beam_size
+        self.max_caption_length = max_caption_length
+        self.truncated = truncated
+        self.deadline_exceeded = deadline_exceeded
+
+    def settings(self):
+        """Returns the beam settings and the truncated and deadline_exceeded flags
+        as a dict."""
+        return {"beam_size": self.beam_size,
+                "max_caption_length": self.max_caption_length,
+                "truncated": self.truncated,
+                "deadline_exceeded": self.deadline_exceeded}
+
+
 class TopN(object):
     """Maintains the top n elements of an incrementally provided set."""
 
@@ -85,11 +140,159 @@ class TopN(object):
             data.sort(reverse=True)
         return data
 
+    def peek(self):
+        """Returns the smallest of the top n elements, or None if empty."""
+        assert self._data is not None
+        if not self._data:
+            return None
+        return self._data[0]
+
     def reset(self):
         """Returns the TopN to an empty state."""
         self._data = []
 
 
+class _Ending(object):
+    """A complete caption, stored as a backpointer into a BeamSearchState."""
+
+    __slots__ = ("step", "row", "state", "logprob", "score", "metadata")
+
+    def __init__(self, step, row, state, logprob, score, metadata):
+        self.step = step
+        self.row = row
+        self.state = state
+        self.logprob = logprob
+        self.score = score
+        self.metadata = metadata
+
+    def __lt__(self, other):
+        return self.score < other.score
+
+
+class BeamSearchState(object):
+    """Partial captions of one image, stored as backpointers.
+
+    After step t, words[t][i] is the last word of the i-th partial caption and
+    parents[t][i] is the row, in step t - 1, of the partial caption it extends.
+    Sentences are only rebuilt for the captions that are returned. The model
+    states of the partial captions are rows [0, size()) of a preallocated
+    [beam_size, state_size] array. Captions that have ended are kept in the
+    `complete_captions` TopN.
+    """
+
+    __slots__ = ("words", "parents", "metadata", "logprobs", "states", "_size",
+                 "complete_captions", "beam_size", "deadline_exceeded")
+
+    def __init__(self, start_id, initial_state, beam_size):
+        """Initializes the state with a single partial caption.
+        Args:
+          start_id: Word id of the sentence start word.
+          initial_state: A numpy array of shape [state_size]; the model state after
+            feeding the image.
+          beam_size: Maximum number of partial and complete captions.
+        """
+        initial_state = np.asarray(initial_state)
+        self.words = [np.array([start_id])]
+        self.parents = [np.array([-1])]
+        # Per step metadata lists, or None if inference_step returns none.
+        self.metadata = [[""]]
+        self.logprobs = np.zeros([1])
+        self.states = np.empty([beam_size, initial_state.shape[0]], dtype=initial_state.dtype)
+        self.states[0] = initial_state
+        self._size = 1
+        self.complete_captions = TopN(beam_size)
+        self.beam_size = beam_size
+        # Whether the search was stopped by a deadline.
+        self.deadline_exceeded = False
+
+    def size(self):
+        """Returns the number of partial captions."""
+        return self._size
+
+    def step(self):
+        """Returns the index of the last step."""
+        return len(self.words) - 1
+
+    def input_feed(self):
+        """Returns the last word of each partial caption."""
+        return self.words[-1]
+
+    def state_feed(self):
+        """Returns the model state of each partial caption."""
+        return self.states[:self._size]
+
+    def advance(self, rows, words, logprobs, new_states, metadata):
+        """Replaces the partial captions by their extensions.
+        Args:
+          rows: Row of the extended partial caption, for each new partial caption.
+          words: The word appended to each new partial caption.
+          logprobs: The log-probability of each new partial caption.
+          new_states: The states returned by inference_step for this step.
+          metadata: The metadata returned by inference_step for this step.
+        """
+        self.parents.append(rows)
+        self.words.append(words)
+        self.logprobs = logprobs
+        self._size = len(rows)
+        np.take(new_states, rows, axis=0, out=self.states[:self._size])
+        if self.metadata is not None and metadata:
+            self.metadata.append([metadata[r] for r in rows])
+        else:
+            self.metadata = None
+
+    def sentence(self, step, row):
+        """Rebuilds the word ids of the partial caption `row` of step `step`."""
+        sentence = []
+        for t in range(step, -1, -1):
+            sentence.append(int(self.words[t][row]))
+            row = self.parents[t][row]
+        sentence.reverse()
+        return sentence
+
+    def metadata_list(self, step, row):
+        """Rebuilds the metadata of the partial caption `row` of step `step`."""
+        if self.metadata is None:
+            return None
+        metadata_list = []
+        for t in range(step, -1, -1):
+            metadata_list.append(self.metadata[t][row])
+            row = self.parents[t][row]
+        metadata_list.reverse()
+        return metadata_list
+
+    def partial_captions(self):
+        """Returns the partial captions as a list of Caption."""
+        step = self.step()
+        captions = []
+        for i in range(self._size):
+            logprob = float(self.logprobs[i])
+            captions.append(Caption(self.sentence(step, i), self.states[i].copy(),
+                                    logprob, logprob, self.metadata_list(step, i)))
+        return captions
+
+    def best_partial_caption(self):
+        """Returns the partial caption with the highest log-probability, without
+        its model state."""
+        step = self.step()
+        i = int(np.argmax(self.logprobs[:self._size]))
+        logprob = float(self.logprobs[i])
+        return Caption(self.sentence(step, i), None, logprob, logprob,
+                       self.metadata_list(step, i))
+
+    def complete_caption_list(self, end_id):
+        """Returns the complete captions as a list of Caption sorted by descending
+        score. This is a destructive operation on complete_captions."""
+        captions = []
+        for ending in self.complete_captions.extract(sort=True):
+            sentence = self.sentence(ending.step, ending.row) + [end_id]
+            metadata_list = None
+            if ending.metadata is not None:
+                metadata_list = self.metadata_list(ending.step, ending.row) + [ending.metadata]
+            captions.append(Caption(sentence, ending.state, ending.logprob,
+                                    ending.score, metadata_list))
+        return captions
+
+
 class CaptionGenerator(object):
     """Class to generate captions from an image-to-text model."""
 
@@ -98,7 +301,10 @@ class CaptionGenerator(object):
                  vocab,
                  beam_size=3,
                  max_caption_length=20,
-                 length_normalization_factor=0.0):
+                 length_normalization_factor=0.0,
+                 in_graph=False,
+                 early_stopping=False,
+                 metrics=None):
         """Initializes the generator.
         Args:
           model: Object encapsulating a trained image-to-text model. Must have
@@ -111,6 +317,15 @@ class CaptionGenerator(object):
             scored by logprob/length^x, rather than logprob. This changes the
             relative scores of captions depending on their lengths. For example, if
             x > 0 then longer captions will be favored.
+          in_graph: If True, captions are generated by the model's in-graph beam
+            search decoder (see ShowAndTellModel.build_beam_search), whose beam
+            parameters are fixed when the graph is built.
+          early_stopping: If True and length_normalization_factor == 0, the search
+            of an image stops as soon as no partial caption can beat the k-th best
+            complete caption. The returned captions are unchanged.
+          metrics: Optional object holding the histograms and counters the
+            searches are recorded in, such as serving_utils' BeamSearchMetrics.
+            Nothing is recorded if None.
         """
         self.vocab = vocab
         self.model = model
@@ -118,73 +333,294 @@ class CaptionGenerator(object):
         self.beam_size = beam_size
         self.max_caption_length = max_caption_length
         self.length_normalization_factor = length_normalization_factor
+        self.in_graph = in_graph
+        self.early_stopping = early_stopping
+        self.metrics = metrics or _NoMetrics()
 
-    def beam_search(self, sess, encoded_image):
-        """Runs beam search caption generation on a single image.
+        # Totals over all searches stopped early.
+        self._stats_lock = threading.Lock()
+        self.early_stopped_searches = 0
+        self.steps_saved = 0
+
+    def init_beams(self, initial_state, beam_size=None):
+        """Creates the search state for a new image.
         Args:
-          sess: TensorFlow Session object.
-          encoded_image: An encoded image string.
+          initial_state: A numpy array of shape [state_size]; the model state after
+            feeding the image.
+          beam_size: Optional beam size of this search; defaults to self.beam_size.
+        Returns:
+          A BeamSearchState holding the initial beam.
+        """
+        return BeamSearchState(self.vocab.start_id, initial_state,
+                               beam_size or self.beam_size)
+
+    def expand_beams(self, search, softmax, new_states, metadata):
+        """Extends the partial captions of a search by one word.
+        The beam_size most probable next words of every partial caption are
+        selected at once; of the candidates that did not end, the beam_size best
+        become the new partial captions.
+        Args:
+          search: The BeamSearchState fed to this step.
+          softmax: A numpy array of shape [search.size(), vocab_size].
+          new_states: A numpy array of shape [search.size(), state_size].
+          metadata: Optional metadata returned by inference_step.
+        """
+        k = min(search.beam_size, softmax.shape[1])
+        top_words = np.argpartition(-softmax, k - 1, axis=1)[:, :k]
+        rows = np.repeat(np.arange(len(softmax)), k)
+        words = top_words.ravel()
+        probs = softmax[rows, words].astype(np.float64)
+
+        keep = probs >= 1e-12  # 视为prob为0 不处理
+        rows, words, probs = rows[keep], words[keep], probs[keep]
+        logprobs = search.logprobs[rows] + np.log(probs)
+
+        ended = words == self.vocab.end_id
+        if ended.any():
+            step = search.step()
+            length = step + 2
+            for r, logprob in zip(rows[ended], logprobs[ended]):
+                score = float(logprob)
+                if self.length_normalization_factor > 0:
+                    score /= length ** self.length_normalization_factor
+                search.complete_captions.push(
+                    _Ending(step, r, new_states[r].copy(), float(logprob), score,
+                            metadata[r] if metadata else None))
+
+        rows, words, logprobs = rows[~ended], words[~ended], logprobs[~ended]
+        best = np.argsort(-logprobs, kind="stable")[:search.beam_size]
+        search.advance(rows[best], words[best], logprobs[best], new_states, metadata)
+
+    def stop_early(self, search, steps_left):
+        """Checks whether a search can end before max_caption_length.
+        Log-probabilities never increase as words are appended, so once the
+        complete captions fill the beam and no partial caption scores above the
+        worst of them, no extension can enter the top beam_size. This only holds
+        when captions are scored by logprob, i.e. length_normalization_factor == 0.
+        Args:
+          search: A BeamSearchState after expand_beams.
+          steps_left: Number of inference steps the search would still run.
         Returns:
-          A list of Caption sorted by descending score.
+          True if the search can stop; the skipped steps are then added to
+          self.steps_saved.
         """
+        if not self.early_stopping or self.length_normalization_factor != 0:
+            return False
+        if steps_left <= 0 or not search.size():
+            return False
+        if search.complete_captions.size() < search.beam_size:
+            return False
+        if search.logprobs.max() > search.complete_captions.peek().score:
+            return False
+
+        with self._stats_lock:
+            self.early_stopped_searches += 1
+            self.steps_saved += steps_left
+        self.metrics.steps_saved.inc(steps_left)
+        return True
+
+    def deadline_passed(self, deadline):
+        """Returns True if `deadline`, a time.time() value or None, has passed."""
+        if deadline is not None and time.time() >= deadline:
+            self.metrics.deadline_exceeded.inc()
+            return True
+        return False
+
+    def _inference_step(self, sess, input_feed, state_feed):
+        with self.metrics.inference_step_seconds.time():
+            return self.model.inference_step(sess, input_feed, state_feed)
+
+    def finish_beams(self, search):
+        """Returns the final captions of a search as a CaptionResults sorted by
+        descending score."""
+        self.metrics.beam_steps.observe(search.step())
+        # If we have no complete captions then fall back to the partial captions.
+        # But never output a mixture of complete and partial captions because a
+        # partial caption could have a higher score than all the complete captions.
+        if not search.complete_captions.size():
+            captions = search.partial_captions()
+        else:
+            captions = search.complete_caption_list(self.vocab.end_id)
+        return CaptionResults(captions, beam_size=search.beam_size,
+                              deadline_exceeded=search.deadline_exceeded)
+
+    def _search(self, sess, encoded_image, beam_size, max_caption_length, deadline):
+        """Runs beam search on a single image, one step per iteration.
+        This is a generator: it yields the BeamSearchState after each step that
+        leaves partial captions to extend, and returns the CaptionResults of
+        finish_beams.
+        """
+        start = time.time()
+        self.metrics.batch_size.observe(1)
+
         # Feed in the image to get the initial state.
-        initial_state = self.model.feed_image(sess, encoded_image)
-
-        initial_beam = Caption(
-            sentence=[self.vocab.start_id],
-            state=initial_state[0],
-            logprob=0.0,
-            score=0.0,
-            metadata=[""])
-        partial_captions = TopN(self.beam_size)
-        partial_captions.push(initial_beam)
-        complete_captions = TopN(self.beam_size)
+        with self.metrics.feed_image_seconds.time():
+            initial_state = self.model.feed_image(sess, encoded_image)
+        search = self.init_beams(initial_state[0], beam_size)
 
         # Run beam search.
-        for _ in range(self.max_caption_length - 1):
-            partial_captions_list = partial_captions.extract()
-            partial_captions.reset()
-            input_feed = np.array([c.sentence[-1] for c in partial_captions_list])
-            state_feed = np.array([c.state for c in partial_captions_list])
-
-            softmax, new_states, metadata = self.model.inference_step(sess,
-                                                                      input_feed,
-                                                                      state_feed)
-
-            for i, partial_caption in enumerate(partial_captions_list):
-                word_probabilities = softmax[i]
-                state = new_states[i]
-                # For this partial caption, get the beam_size most probable next words.
-                words_and_probs = list(enumerate(word_probabilities))
-                words_and_probs.sort(key=lambda x: -x[1])
-                words_and_probs = words_and_probs[0:self.beam_size]
-                # Each next word gives a new partial caption.
-                for w, p in words_and_probs:
-                    if p < 1e-12:
-                        continue  # 视为prob为0 不处理
-                    sentence = partial_caption.sentence + [w]
-                    logprob = partial_caption.logprob + math.log(p)
-                    score = logprob
-                    if metadata:
-                        metadata_list = partial_caption.metadata + [metadata[i]]
-                    else:
-                        metadata_list = None
-                    if w == self.vocab.end_id:
-                        if self.length_normalization_factor > 0:
-                            score /= len(sentence) ** self.length_normalization_factor
-                        beam = Caption(sentence, state, logprob, score, metadata_list)
-                        complete_captions.push(beam)
-                    else:
-                        beam = Caption(sentence, state, logprob, score, metadata_list)
-                        partial_captions.push(beam)
-            if partial_captions.size() == 0:
+        num_steps = (max_caption_length or self.max_caption_length) - 1
+        for step in range(num_steps):
+            softmax, new_states, metadata = self._inference_step(sess,
+                                                                 search.input_feed(),
+                                                                 search.state_feed())
+
+            self.expand_beams(search, softmax, new_states, metadata)
+            if not search.size():
                 # We have run out of partial candidates; happens when beam_size = 1.
                 break
+            if self.stop_early(search, num_steps - step - 1):
+                break
+            if self.deadline_passed(deadline):
+                search.deadline_exceeded = True
+                break
+            yield search
 
-        # If we have no complete captions then fall back to the partial captions.
-        # But never output a mixture of complete and partial captions because a
-        # partial caption could have a higher score than all the complete captions.
-        if not complete_captions.size():
-            complete_captions = partial_captions
+        captions = self.finish_beams(search)
+        self.metrics.beam_search_seconds.observe(time.time() - start)
+        return captions
+
+    def beam_search(self, sess, encoded_image, beam_size=None,
+                    max_caption_length=None, deadline=None):
+        """Runs beam search caption generation on a single image.
+        Args:
+          sess: TensorFlow Session object.
+          encoded_image: An encoded image string.
+          beam_size: Optional beam size for this call; 1 is greedy decoding.
+          max_caption_length: Optional maximum caption length for this call.
+          deadline: Optional time.time() value. The search stops after the first
+            step that ends past it and returns the best captions found so far.
+        Returns:
+          A CaptionResults of Caption sorted by descending score.
+        """
+        if self.in_graph:
+            return self.beam_search_in_graph(sess, [encoded_image])[0]
+
+        steps = self._search(sess, encoded_image, beam_size, max_caption_length, deadline)
+        while True:
+            try:
+                next(steps)
+            except StopIteration as stop:
+                return stop.value
+
+    def beam_search_steps(self, sess, encoded_image, beam_size=None,
+                          max_caption_length=None, deadline=None):
+        """Runs beam search on a single image, reporting progress after each step.
+        This is a generator: closing it stops the search before the next
+        inference step.
+        Args:
+          sess: TensorFlow Session object.
+          encoded_image: An encoded image string.
+          beam_size: Optional beam size, as in beam_search.
+          max_caption_length: Optional maximum caption length, as in beam_search.
+          deadline: Optional deadline, as in beam_search.
+        Yields:
+          ("partial", caption) after each step that leaves partial captions, with
+          the best partial Caption; then ("final", captions) with the list of
+          Caption sorted by descending score that beam_search would return.
+        """
+        if self.in_graph:
+            yield "final", self.beam_search_in_graph(sess, [encoded_image])[0]
+            return
+
+        steps = self._search(sess, encoded_image, beam_size, max_caption_length, deadline)
+        while True:
+            try:
+                search = next(steps)
+            except StopIteration as stop:
+                yield "final", stop.value
+                return
+            yield "partial", search.best_partial_caption()
+
+    def beam_search_batch(self, sess, encoded_images, beam_size=None,
+                          max_caption_length=None, deadline=None):
+        """Runs beam search caption generation on a batch of images.
+        The images are encoded by one feed_images call. At every step the partial
+        captions of all images still being searched are fed through a single
+        inference_step call; images whose search has ended drop out of the batch.
+        Args:
+          sess: TensorFlow Session object.
+          encoded_images: A list of encoded image strings.
+          beam_size: Optional beam size, as in beam_search.
+          max_caption_length: Optional maximum caption length, as in beam_search.
+          deadline: Optional deadline, as in beam_search; it ends the search of
+            all the images.
+        Returns:
+          A list with, for each image, a CaptionResults of Caption sorted by
+          descending score.
+        """
+        if self.in_graph:
+            return self.beam_search_in_graph(sess, encoded_images)
+
+        start = time.time()
+        self.metrics.batch_size.observe(len(encoded_images))
+
+        with self.metrics.feed_image_seconds.time():
+            initial_states = self.model.feed_images(sess, encoded_images)
+        searches = [self.init_beams(initial_state, beam_size)
+                    for initial_state in initial_states]
+
+        active = list(range(len(searches)))
+        num_steps = (max_caption_length or self.max_caption_length) - 1
+        for step in range(num_steps):
+            if not active:
+                break
+
+            input_feed = np.concatenate([searches[i].input_feed() for i in active])
+            state_feed = np.concatenate([searches[i].state_feed() for i in active])
+
+            softmax, new_states, metadata = self._inference_step(sess,
+                                                                 input_feed,
+                                                                 state_feed)
+
+            # Hand each image its own rows of the batched outputs.
+            still_active = []
+            offset = 0
+            for i in active:
+                search = searches[i]
+                end = offset + search.size()
+                self.expand_beams(search,
+                                  softmax[offset:end],
+                                  new_states[offset:end],
+                                  metadata[offset:end] if metadata else None)
+                offset = end
+                if search.size() and not self.stop_early(search, num_steps - step - 1):
+                    still_active.append(i)
+            active = still_active
+            if active and self.deadline_passed(deadline):
+                for i in active:
+                    searches[i].deadline_exceeded = True
+                break
+
+        results = [self.finish_beams(search) for search in searches]
+        self.metrics.beam_search_seconds.observe(time.time() - start)
+        return results
+
+    def beam_search_in_graph(self, sess, encoded_images):
+        """Runs the in-graph beam search decoder on a batch of images.
+        The whole search is a single session run; the returned Captions carry no
+        model state.
+        Args:
+          sess: TensorFlow Session object.
+          encoded_images: A list of encoded image strings.
+        Returns:
+          A list with, for each image, a CaptionResults of Caption sorted by
+          descending score.
+        """
+        self.metrics.batch_size.observe(len(encoded_images))
+        with self.metrics.beam_search_seconds.time():
+            sequences, lengths, logprobs, scores = self.model.run_beam_search(
+                sess, encoded_images, self.vocab.start_id, self.vocab.end_id)
 
-        return complete_captions.extract(sort=True)
+        results = []
+        for i in range(len(encoded_images)):
+            captions = CaptionResults(beam_size=sequences.shape[1])
+            for j in range(sequences.shape[1]):
+                if not np.isfinite(scores[i, j]):
+                    continue  # Empty slot.
+                captions.append(Caption(sentence=sequences[i, j, :lengths[i, j]].tolist(),
+                                        state=None,
+                                        logprob=float(logprobs[i, j]),
+                                        score=float(scores[i, j])))
+            results.append(captions)
+        return results
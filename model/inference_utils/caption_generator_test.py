@@ -0,0 +1,154 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-12 上午10:40
+
+# @Author  : Swing
+
+
+import copy
+import pickle
+import unittest
+
+import numpy as np
+
+from model.inference_utils import caption_generator
+from model.serving_utils import metrics
+
+
+class FakeVocab(object):
+    """Fake Vocabulary for testing purposes."""
+
+    def __init__(self):
+        self.start_id = 0  # Word id denoting sentence start.
+        self.end_id = 1  # Word id denoting sentence end.
+
+
+class FakeModel(object):
+    """Fake model whose next word distribution never changes."""
+
+    def __init__(self, probabilities):
+        self.probabilities = np.array(probabilities, dtype=np.float32)
+        self.steps = 0
+
+    def feed_image(self, sess, encoded_image):
+        return np.zeros([1, 2], dtype=np.float32)
+
+    def feed_images(self, sess, encoded_images):
+        return np.zeros([len(encoded_images), 2], dtype=np.float32)
+
+    def inference_step(self, sess, input_feed, state_feed):
+        self.steps += 1
+        softmax = np.tile(self.probabilities, [len(input_feed), 1])
+        return softmax, np.array(state_feed), None
+
+
+class BeamSearchStateTest(unittest.TestCase):
+
+    def _advance(self, search, rows, words, logprobs, metadata=None):
+        rows = np.array(rows)
+        new_states = np.arange(search.size() * 2, dtype=np.float32).reshape([-1, 2])
+        search.advance(rows, np.array(words), np.array(logprobs), new_states, metadata)
+
+    def testSentenceFollowsBackpointers(self):
+        search = caption_generator.BeamSearchState(0, np.zeros([2], np.float32), beam_size=2)
+        self._advance(search, [0, 0], [5, 6], [-1.0, -2.0])
+        # Row 0 extends "6" and row 1 extends "5": the rows cross.
+        self._advance(search, [1, 0], [7, 8], [-2.5, -3.0])
+        self._advance(search, [1, 1], [9, 4], [-3.5, -4.0])
+
+        self.assertEqual(3, search.step())
+        self.assertEqual([0, 6, 7], search.sentence(2, 0))
+        self.assertEqual([0, 5, 8], search.sentence(2, 1))
+        self.assertEqual([0, 5, 8, 9], search.sentence(3, 0))
+        self.assertEqual([0, 5, 8, 4], search.sentence(3, 1))
+        self.assertEqual([0], search.sentence(0, 0))
+
+    def testMetadataFollowsBackpointers(self):
+        search = caption_generator.BeamSearchState(0, np.zeros([2], np.float32), beam_size=2)
+        # Metadata is returned per fed row, i.e. per parent.
+        self._advance(search, [0, 0], [5, 6], [-1.0, -2.0], ["a"])
+        self._advance(search, [1, 0], [7, 8], [-2.5, -3.0], ["b", "c"])
+        self.assertEqual(["", "a", "c"], search.metadata_list(2, 0))
+        self.assertEqual(["", "a", "b"], search.metadata_list(2, 1))
+
+    def testCompleteCaptionsEndWithEndWord(self):
+        search = caption_generator.BeamSearchState(0, np.zeros([2], np.float32), beam_size=2)
+        self._advance(search, [0, 0], [5, 6], [-1.0, -2.0])
+        search.complete_captions.push(
+            caption_generator._Ending(1, 1, None, -2.5, -2.5, None))
+        search.complete_captions.push(
+            caption_generator._Ending(0, 0, None, -0.5, -0.5, None))
+
+        captions = search.complete_caption_list(1)
+        self.assertEqual([[0, 1], [0, 6, 1]], [c.sentence for c in captions])
+        self.assertEqual([-0.5, -2.5], [c.score for c in captions])
+
+
+class CaptionResultsTest(unittest.TestCase):
+
+    def testCopiesKeepTheSettings(self):
+        results = caption_generator.CaptionResults(["a dog (p=0.5)"], beam_size=2,
+                                                   max_caption_length=16, truncated=True)
+        for other in (copy.copy(results), pickle.loads(pickle.dumps(results))):
+            self.assertEqual(["a dog (p=0.5)"], other)
+            self.assertEqual({"beam_size": 2, "max_caption_length": 16, "truncated": True,
+                              "deadline_exceeded": False}, other.settings())
+        other = copy.copy(results)
+        other.append("a cat (p=0.1)")
+        self.assertEqual(1, len(results))
+
+
+class CaptionGeneratorTest(unittest.TestCase):
+
+    def _beam_search(self, early_stopping):
+        model = FakeModel([0.0, 0.6, 0.3, 0.1])
+        generator = caption_generator.CaptionGenerator(
+            model, FakeVocab(), beam_size=2, max_caption_length=10,
+            early_stopping=early_stopping)
+        captions = generator.beam_search(None, b"image")
+        return captions, model.steps, generator
+
+    def testEarlyStoppingKeepsTheCaptions(self):
+        expected, full_steps, _ = self._beam_search(early_stopping=False)
+        captions, steps, generator = self._beam_search(early_stopping=True)
+
+        self.assertEqual([c.sentence for c in expected], [c.sentence for c in captions])
+        self.assertEqual([c.score for c in expected], [c.score for c in captions])
+        self.assertLess(steps, full_steps)
+        self.assertEqual(1, generator.early_stopped_searches)
+        self.assertEqual(full_steps - steps, generator.steps_saved)
+
+    def testStepsEndWithTheCaptionsOfBeamSearch(self):
+        expected, steps, _ = self._beam_search(early_stopping=False)
+        generator = caption_generator.CaptionGenerator(
+            FakeModel([0.0, 0.6, 0.3, 0.1]), FakeVocab(), beam_size=2, max_caption_length=10)
+        events = list(generator.beam_search_steps(None, b"image"))
+
+        self.assertEqual(["partial"] * (len(events) - 1), [kind for kind, _ in events[:-1]])
+        self.assertEqual(steps, len(events) - 1)
+        kind, captions = events[-1]
+        self.assertEqual("final", kind)
+        self.assertEqual([c.sentence for c in expected], [c.sentence for c in captions])
+
+    def testBatchesStoppedByTheDeadlineAreFlagged(self):
+        generator = caption_generator.CaptionGenerator(
+            FakeModel([0.0, 0.6, 0.3, 0.1]), FakeVocab(), beam_size=2, max_caption_length=10)
+        results = generator.beam_search_batch(None, [b"a", b"b"], deadline=0)
+        self.assertEqual([True, True], [r.deadline_exceeded for r in results])
+        results = generator.beam_search_batch(None, [b"a", b"b"])
+        self.assertEqual([False, False], [r.deadline_exceeded for r in results])
+
+    def testRecordsSearchesInGivenMetrics(self):
+        beam_search_metrics = metrics.BeamSearchMetrics(metrics.Registry())
+        generator = caption_generator.CaptionGenerator(
+            FakeModel([0.0, 0.6, 0.3, 0.1]), FakeVocab(), beam_size=2,
+            max_caption_length=10, metrics=beam_search_metrics)
+        self.assertFalse(generator.beam_search(None, b"image").deadline_exceeded)
+        self.assertTrue(generator.beam_search(None, b"image", deadline=0).deadline_exceeded)
+        self.assertEqual(1, beam_search_metrics.deadline_exceeded.value())
+        self.assertIn("caption_beam_search_seconds_count 2",
+                      beam_search_metrics.beam_search_seconds.render())
+
+
+if __name__ == "__main__":
+    unittest.main()
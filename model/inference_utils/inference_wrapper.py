@@ -25,6 +25,11 @@ class InferenceWrapper(inference_wrapper_base.InferenceWrapperBase):
                                  feed_dict={"image_feed:0": encoded_image})
         return initial_state
 
+    def feed_images(self, sess, encoded_images):
+        initial_states = sess.run(fetches="lstm/initial_state:0",
+                                  feed_dict={"image_batch_feed:0": encoded_images})
+        return initial_states
+
     def inference_step(self, sess, input_feed, state_feed):
         softmax_output, state_output = sess.run(
             fetches=["softmax:0", "lstm/state:0"],
@@ -33,3 +38,14 @@ class InferenceWrapper(inference_wrapper_base.InferenceWrapperBase):
                 "lstm/state_feed:0": state_feed,
             })
         return softmax_output, state_output, None
+
+    def run_beam_search(self, sess, encoded_images, start_id, end_id):
+        sequences, lengths, logprobs, scores = sess.run(
+            fetches=["beam_search/sequences:0", "beam_search/lengths:0",
+                     "beam_search/logprobs:0", "beam_search/scores:0"],
+            feed_dict={
+                "image_batch_feed:0": encoded_images,
+                "beam_search/start_id:0": start_id,
+                "beam_search/end_id:0": end_id,
+            })
+        return sequences, lengths, logprobs, scores
@@ -6,12 +6,25 @@
 
 import os.path
 
+import numpy as np
 import tensorflow as tf
 
+from model.inference_utils import quantization
+
 
 # pylint: disable=unused-argument
 
 
+def _dequantize_weights(sess):
+    """Assigns the dequantized decoder weights of a quantized model once, so that
+    inference steps read float weights rather than dequantizing them."""
+    try:
+        dequantize = sess.graph.get_operation_by_name(quantization.DEQUANTIZE_OP)
+    except KeyError:
+        return
+    sess.run(dequantize)
+
+
 class InferenceWrapperBase(object):
     """Base wrapper class for performing inference_utils with an image-to-text model."""
 
@@ -48,6 +61,7 @@ class InferenceWrapperBase(object):
         def _restore_fn(sess):
             tf.logging.info("Loading model from checkpoint: %s", checkpoint_path)
             saver.restore(sess, checkpoint_path)
+            _dequantize_weights(sess)
             tf.logging.info("Successfully loaded checkpoint: %s",
                             os.path.basename(checkpoint_path))
 
@@ -97,6 +111,26 @@ class InferenceWrapperBase(object):
 
         return self._create_restore_fn(checkpoint_path, saver)
 
+    def build_graph_from_frozen(self, frozen_graph_file):
+        """Builds the inference_utils graph from a single-file frozen GraphDef, as
+        written by export_inference_graph.py, whose variables are constants.
+        Args:
+          frozen_graph_file: File containing the serialized frozen GraphDef.
+        Returns:
+          restore_fn: A function such that restore_fn(sess) prepares the session;
+            only the dequantized weights of a quantized model are assigned.
+        """
+        tf.logging.info("Loading frozen GraphDef from file: %s", frozen_graph_file)
+        graph_def = tf.GraphDef()
+        with tf.gfile.FastGFile(frozen_graph_file, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        tf.import_graph_def(graph_def, name="")
+
+        def _restore_fn(sess):
+            _dequantize_weights(sess)
+
+        return _restore_fn
+
     def feed_image(self, sess, encoded_image):
         """Feeds an image and returns the initial model state.
         See comments at the top of file.
@@ -108,6 +142,19 @@ class InferenceWrapperBase(object):
         """
         tf.logging.fatal("Please implement feed_image in subclass")
 
+    def feed_images(self, sess, encoded_images):
+        """Feeds a batch of images and returns their initial model states.
+        Subclasses whose graph accepts a batch of images should override this;
+        the default implementation feeds the images one at a time.
+        Args:
+          sess: TensorFlow Session object.
+          encoded_images: A list of encoded image strings.
+        Returns:
+          states: A numpy array of shape [len(encoded_images), state_size].
+        """
+        return np.concatenate([self.feed_image(sess, encoded_image)
+                               for encoded_image in encoded_images])
+
     def inference_step(self, sess, input_feed, state_feed):
         """Runs one step of inference_utils.
         Args:
@@ -123,4 +170,23 @@ class InferenceWrapperBase(object):
         """
         tf.logging.fatal("Please implement inference_step in subclass")
 
+    def run_beam_search(self, sess, encoded_images, start_id, end_id):
+        """Runs the in-graph beam search decoder on a batch of images.
+        Only available when the model was built with in_graph_beam_search.
+        Args:
+          sess: TensorFlow Session object.
+          encoded_images: A list of encoded image strings.
+          start_id: Word id of the sentence start word.
+          end_id: Word id of the sentence end word.
+        Returns:
+          sequences: A numpy array of shape [batch_size, beam_size,
+            max_caption_length] holding word ids.
+          lengths: A numpy array of shape [batch_size, beam_size]; the number of
+            valid word ids in each sequence.
+          logprobs: A numpy array of shape [batch_size, beam_size].
+          scores: A numpy array of shape [batch_size, beam_size]; -inf marks an
+            empty slot.
+        """
+        tf.logging.fatal("Please implement run_beam_search in subclass")
+
 # pylint: enable=unused-argument
@@ -0,0 +1,284 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-8 下午3:20
+
+# @Author  : Swing
+
+
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from model.inference_utils import inference_wrapper
+from model.inference_utils import quantization
+
+# Decoder weights read from the session, by graph variable name.
+_LSTM_KERNEL = "lstm/basic_lstm_cell/kernel"
+_LSTM_BIAS = "lstm/basic_lstm_cell/bias"
+_LOGITS_WEIGHTS = "logits/weights"
+_LOGITS_BIASES = "logits/biases"
+_EMBEDDING_MAP = "seq_embedding/map"
+
+# Names under which a frozen graph must keep the decoder weights.
+DECODER_WEIGHTS = (_LSTM_KERNEL, _LSTM_BIAS, _LOGITS_WEIGHTS, _LOGITS_BIASES, _EMBEDDING_MAP)
+
+# Added to the forget gate at run time by BasicLSTMCell and LSTMBlockCell.
+_FORGET_BIAS = 1.0
+
+# Output columns of an int8 weight matrix dequantized at a time. A tile of the
+# lstm kernel, 256 columns of 1024 rows, is 1MB of float32 and stays in cache.
+_TILE_COLUMNS = 256
+
+
+def _sigmoid(x):
+    """Computes the logistic function of x in place."""
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1.0
+    np.reciprocal(x, out=x)
+
+
+def _matmul(x, weights, scales, tile, out):
+    """Computes x times weights into out. If scales is not None, weights are int8
+    with one scale per output column; they are dequantized into `tile` one tile
+    of columns at a time and the scales are applied to the products."""
+    if scales is None:
+        np.dot(x, weights, out=out)
+        return
+    num_columns = weights.shape[1]
+    for start in range(0, num_columns, _TILE_COLUMNS):
+        end = min(start + _TILE_COLUMNS, num_columns)
+        weights_tile = tile[:weights.shape[0], :end - start]
+        np.copyto(weights_tile, weights[:, start:end])
+        np.matmul(x, weights_tile, out=out[:, start:end])
+    out *= scales
+
+
+class _Buffers(object):
+    """Work arrays of the decoder step for batches of up to batch_size rows, with
+    a tile for dequantizing int8 weights if `quantized`."""
+
+    def __init__(self, batch_size, embedding_size, num_units, quantized):
+        self.batch_size = batch_size
+        self.inputs = np.empty([batch_size, embedding_size + num_units], np.float32)
+        self.gates = np.empty([batch_size, 4 * num_units], np.float32)
+        self.sums = np.empty([batch_size, 1], np.float32)
+        self.tile = None
+        if quantized:
+            self.tile = np.empty([embedding_size + num_units, _TILE_COLUMNS], np.float32)
+
+
+class NumpyDecoderWrapper(inference_wrapper.InferenceWrapper):
+    """InferenceWrapper that runs the decoder steps in NumPy.
+
+    The Inception encoder still runs in the TensorFlow session: feed_image and
+    feed_images are inherited. After the model is restored the seq_embedding,
+    lstm and logits weights are copied out of the session, and inference_step
+    computes the embedding lookup, LSTM cell and softmax with NumPy. No session
+    run is made per step.
+
+    Weights stored quantized, by quantize_decoder.py, stay int8 in memory with
+    their per-channel scales, about a quarter of the float32 size. The matmul
+    weights are dequantized one tile of _TILE_COLUMNS output columns at a time
+    and only the looked up embedding rows are dequantized. Steps of beam-sized
+    batches take about as long as with float32 weights; large batches are up to
+    a quarter slower.
+
+    Work arrays are taken from a pool holding one set per concurrent call, each
+    grown to the largest batch it has served. The softmax and state arrays
+    returned by inference_step are new arrays owned by the caller.
+    """
+
+    def __init__(self):
+        super(NumpyDecoderWrapper, self).__init__()
+        self._lock = threading.Lock()
+        self._free_buffers = []
+        self.lstm_kernel = None
+        self.lstm_bias = None
+        self.logits_weights = None
+        self.logits_biases = None
+        self.embedding_map = None
+        # Per-channel scales of the weights above that are int8, else None.
+        self.lstm_kernel_scales = None
+        self.logits_weights_scales = None
+        self.embedding_scales = None
+
+    def build_graph_from_config(self, model_config, checkpoint_path):
+        restore_fn = super(NumpyDecoderWrapper, self).build_graph_from_config(
+            model_config, checkpoint_path)
+        return self._loading_decoder_weights(restore_fn)
+
+    def build_graph_from_frozen(self, frozen_graph_file):
+        restore_fn = super(NumpyDecoderWrapper, self).build_graph_from_frozen(
+            frozen_graph_file)
+        return self._loading_decoder_weights(restore_fn)
+
+    def _loading_decoder_weights(self, restore_fn):
+        def _restore_fn(sess):
+            restore_fn(sess)
+            self.load_decoder_weights(sess)
+
+        return _restore_fn
+
+    def _read_weight(self, read, name):
+        """Returns the value of the decoder variable `name` and, if it is stored
+        quantized, its per-channel scales. read(name) returns a stored value or
+        None. The int8 values are preferred to the float32 variable a quantized
+        graph dequantizes them into.
+        Returns:
+          weights: A float32 array, or an int8 array if stored quantized.
+          scales: A float32 array of per-channel scales, or None.
+        """
+        quantized = read(name + quantization.QUANTIZED_SUFFIX)
+        if quantized is not None:
+            scales = read(name + quantization.SCALE_SUFFIX)
+            return (np.ascontiguousarray(quantized, dtype=np.int8),
+                    np.ascontiguousarray(scales, dtype=np.float32))
+        value = read(name)
+        if value is None:
+            raise ValueError("Decoder weight %s not found" % name)
+        return np.ascontiguousarray(value, dtype=np.float32), None
+
+    def _load_decoder_weights(self, read):
+        self.lstm_kernel, self.lstm_kernel_scales = self._read_weight(read, _LSTM_KERNEL)
+        self.lstm_bias, _ = self._read_weight(read, _LSTM_BIAS)
+        self.logits_weights, self.logits_weights_scales = self._read_weight(
+            read, _LOGITS_WEIGHTS)
+        self.logits_biases, _ = self._read_weight(read, _LOGITS_BIASES)
+        self.embedding_map, self.embedding_scales = self._read_weight(read, _EMBEDDING_MAP)
+        tf.logging.info("Loaded NumPy decoder weights: %d units, %d words",
+                        self.lstm_bias.shape[0] // 4, self.embedding_map.shape[0])
+
+    def load_decoder_weights(self, sess):
+        """Copies the decoder weights out of a restored session, where they are
+        variables or frozen constants."""
+        def read(name):
+            for tensor_name in (name + ":0", name + "/read:0"):
+                try:
+                    return sess.run(sess.graph.get_tensor_by_name(tensor_name))
+                except KeyError:
+                    continue
+            return None
+
+        self._load_decoder_weights(read)
+
+    def load_decoder_weights_from_checkpoint(self, checkpoint_path):
+        """Reads the decoder weights directly from a checkpoint, without building
+        a graph. Only inference_step can then be used.
+        Args:
+          checkpoint_path: Model checkpoint file or directory containing a model
+            checkpoint file.
+        Raises:
+          ValueError: If no checkpoint is found.
+        """
+        if tf.gfile.IsDirectory(checkpoint_path):
+            checkpoint_dir = checkpoint_path
+            checkpoint_path = tf.train.latest_checkpoint(checkpoint_dir)
+            if not checkpoint_path:
+                raise ValueError("No checkpoint file found in: %s" % checkpoint_dir)
+        reader = tf.train.NewCheckpointReader(checkpoint_path)
+
+        def read(name):
+            return reader.get_tensor(name) if reader.has_tensor(name) else None
+
+        self._load_decoder_weights(read)
+
+    def quantized(self):
+        """Whether some decoder weights are held as int8."""
+        return any(scales is not None for scales in (
+            self.lstm_kernel_scales, self.logits_weights_scales, self.embedding_scales))
+
+    def decoder_bytes(self):
+        """Returns the size of the decoder weights held in memory."""
+        weights = (self.lstm_kernel, self.lstm_bias, self.logits_weights, self.logits_biases,
+                   self.embedding_map, self.lstm_kernel_scales, self.logits_weights_scales,
+                   self.embedding_scales)
+        return sum(w.nbytes for w in weights if w is not None)
+
+    def _acquire_buffers(self, batch_size):
+        """Takes work arrays for batch_size rows from the pool."""
+        with self._lock:
+            buffers = self._free_buffers.pop() if self._free_buffers else None
+        if buffers is None or buffers.batch_size < batch_size:
+            buffers = _Buffers(batch_size,
+                               self.embedding_map.shape[1],
+                               self.lstm_bias.shape[0] // 4,
+                               self.quantized())
+        return buffers
+
+    def _release_buffers(self, buffers):
+        with self._lock:
+            self._free_buffers.append(buffers)
+
+    def inference_step(self, sess, input_feed, state_feed):
+        buffers = self._acquire_buffers(len(input_feed))
+        try:
+            return self._inference_step(buffers, input_feed, state_feed)
+        finally:
+            self._release_buffers(buffers)
+
+    def _inference_step(self, buffers, input_feed, state_feed):
+        batch_size = len(input_feed)
+        embedding_size = self.embedding_map.shape[1]
+        num_units = self.lstm_bias.shape[0] // 4
+        inputs = buffers.inputs[:batch_size]
+        gates = buffers.gates[:batch_size]
+        sums = buffers.sums[:batch_size]
+        state = np.empty([batch_size, 2 * num_units], np.float32)
+        softmax = np.empty([batch_size, self.logits_biases.shape[0]], np.float32)
+
+        # LSTM input: the embedded words next to the previous output h.
+        if self.embedding_scales is None:
+            np.take(self.embedding_map, input_feed, axis=0, out=inputs[:, :embedding_size])
+        else:
+            np.multiply(self.embedding_map[input_feed],
+                        self.embedding_scales[input_feed][:, np.newaxis],
+                        out=inputs[:, :embedding_size])
+        inputs[:, embedding_size:] = state_feed[:, num_units:]
+
+        _matmul(inputs, self.lstm_kernel, self.lstm_kernel_scales, buffers.tile, gates)
+        gates += self.lstm_bias
+        i = gates[:, :num_units]
+        j = gates[:, num_units:2 * num_units]
+        f = gates[:, 2 * num_units:3 * num_units]
+        o = gates[:, 3 * num_units:]
+        f += _FORGET_BIAS
+        _sigmoid(i)
+        _sigmoid(f)
+        _sigmoid(o)
+        np.tanh(j, out=j)
+
+        # new_c = c * sigmoid(f) + sigmoid(i) * tanh(j); new_h = tanh(new_c) * sigmoid(o)
+        c = state[:, :num_units]
+        h = state[:, num_units:]
+        np.multiply(state_feed[:, :num_units], f, out=c)
+        j *= i
+        c += j
+        np.tanh(c, out=h)
+        h *= o
+
+        _matmul(h, self.logits_weights, self.logits_weights_scales, buffers.tile, softmax)
+        softmax += self.logits_biases
+        np.max(softmax, axis=1, keepdims=True, out=sums)
+        softmax -= sums
+        np.exp(softmax, out=softmax)
+        np.sum(softmax, axis=1, keepdims=True, out=sums)
+        softmax /= sums
+        return softmax, state, None
+
+
+class RemoteEncoderWrapper(NumpyDecoderWrapper):
+    """Decoder stage model: images are encoded by remote encoder stages through
+    an encoder_stage.EncoderClient and the decoder steps run in NumPy. No TensorFlow session
+    is needed; the sess arguments are ignored."""
+
+    def __init__(self, encoder_client):
+        super(RemoteEncoderWrapper, self).__init__()
+        self.encoder_client = encoder_client
+
+    def feed_image(self, sess, encoded_image):
+        return self.encoder_client.encode([encoded_image])
+
+    def feed_images(self, sess, encoded_images):
+        return self.encoder_client.encode(encoded_images)
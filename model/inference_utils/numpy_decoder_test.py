@@ -0,0 +1,143 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-13 上午11:30
+
+# @Author  : Swing
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+if tf is not None:
+    from model.inference_utils import numpy_decoder
+    from model.inference_utils import quantization
+
+_VOCAB_SIZE = 7
+_EMBEDDING_SIZE = 3
+_NUM_UNITS = 4
+
+
+@unittest.skipIf(tf is None, "TensorFlow is not installed")
+class NumpyDecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.checkpoint_dir = tempfile.mkdtemp()
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.set_random_seed(0)
+            self.input_feed = tf.placeholder(tf.int64, [None], name="input_feed")
+            self.state_feed = tf.placeholder(tf.float32, [None, 2 * _NUM_UNITS],
+                                             name="state_feed")
+            with tf.variable_scope("seq_embedding"):
+                embedding_map = tf.get_variable("map", [_VOCAB_SIZE, _EMBEDDING_SIZE])
+            embeddings = tf.nn.embedding_lookup(embedding_map, self.input_feed)
+
+            cell = tf.nn.rnn_cell.BasicLSTMCell(_NUM_UNITS, state_is_tuple=True)
+            with tf.variable_scope("lstm"):
+                c, h = tf.split(self.state_feed, 2, axis=1)
+                outputs, state = cell(embeddings, tf.nn.rnn_cell.LSTMStateTuple(c, h))
+            self.state = tf.concat(state, axis=1)
+
+            with tf.variable_scope("logits"):
+                weights = tf.get_variable("weights", [_NUM_UNITS, _VOCAB_SIZE])
+                biases = tf.get_variable("biases", [_VOCAB_SIZE],
+                                         initializer=tf.random_normal_initializer())
+            self.softmax = tf.nn.softmax(tf.matmul(outputs, weights) + biases)
+
+            # The LSTM bias is initialized to zeros; a random one also checks the
+            # forget bias offset.
+            lstm_bias = [v for v in tf.global_variables()
+                         if v.op.name == "lstm/basic_lstm_cell/bias"][0]
+            randomize_bias = tf.assign(lstm_bias, tf.random_normal([4 * _NUM_UNITS]))
+            self.sess = tf.Session(graph=self.graph)
+            self.sess.run(tf.global_variables_initializer())
+            self.sess.run(randomize_bias)
+            tf.train.Saver().save(self.sess, os.path.join(self.checkpoint_dir, "model.ckpt"))
+
+    def tearDown(self):
+        self.sess.close()
+        shutil.rmtree(self.checkpoint_dir)
+
+    def _decoder(self):
+        decoder = numpy_decoder.NumpyDecoderWrapper()
+        decoder.load_decoder_weights_from_checkpoint(self.checkpoint_dir)
+        return decoder
+
+    def testStepMatchesTheTensorFlowCell(self):
+        decoder = self._decoder()
+        random = np.random.RandomState(0)
+        for batch_size in (3, 5, 2):
+            input_feed = random.randint(0, _VOCAB_SIZE, batch_size)
+            state_feed = random.randn(batch_size, 2 * _NUM_UNITS).astype(np.float32)
+            softmax, state = self.sess.run(
+                [self.softmax, self.state],
+                feed_dict={self.input_feed: input_feed, self.state_feed: state_feed})
+            np_softmax, np_state, _ = decoder.inference_step(None, input_feed, state_feed)
+            np.testing.assert_allclose(softmax, np_softmax, rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(state, np_state, rtol=1e-5, atol=1e-6)
+
+    def testResultsAreNotOverwrittenByLaterSteps(self):
+        decoder = self._decoder()
+        state_feed = np.zeros([2, 2 * _NUM_UNITS], np.float32)
+        softmax, state, _ = decoder.inference_step(None, np.array([1, 2]), state_feed)
+        expected = softmax.copy(), state.copy()
+        decoder.inference_step(None, np.array([3, 4]), state_feed)
+        np.testing.assert_array_equal(expected[0], softmax)
+        np.testing.assert_array_equal(expected[1], state)
+
+    def testQuantizedWeightsStayInt8(self):
+        reader = tf.train.NewCheckpointReader(tf.train.latest_checkpoint(self.checkpoint_dir))
+        stored, dequantized = {}, {}
+        for name in numpy_decoder.DECODER_WEIGHTS:
+            value = reader.get_tensor(name)
+            axis = quantization.QUANTIZED_VARIABLES.get(name)
+            if axis is None:
+                stored[name] = value
+            else:
+                quantized, scales = quantization.quantize_per_channel(value, axis)
+                stored[name + quantization.QUANTIZED_SUFFIX] = quantized
+                stored[name + quantization.SCALE_SUFFIX] = scales
+                value = quantization.dequantize_per_channel(quantized, scales, axis)
+            dequantized[name] = value
+        int8_decoder = numpy_decoder.NumpyDecoderWrapper()
+        int8_decoder._load_decoder_weights(stored.get)
+        float_decoder = numpy_decoder.NumpyDecoderWrapper()
+        float_decoder._load_decoder_weights(dequantized.get)
+        self.assertEqual(np.int8, int8_decoder.lstm_kernel.dtype)
+        self.assertEqual(np.int8, int8_decoder.embedding_map.dtype)
+        self.assertLess(int8_decoder.decoder_bytes(), float_decoder.decoder_bytes())
+
+        random = np.random.RandomState(0)
+        # Several tiles per weight matrix.
+        with mock.patch.object(numpy_decoder, "_TILE_COLUMNS", 3):
+            for batch_size in (3, 5):
+                input_feed = random.randint(0, _VOCAB_SIZE, batch_size)
+                state_feed = random.randn(batch_size, 2 * _NUM_UNITS).astype(np.float32)
+                softmax, state, _ = int8_decoder.inference_step(None, input_feed, state_feed)
+                expected_softmax, expected_state, _ = float_decoder.inference_step(
+                    None, input_feed, state_feed)
+                np.testing.assert_allclose(expected_softmax, softmax, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(expected_state, state, rtol=1e-5, atol=1e-6)
+
+    def testMissingCheckpointNamesTheDirectory(self):
+        empty_dir = tempfile.mkdtemp()
+        try:
+            with self.assertRaisesRegex(ValueError, "found in: %s" % empty_dir):
+                numpy_decoder.NumpyDecoderWrapper().load_decoder_weights_from_checkpoint(
+                    empty_dir)
+        finally:
+            shutil.rmtree(empty_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-3 下午8:40
+
+# @Author  : Swing
+
+
+import numpy as np
+
+# Decoder variables stored as int8 by quantize_decoder.py, mapped to the axis that
+# indexes their channels: output units for the matmul weights and words for the
+# embedding map.
+QUANTIZED_VARIABLES = {
+    "lstm/basic_lstm_cell/kernel": 1,
+    "logits/weights": 1,
+    "seq_embedding/map": 0,
+}
+
+# Suffixes of the int8 values and float32 scales replacing a quantized variable.
+QUANTIZED_SUFFIX = "_quantized"
+SCALE_SUFFIX = "_scale"
+
+# Op of a quantized inference graph that dequantizes the int8 weights into the
+# float variables read by the decoder. It is run once, after restoring.
+DEQUANTIZE_OP = "dequantize_weights"
+
+
+def quantize_per_channel(weights, axis):
+    """Symmetrically quantizes weights to int8 with one scale per channel.
+    Args:
+      weights: A float numpy array of rank 2.
+      axis: The axis indexing the channels.
+    Returns:
+      quantized: An int8 array shaped like `weights`.
+      scales: A float32 array with one scale per channel, such that
+        weights ~= quantized * scales along `axis`.
+    """
+    reduce_axis = 1 - axis
+    max_abs = np.max(np.abs(weights), axis=reduce_axis)
+    scales = (max_abs / 127.0).astype(np.float32)
+    scales[scales == 0] = 1.0
+    quantized = np.round(weights / np.expand_dims(scales, reduce_axis))
+    return np.clip(quantized, -127, 127).astype(np.int8), scales
+
+
+def dequantize_per_channel(quantized, scales, axis):
+    """Inverse of quantize_per_channel."""
+    return quantized.astype(np.float32) * np.expand_dims(scales, 1 - axis)
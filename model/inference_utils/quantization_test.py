@@ -0,0 +1,48 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-13 上午10:20
+
+# @Author  : Swing
+
+
+import unittest
+
+import numpy as np
+
+from model.inference_utils import quantization
+
+
+class QuantizationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.weights = np.random.RandomState(0).randn(6, 4).astype(np.float32)
+
+    def testRoundTripIsWithinHalfAStep(self):
+        for axis in (0, 1):
+            quantized, scales = quantization.quantize_per_channel(self.weights, axis)
+            self.assertEqual(np.int8, quantized.dtype)
+            self.assertEqual(np.float32, scales.dtype)
+            self.assertEqual((self.weights.shape[axis],), scales.shape)
+
+            restored = quantization.dequantize_per_channel(quantized, scales, axis)
+            self.assertEqual(self.weights.shape, restored.shape)
+            error = np.abs(restored - self.weights)
+            self.assertTrue(np.all(error <= np.expand_dims(scales, 1 - axis) / 2 + 1e-6))
+
+    def testLargestWeightOfEachChannelIsExact(self):
+        quantized, scales = quantization.quantize_per_channel(self.weights, 1)
+        self.assertEqual([127] * 4, np.max(np.abs(quantized), axis=0).tolist())
+        np.testing.assert_allclose(np.max(np.abs(self.weights), axis=0), scales * 127,
+                                   rtol=1e-6)
+
+    def testZeroChannelsStayZero(self):
+        self.weights[2] = 0.0
+        quantized, scales = quantization.quantize_per_channel(self.weights, 0)
+        self.assertEqual(1.0, scales[2])
+        self.assertEqual([0] * 4, quantized[2].tolist())
+        restored = quantization.dequantize_per_channel(quantized, scales, 0)
+        self.assertEqual([0.0] * 4, restored[2].tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,7 +15,8 @@ class Vocabulary(object):
                  vocab_file,
                  start_word="<S>",
                  end_word="</S>",
-                 unk_word="<UNK>"):
+                 unk_word="<UNK>",
+                 vocab_lines=None):
         """Initializes the vocabulary.
         Args:
           vocab_file: File containing the vocabulary, where the words are the first
@@ -24,13 +25,18 @@ class Vocabulary(object):
           start_word: Special word denoting sentence start.
           end_word: Special word denoting sentence end.
           unk_word: Special word denoting unknown words.
+          vocab_lines: Optional lines of a vocabulary file, used instead of reading
+            vocab_file (for example the vocabulary stored in an exported graph).
         """
-        if not tf.gfile.Exists(vocab_file):
-            tf.logging.fatal("Vocab file %s not found.", vocab_file)
-        tf.logging.info("Initializing vocabulary from file: %s", vocab_file)
+        if vocab_lines is not None:
+            reverse_vocab = list(vocab_lines)
+        else:
+            if not tf.gfile.Exists(vocab_file):
+                tf.logging.fatal("Vocab file %s not found.", vocab_file)
+            tf.logging.info("Initializing vocabulary from file: %s", vocab_file)
 
-        with tf.gfile.GFile(vocab_file, mode="r") as f:
-            reverse_vocab = list(f.readlines())
+            with tf.gfile.GFile(vocab_file, mode="r") as f:
+                reverse_vocab = list(f.readlines())
         reverse_vocab = [line.split()[0] for line in reverse_vocab]
         assert start_word in reverse_vocab
         assert end_word in reverse_vocab
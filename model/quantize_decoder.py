@@ -0,0 +1,137 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-3 下午9:05
+
+# @Author  : Swing
+
+
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from model import configuration
+from model.inference_interface import Captioner
+from model.inference_utils import quantization
+
+FLAGS = tf.flags.FLAGS
+
+# --checkpoint_path, --vocab_file and --input_files are defined by
+# inference_interface. Images matching --input_files are captioned by the float
+# and quantized models for the accuracy report; it is skipped if none are given.
+tf.flags.DEFINE_string("output_dir", "",
+                       "Directory to write the quantized checkpoint to.")
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+
+def quantize_checkpoint(checkpoint_path, output_dir):
+    """Writes a copy of a checkpoint whose decoder weights are stored as int8.
+    Each variable of quantization.QUANTIZED_VARIABLES is replaced by an int8
+    `<name>_quantized` variable and a float32 `<name>_scale` variable with one
+    scale per channel; all other variables are copied unchanged. The result is
+    read by models built with ModelConfig.quantize_decoder_weights. Their
+    sessions hold both the int8 and the dequantized float32 decoder weights, so
+    the quantized checkpoint is smaller but the session is not; the NumPy decoder
+    holds the weights as int8 only.
+    Args:
+      checkpoint_path: Model checkpoint file or directory containing a model
+        checkpoint file.
+      output_dir: Directory to write the quantized checkpoint to.
+    Returns:
+      The path of the written checkpoint.
+    Raises:
+      ValueError: If no checkpoint is found.
+    """
+    if tf.gfile.IsDirectory(checkpoint_path):
+        checkpoint_dir = checkpoint_path
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_dir)
+        if not checkpoint_path:
+            raise ValueError("No checkpoint file found in: %s" % checkpoint_dir)
+
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    g = tf.Graph()
+    with g.as_default():
+        for name in sorted(reader.get_variable_to_shape_map()):
+            value = reader.get_tensor(name)
+            axis = quantization.QUANTIZED_VARIABLES.get(name)
+            if axis is None:
+                tf.Variable(value, name=name)
+                continue
+
+            quantized, scales = quantization.quantize_per_channel(value, axis)
+            error = np.abs(quantization.dequantize_per_channel(quantized, scales, axis) - value)
+            tf.logging.info("Quantized %s %s: max abs error %g, mean abs error %g",
+                            name, value.shape, error.max(), error.mean())
+            tf.Variable(quantized, name=name + quantization.QUANTIZED_SUFFIX)
+            tf.Variable(scales, name=name + quantization.SCALE_SUFFIX)
+        saver = tf.train.Saver()
+
+    if not tf.gfile.IsDirectory(output_dir):
+        tf.gfile.MakeDirs(output_dir)
+    with tf.Session(graph=g) as sess:
+        sess.run(tf.variables_initializer(g.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)))
+        output_path = saver.save(sess, os.path.join(output_dir, "model.ckpt"),
+                                 global_step=reader.get_tensor("global_step"))
+    tf.logging.info("Wrote quantized checkpoint: %s", output_path)
+    return output_path
+
+
+def accuracy_report(checkpoint_path, quantized_checkpoint_path, vocab_file, filenames):
+    """Compares the top-1 captions of the float and quantized models.
+    Returns:
+      A dict with the number of images, the fraction whose top-1 captions are
+      identical and the mean and max absolute difference of the top-1 caption
+      log-probabilities.
+    """
+    quantized_config = configuration.ModelConfig()
+    quantized_config.quantize_decoder_weights = True
+    float_captioner = Captioner(checkpoint_path, vocab_file)
+    quantized_captioner = Captioner(quantized_checkpoint_path, vocab_file,
+                                    model_config=quantized_config)
+
+    matches = 0
+    logprob_diffs = []
+    for filename in filenames:
+        with tf.gfile.GFile(filename, "rb") as f:
+            image = f.read()
+        float_best = float_captioner.generator.beam_search(float_captioner.sess, image)[0]
+        quantized_best = quantized_captioner.generator.beam_search(
+            quantized_captioner.sess, image)[0]
+        if float_best.sentence == quantized_best.sentence:
+            matches += 1
+        logprob_diffs.append(abs(float_best.logprob - quantized_best.logprob))
+        tf.logging.info("%s\n  float:     %s\n  quantized: %s", os.path.basename(filename),
+                        float_captioner.format_captions([float_best])[0],
+                        quantized_captioner.format_captions([quantized_best])[0])
+
+    float_captioner.close()
+    quantized_captioner.close()
+    return {"images": len(filenames),
+            "top1_agreement": float(matches) / len(filenames),
+            "mean_abs_logprob_diff": float(np.mean(logprob_diffs)),
+            "max_abs_logprob_diff": float(np.max(logprob_diffs))}
+
+
+def main(unused_argv):
+    assert FLAGS.checkpoint_path, "--checkpoint_path is required"
+    assert FLAGS.output_dir, "--output_dir is required"
+
+    quantized_checkpoint_path = quantize_checkpoint(FLAGS.checkpoint_path, FLAGS.output_dir)
+
+    if FLAGS.input_files:
+        assert FLAGS.vocab_file, "--vocab_file is required for the accuracy report"
+        filenames = []
+        for file_pattern in FLAGS.input_files.split(","):
+            filenames.extend(tf.gfile.Glob(file_pattern))
+        assert filenames, "No files found matching --input_files"
+        report = accuracy_report(FLAGS.checkpoint_path, quantized_checkpoint_path,
+                                 FLAGS.vocab_file, filenames)
+        tf.logging.info("Accuracy report: %d images, top-1 caption agreement %.3f, "
+                        "top-1 log-probability difference mean %.4f max %.4f",
+                        report["images"], report["top1_agreement"],
+                        report["mean_abs_logprob_diff"], report["max_abs_logprob_diff"])
+
+
+if __name__ == "__main__":
+    tf.app.run()
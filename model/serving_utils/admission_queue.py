@@ -0,0 +1,173 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-3-16 下午3:40
+
+# @Author  : Swing
+
+
+import queue
+import threading
+import time
+from concurrent import futures
+
+
+class QueueFullError(Exception):
+    """Raised when a request is rejected because the admission queue is full."""
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a request's deadline passes before it has been served."""
+
+
+class AdmissionQueue(object):
+    """Bounded queue of requests in front of the model workers.
+
+    Requests are admitted only while fewer than `max_queue_size` are waiting;
+    otherwise submit() fails immediately with QueueFullError so callers can shed
+    load. Each request carries a deadline and is dropped with
+    DeadlineExceededError if a worker only reaches it after that deadline. The
+    deadline is also passed to the handler, which should finish its work by then:
+    call() gives up on a request at its deadline, but cannot stop a handler that
+    is already running.
+    """
+
+    def __init__(self, handler, num_workers=1, max_queue_size=64,
+                 default_timeout_secs=10.0):
+        """Starts the worker threads.
+        Args:
+          handler: Function called by a worker as handler(item, deadline), where
+            deadline is the request's time.time() deadline; its return value is
+            the request result.
+          num_workers: Number of worker threads calling `handler` concurrently.
+          max_queue_size: Maximum number of requests waiting for a worker.
+          default_timeout_secs: Deadline of a request, counted from submission,
+            when submit() is not given one.
+        """
+        assert num_workers > 0
+        assert max_queue_size > 0
+        self.handler = handler
+        self.max_queue_size = max_queue_size
+        self.default_timeout_secs = default_timeout_secs
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.served = 0
+        self.failed = 0
+        self.dequeued = 0
+        self.max_depth = 0
+        self.total_wait_secs = 0.0
+        self.max_wait_secs = 0.0
+
+        self._threads = []
+        for i in range(num_workers):
+            thread = threading.Thread(target=self._run, name="AdmissionQueue-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, item, timeout_secs=None):
+        """Admits a request.
+        Args:
+          item: First argument passed to the handler.
+          timeout_secs: Optional deadline of the request, counted from now.
+        Returns:
+          A concurrent.futures.Future resolving to the handler result.
+        Raises:
+          QueueFullError: If the queue is full.
+        """
+        if timeout_secs is None:
+            timeout_secs = self.default_timeout_secs
+        future = futures.Future()
+        now = time.time()
+        try:
+            self._queue.put_nowait((item, future, now, now + timeout_secs))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFullError("Admission queue is full (%d requests)" %
+                                 self.max_queue_size)
+        with self._lock:
+            self.admitted += 1
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+        return future
+
+    def call(self, item, timeout_secs=None):
+        """Runs a request and blocks until its result is ready.
+        Raises:
+          QueueFullError: If the queue is full.
+          DeadlineExceededError: If the request is not served before its deadline.
+        """
+        if timeout_secs is None:
+            timeout_secs = self.default_timeout_secs
+        future = self.submit(item, timeout_secs)
+        try:
+            return future.result(timeout_secs)
+        except futures.TimeoutError:
+            if future.cancel():
+                with self._lock:
+                    self.expired += 1
+            raise DeadlineExceededError("Request not served within %.3f s" % timeout_secs)
+
+    def close(self):
+        """Finishes the admitted requests and stops the worker threads."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        """Returns a dict with the queue depth, admission and wait-time metrics.
+        `admitted` and `rejected` count submit() calls. `expired` counts requests
+        whose deadline passed before a worker dequeued them. `served` and `failed`
+        count dequeued requests when their handler returns or raises, so a request
+        that call() gave up on at its deadline is still counted once its handler
+        finishes. The wait times are over the dequeued requests.
+        """
+        with self._lock:
+            return {"queue_depth": self._queue.qsize(),
+                    "max_queue_depth": self.max_depth,
+                    "max_queue_size": self.max_queue_size,
+                    "admitted": self.admitted,
+                    "rejected": self.rejected,
+                    "expired": self.expired,
+                    "served": self.served,
+                    "failed": self.failed,
+                    "mean_wait_secs": (self.total_wait_secs / self.dequeued
+                                       if self.dequeued else 0.0),
+                    "max_wait_secs": self.max_wait_secs}
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            item, future, submitted_at, deadline = request
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            now = time.time()
+            wait_secs = now - submitted_at
+            with self._lock:
+                self.dequeued += 1
+                self.total_wait_secs += wait_secs
+                self.max_wait_secs = max(self.max_wait_secs, wait_secs)
+                if now > deadline:
+                    self.expired += 1
+            if now > deadline:
+                future.set_exception(DeadlineExceededError(
+                    "Request waited %.3f s in the admission queue" % wait_secs))
+                continue
+
+            try:
+                result = self.handler(item, deadline)
+            except Exception as err:  # pylint: disable=broad-except
+                with self._lock:
+                    self.failed += 1
+                future.set_exception(err)
+            else:
+                with self._lock:
+                    self.served += 1
+                future.set_result(result)
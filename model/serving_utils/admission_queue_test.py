@@ -0,0 +1,109 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-12 下午2:10
+
+# @Author  : Swing
+
+
+import threading
+import time
+import unittest
+
+from model.serving_utils import admission_queue
+
+
+class BlockingHandler(object):
+    """Handler that blocks until released and records the deadlines it got."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.deadlines = []
+
+    def __call__(self, item, deadline):
+        self.deadlines.append(deadline)
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(item, Exception):
+            raise item
+        return item * 2
+
+
+class AdmissionQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = BlockingHandler()
+
+    def tearDown(self):
+        self.handler.release.set()
+
+    def testCallReturnsHandlerResult(self):
+        self.handler.release.set()
+        queue = admission_queue.AdmissionQueue(self.handler)
+        self.assertEqual(42, queue.call(21))
+        queue.close()
+        stats = queue.stats()
+        self.assertEqual(1, stats["admitted"])
+        self.assertEqual(1, stats["served"])
+
+    def testHandlerGetsRequestDeadline(self):
+        self.handler.release.set()
+        queue = admission_queue.AdmissionQueue(self.handler)
+        before = time.time()
+        queue.call(1, timeout_secs=30)
+        queue.close()
+        self.assertGreaterEqual(self.handler.deadlines[0], before + 30)
+        self.assertLessEqual(self.handler.deadlines[0], time.time() + 30)
+
+    def testRejectsWhenFull(self):
+        queue = admission_queue.AdmissionQueue(self.handler, max_queue_size=1)
+        running = queue.submit(1)
+        self.assertTrue(self.handler.started.wait(5))
+        waiting = queue.submit(2)
+        with self.assertRaises(admission_queue.QueueFullError):
+            queue.submit(3)
+        self.handler.release.set()
+        self.assertEqual([2, 4], [running.result(5), waiting.result(5)])
+        queue.close()
+        stats = queue.stats()
+        self.assertEqual(2, stats["admitted"])
+        self.assertEqual(1, stats["rejected"])
+
+    def testExpiresRequestsDequeuedAfterTheirDeadline(self):
+        queue = admission_queue.AdmissionQueue(self.handler)
+        queue.submit(1)
+        self.assertTrue(self.handler.started.wait(5))
+        late = queue.submit(2, timeout_secs=0.01)
+        time.sleep(0.05)
+        self.handler.release.set()
+        with self.assertRaises(admission_queue.DeadlineExceededError):
+            late.result(5)
+        queue.close()
+        self.assertEqual(1, queue.stats()["expired"])
+        self.assertEqual([1], [len(self.handler.deadlines)])
+
+    def testServedIsCountedWhenTheHandlerReturns(self):
+        queue = admission_queue.AdmissionQueue(self.handler)
+        with self.assertRaises(admission_queue.DeadlineExceededError):
+            queue.call(1, timeout_secs=0.05)
+        # The handler is still running, so the request is not counted yet.
+        self.assertEqual(0, queue.stats()["served"])
+        self.handler.release.set()
+        queue.close()
+        stats = queue.stats()
+        self.assertEqual(1, stats["served"])
+        self.assertEqual(0, stats["expired"])
+
+    def testHandlerErrorsAreCountedAsFailed(self):
+        self.handler.release.set()
+        queue = admission_queue.AdmissionQueue(self.handler)
+        with self.assertRaises(ValueError):
+            queue.call(ValueError("bad image"))
+        queue.close()
+        stats = queue.stats()
+        self.assertEqual(0, stats["served"])
+        self.assertEqual(1, stats["failed"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-3-12 下午9:20
+
+# @Author  : Swing
+
+
+import queue
+import threading
+import time
+from concurrent import futures
+
+
+class BatchScheduler(object):
+    """Runs concurrent caption requests as shared batched session calls.
+
+    Requests are collected for at most `batch_timeout_secs` after the first one
+    arrives, or until `max_batch_size` requests are waiting, and each batch is
+    captioned with CaptionGenerator.beam_search_batch. Requests of a batch with
+    different beam settings are decoded in separate beam_search_batch calls.
+    """
+
+    def __init__(self, generator, sess, max_batch_size=8, batch_timeout_secs=0.005):
+        """Starts the scheduler thread.
+        Args:
+          generator: A CaptionGenerator; its model and beam parameters are used.
+          sess: TensorFlow Session object.
+          max_batch_size: Maximum number of images decoded together.
+          batch_timeout_secs: How long to wait for more requests after the first
+            one of a batch arrives.
+        """
+        assert max_batch_size > 0
+        self.generator = generator
+        self.sess = sess
+        self.max_batch_size = max_batch_size
+        self.batch_timeout_secs = batch_timeout_secs
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="BatchScheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, encoded_image, beam_size=None, max_caption_length=None,
+               deadline=None):
+        """Queues an encoded image for captioning.
+        Args:
+          encoded_image: An encoded image string.
+          beam_size: Optional beam size, as in CaptionGenerator.beam_search.
+          max_caption_length: Optional maximum caption length.
+          deadline: Optional time.time() value; a batch stops at the earliest
+            deadline of its requests.
+        Returns:
+          A concurrent.futures.Future resolving to a list of Caption sorted by
+          descending score.
+        """
+        future = futures.Future()
+        self._queue.put((encoded_image, future, (beam_size, max_caption_length), deadline))
+        return future
+
+    def caption(self, encoded_image, timeout=None, **kwargs):
+        """Captions an encoded image, blocking until its batch has been decoded.
+        Keyword arguments are passed to submit()."""
+        return self.submit(encoded_image, **kwargs).result(timeout)
+
+    def close(self):
+        """Finishes the queued requests and stops the scheduler thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            self._closed = True
+            return []
+
+        batch = [item]
+        deadline = time.time() + self.batch_timeout_secs
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._closed = True
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while not self._closed:
+            batch = self._next_batch()
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+
+            # Requests with the same beam settings share a beam_search_batch call.
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[2], []).append(item)
+            for (beam_size, max_caption_length), group in groups.items():
+                deadlines = [deadline for _, _, _, deadline in group if deadline is not None]
+                try:
+                    results = self.generator.beam_search_batch(
+                        self.sess, [image for image, _, _, _ in group],
+                        beam_size=beam_size,
+                        max_caption_length=max_caption_length,
+                        deadline=min(deadlines) if deadlines else None)
+                except Exception as err:  # pylint: disable=broad-except
+                    for _, future, _, _ in group:
+                        future.set_exception(err)
+                else:
+                    for (_, future, _, _), captions in zip(group, results):
+                        future.set_result(captions)
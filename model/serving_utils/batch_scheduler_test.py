@@ -0,0 +1,98 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-12 上午10:05
+
+# @Author  : Swing
+
+
+import threading
+import unittest
+
+from model.serving_utils import batch_scheduler
+
+
+class FakeGenerator(object):
+    """Records beam_search_batch calls and captions each image with itself."""
+
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+        self._lock = threading.Lock()
+
+    def beam_search_batch(self, sess, encoded_images, beam_size=None,
+                          max_caption_length=None, deadline=None):
+        with self._lock:
+            self.calls.append((list(encoded_images), beam_size, max_caption_length, deadline))
+        if self.error is not None:
+            raise self.error
+        return [[image] for image in encoded_images]
+
+
+class BatchSchedulerTest(unittest.TestCase):
+
+    def _submit_all(self, scheduler, requests):
+        return [scheduler.submit(image, **kwargs) for image, kwargs in requests]
+
+    def testConcurrentRequestsShareABatch(self):
+        generator = FakeGenerator()
+        scheduler = batch_scheduler.BatchScheduler(generator, None, max_batch_size=3,
+                                                   batch_timeout_secs=5.0)
+        pending = self._submit_all(scheduler, [(b"a", {}), (b"b", {}), (b"c", {})])
+        self.assertEqual([[b"a"], [b"b"], [b"c"]], [f.result(5) for f in pending])
+        scheduler.close()
+        self.assertEqual(1, len(generator.calls))
+        self.assertEqual([b"a", b"b", b"c"], generator.calls[0][0])
+
+    def testBatchesAreLimitedToMaxBatchSize(self):
+        generator = FakeGenerator()
+        scheduler = batch_scheduler.BatchScheduler(generator, None, max_batch_size=2,
+                                                   batch_timeout_secs=5.0)
+        pending = self._submit_all(scheduler, [(b"a", {}), (b"b", {}), (b"c", {}), (b"d", {})])
+        for future in pending:
+            future.result(5)
+        scheduler.close()
+        self.assertEqual([2, 2], [len(call[0]) for call in generator.calls])
+
+    def testRequestsAreGroupedBySettings(self):
+        generator = FakeGenerator()
+        scheduler = batch_scheduler.BatchScheduler(generator, None, max_batch_size=4,
+                                                   batch_timeout_secs=5.0)
+        pending = self._submit_all(scheduler, [
+            (b"a", {"beam_size": 1}), (b"b", {"beam_size": 3}),
+            (b"c", {"beam_size": 1}), (b"d", {"beam_size": 3})])
+        self.assertEqual([[b"a"], [b"b"], [b"c"], [b"d"]], [f.result(5) for f in pending])
+        scheduler.close()
+        calls = sorted((call[1], call[0]) for call in generator.calls)
+        self.assertEqual([(1, [b"a", b"c"]), (3, [b"b", b"d"])], calls)
+
+    def testBatchUsesEarliestDeadline(self):
+        generator = FakeGenerator()
+        scheduler = batch_scheduler.BatchScheduler(generator, None, max_batch_size=3,
+                                                   batch_timeout_secs=5.0)
+        pending = self._submit_all(scheduler, [
+            (b"a", {"deadline": 30.0}), (b"b", {}), (b"c", {"deadline": 20.0})])
+        for future in pending:
+            future.result(5)
+        scheduler.close()
+        self.assertEqual(20.0, generator.calls[0][3])
+
+    def testErrorFailsEveryRequestOfTheBatch(self):
+        error = ValueError("broken batch")
+        scheduler = batch_scheduler.BatchScheduler(FakeGenerator(error), None,
+                                                   max_batch_size=2, batch_timeout_secs=5.0)
+        pending = self._submit_all(scheduler, [(b"a", {}), (b"b", {})])
+        for future in pending:
+            self.assertIs(error, future.exception(5))
+        scheduler.close()
+
+    def testCloseFinishesQueuedRequests(self):
+        generator = FakeGenerator()
+        scheduler = batch_scheduler.BatchScheduler(generator, None, max_batch_size=8,
+                                                   batch_timeout_secs=5.0)
+        future = scheduler.submit(b"a")
+        scheduler.close()
+        self.assertEqual([b"a"], future.result(0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-3-14 下午8:05
+
+# @Author  : Swing
+
+
+import collections
+import hashlib
+import threading
+import time
+
+
+def image_digest(encoded_image):
+    """Returns the hex SHA-256 digest of an encoded image string."""
+    return hashlib.sha256(encoded_image).hexdigest()
+
+
+class CaptionCache(object):
+    """Thread-safe LRU cache of caption results with an optional TTL.
+
+    Entries are keyed by the digest of the encoded image bytes together with a
+    model key identifying the checkpoint and beam parameters that produced them,
+    so results of different models never mix.
+    """
+
+    def __init__(self, max_entries=10000, ttl_secs=None):
+        """Initializes an empty cache.
+        Args:
+          max_entries: Maximum number of cached results; the least recently used
+            entry is evicted when the cache is full.
+          ttl_secs: If not None, entries older than this many seconds are treated
+            as missing.
+        """
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.ttl_secs = ttl_secs
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, encoded_image, model_key):
+        """Returns the cache key of an encoded image for a model key."""
+        return (image_digest(encoded_image), model_key)
+
+    def get(self, key):
+        """Returns the cached value for `key`, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if self.ttl_secs is not None and time.time() - stored_at > self.ttl_secs:
+                    del self._entries[key]
+                    self.evictions += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """Stores `value` under `key`, evicting the least recently used entry if
+        the cache is full."""
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Removes all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """Returns a dict with the size and hit/miss/eviction counters."""
+        with self._lock:
+            return {"size": len(self._entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+def model_key(checkpoint_path, vocab_file, beam_size, max_caption_length,
+              length_normalization_factor, in_graph_beam=None):
+    """Returns the key identifying the results of a model with its default beam
+    settings.
+    Args:
+      checkpoint_path: The checkpoint or graph file the model was restored from.
+      vocab_file: The vocabulary file.
+      beam_size: Default beam size of the model's CaptionGenerator.
+      max_caption_length: Default maximum caption length of the generator.
+      length_normalization_factor: Length normalization factor of the generator.
+      in_graph_beam: If the model runs the in-graph beam search decoder, the
+        (beam_size, max_caption_length, length_normalization_factor) the graph
+        was built with; otherwise None.
+    """
+    return (checkpoint_path, vocab_file, beam_size, max_caption_length,
+            length_normalization_factor, in_graph_beam)
+
+
+def settings_key(key, beam_size=None, max_caption_length=None):
+    """Returns the model key of results produced with overridden beam settings.
+    The in-graph beam search decoder ignores overrides, so the key of such a
+    model is returned unchanged.
+    Args:
+      key: A model_key().
+      beam_size: Beam size used, or None for the model's default.
+      max_caption_length: Maximum caption length used, or None for the default.
+    """
+    checkpoint_path, vocab_file, default_beam_size, default_length, factor, in_graph_beam = key
+    if in_graph_beam is not None:
+        return key
+    return (checkpoint_path, vocab_file, beam_size or default_beam_size,
+            max_caption_length or default_length, factor, in_graph_beam)
@@ -0,0 +1,68 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-12 上午11:20
+
+# @Author  : Swing
+
+
+import unittest
+from unittest import mock
+
+from model.serving_utils import caption_cache
+
+
+class CaptionCacheTest(unittest.TestCase):
+
+    def testKeysSeparateImagesAndModels(self):
+        cache = caption_cache.CaptionCache()
+        self.assertEqual(cache.key(b"a", "m1"), cache.key(b"a", "m1"))
+        self.assertNotEqual(cache.key(b"a", "m1"), cache.key(b"b", "m1"))
+        self.assertNotEqual(cache.key(b"a", "m1"), cache.key(b"a", "m2"))
+
+    def testHitsAndMisses(self):
+        cache = caption_cache.CaptionCache()
+        key = cache.key(b"image", "model")
+        self.assertIsNone(cache.get(key))
+        cache.put(key, ["a caption"])
+        self.assertEqual(["a caption"], cache.get(key))
+        self.assertEqual({"size": 1, "hits": 1, "misses": 1, "evictions": 0}, cache.stats())
+
+    def testEvictsLeastRecentlyUsed(self):
+        cache = caption_cache.CaptionCache(max_entries=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.stats()["evictions"])
+
+    def testExpiredEntriesAreMissing(self):
+        cache = caption_cache.CaptionCache(ttl_secs=10)
+        with mock.patch.object(caption_cache.time, "time", return_value=100.0):
+            cache.put("a", 1)
+        with mock.patch.object(caption_cache.time, "time", return_value=105.0):
+            self.assertEqual(1, cache.get("a"))
+        with mock.patch.object(caption_cache.time, "time", return_value=111.0):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, len(cache))
+
+    def testSettingsKeyOverridesDefaults(self):
+        key = caption_cache.model_key("ckpt", "vocab", 3, 20, 0.0)
+        self.assertEqual(key, caption_cache.settings_key(key))
+        self.assertEqual(key, caption_cache.settings_key(key, 3, 20))
+        self.assertNotEqual(key, caption_cache.settings_key(key, beam_size=1))
+        self.assertNotEqual(key, caption_cache.settings_key(key, max_caption_length=10))
+
+    def testInGraphBeamSearchIgnoresOverrides(self):
+        key = caption_cache.model_key("ckpt", "vocab", 3, 20, 0.0, in_graph_beam=(3, 20, 0.0))
+        self.assertNotEqual(caption_cache.model_key("ckpt", "vocab", 3, 20, 0.0), key)
+        self.assertNotEqual(
+            caption_cache.model_key("ckpt", "vocab", 3, 20, 0.0, in_graph_beam=(2, 20, 0.0)), key)
+        self.assertEqual(key, caption_cache.settings_key(key, beam_size=1, max_caption_length=10))
+
+
+if __name__ == "__main__":
+    unittest.main()
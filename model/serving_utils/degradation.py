@@ -0,0 +1,44 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-3-22 下午4:10
+
+# @Author  : Swing
+
+
+class DegradationPolicy(object):
+    """Picks beam search settings from the current load of the service.
+
+    Each level is a (min_load, beam_size, max_caption_length) tuple, where load
+    is the fraction of the admission queue in use. The level with the highest
+    min_load not above the current load is used, so settings get cheaper as the
+    queue fills up, down to greedy decoding (beam_size 1).
+    """
+
+    DEFAULT_LEVELS = ((0.0, 3, 20),
+                      (0.5, 2, 16),
+                      (0.8, 1, 12))
+
+    def __init__(self, levels=DEFAULT_LEVELS):
+        """Initializes the policy.
+        Args:
+          levels: A sequence of (min_load, beam_size, max_caption_length) tuples;
+            the first level should have min_load 0 and the model's full settings.
+        """
+        assert levels
+        self.levels = sorted(levels)
+
+    def settings(self, queue_depth, max_queue_size):
+        """Returns the beam settings for the given admission queue state.
+        Returns:
+          A dict with keys beam_size, max_caption_length and degraded; degraded
+          is True unless the first level is used.
+        """
+        load = float(queue_depth) / max_queue_size if max_queue_size else 0.0
+        index = 0
+        for i, (min_load, _, _) in enumerate(self.levels):
+            if load >= min_load:
+                index = i
+        _, beam_size, max_caption_length = self.levels[index]
+        return {"beam_size": beam_size,
+                "max_caption_length": max_caption_length,
+                "degraded": index > 0}
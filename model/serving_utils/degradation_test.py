@@ -0,0 +1,42 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-12 下午5:00
+
+# @Author  : Swing
+
+
+import unittest
+
+from model.serving_utils import degradation
+
+
+class DegradationPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = degradation.DegradationPolicy()
+
+    def _settings(self, queue_depth, max_queue_size=100):
+        settings = self.policy.settings(queue_depth, max_queue_size)
+        return settings["beam_size"], settings["max_caption_length"], settings["degraded"]
+
+    def testIdleServiceUsesFullSettings(self):
+        self.assertEqual((3, 20, False), self._settings(0))
+        self.assertEqual((3, 20, False), self._settings(49))
+
+    def testSettingsGetCheaperAsTheQueueFills(self):
+        self.assertEqual((2, 16, True), self._settings(50))
+        self.assertEqual((2, 16, True), self._settings(79))
+        self.assertEqual((1, 12, True), self._settings(80))
+        self.assertEqual((1, 12, True), self._settings(100))
+
+    def testLevelsAreSortedByLoad(self):
+        policy = degradation.DegradationPolicy([(0.5, 1, 10), (0.0, 4, 30)])
+        self.assertEqual(4, policy.settings(1, 10)["beam_size"])
+        self.assertEqual(1, policy.settings(6, 10)["beam_size"])
+
+    def testUnboundedQueueIsIdle(self):
+        self.assertEqual((3, 20, False), self._settings(10, max_queue_size=0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-10 下午4:35
+
+# @Author  : Swing
+
+
+import socket
+import struct
+import threading
+from multiprocessing import connection
+
+import numpy as np
+
+# An encoder request is the number of images followed by each encoded image,
+# prefixed with its length.
+_LENGTH = struct.Struct("<I")
+
+# Header of an encoder response: status, rows, columns. A float32 buffer of
+# rows * columns initial states follows, or a utf-8 error message if status is
+# not _OK.
+_HEADER = struct.Struct("<BII")
+_OK = 0
+_ERROR = 1
+
+
+class EncoderError(Exception):
+    """Raised when an encoder stage fails to encode a batch of images."""
+    pass
+
+
+def parse_address(address):
+    """Turns "host:port" into a (host, port) tuple; other addresses, such as Unix
+    socket paths, are returned unchanged."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def pack_images(encoded_images):
+    """Serializes a list of encoded images into an encoder request."""
+    parts = [_LENGTH.pack(len(encoded_images))]
+    for image in encoded_images:
+        parts.append(_LENGTH.pack(len(image)))
+        parts.append(bytes(image))
+    return b"".join(parts)
+
+
+def unpack_images(request):
+    """Inverse of pack_images.
+    Raises:
+      ValueError: If the request is malformed.
+    """
+    request = memoryview(request)
+    try:
+        count, = _LENGTH.unpack_from(request)
+        offset = _LENGTH.size
+        encoded_images = []
+        for _ in range(count):
+            length, = _LENGTH.unpack_from(request, offset)
+            offset += _LENGTH.size
+            if offset + length > len(request):
+                raise ValueError("Malformed encoder request: image %d is truncated" %
+                                 len(encoded_images))
+            encoded_images.append(request[offset:offset + length].tobytes())
+            offset += length
+    except struct.error as err:
+        raise ValueError("Malformed encoder request: %s" % err)
+    if offset != len(request):
+        raise ValueError("Malformed encoder request: %d trailing bytes" %
+                         (len(request) - offset))
+    return encoded_images
+
+
+def pack_states(states):
+    """Serializes initial states into an encoder response."""
+    states = np.ascontiguousarray(states, dtype=np.float32)
+    return _HEADER.pack(_OK, states.shape[0], states.shape[1]) + states.tobytes()
+
+
+def pack_error(message):
+    """Serializes an error message into an encoder response."""
+    return _HEADER.pack(_ERROR, 0, 0) + message.encode("utf-8")
+
+
+def unpack_states(response):
+    """Inverse of pack_states.
+    Returns:
+      A float32 numpy array of shape [rows, columns].
+    Raises:
+      EncoderError: If the response holds an error.
+    """
+    status, rows, cols = _HEADER.unpack_from(response)
+    if status != _OK:
+        raise EncoderError(bytes(response[_HEADER.size:]).decode("utf-8"))
+    return np.frombuffer(response, dtype=np.float32, count=rows * cols,
+                         offset=_HEADER.size).reshape(rows, cols)
+
+
+class EncoderServer(object):
+    """Encoder stage: serves the initial LSTM states of images.
+
+    Each decoder connection sends a list of encoded images, framed by
+    pack_images, and receives their lstm/initial_state rows as one float32
+    buffer. Requests are plain bytes and are never unpickled. Connections are
+    served by their own threads, all running feed_images on the same session.
+    """
+
+    def __init__(self, captioner, address, authkey=None, max_request_bytes=64 << 20):
+        """Starts listening.
+        Args:
+          captioner: Captioner whose session encodes the images.
+          address: (host, port) tuple or Unix socket path to listen on.
+          authkey: Optional bytes shared with the clients.
+          max_request_bytes: Connections sending a larger request are closed.
+        """
+        self.captioner = captioner
+        self.max_request_bytes = max_request_bytes
+        self._listener = connection.Listener(address, authkey=authkey)
+        self.address = self._listener.address
+        self.requests = 0
+        self.rejected_connections = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def serve_forever(self):
+        """Accepts connections until close() is called."""
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, connection.AuthenticationError):
+                if self._closed.is_set():
+                    break
+                # Wrong authkey or a client that went away during the handshake.
+                with self._lock:
+                    self.rejected_connections += 1
+                continue
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv_bytes(self.max_request_bytes)
+                except (EOFError, OSError):
+                    # Closed by the client, or a request over max_request_bytes.
+                    break
+                try:
+                    states = self.captioner.model.feed_images(self.captioner.sess,
+                                                              unpack_images(request))
+                except Exception as err:  # pylint: disable=broad-except
+                    conn.send_bytes(pack_error(repr(err)))
+                    continue
+                with self._lock:
+                    self.requests += 1
+                conn.send_bytes(pack_states(states))
+
+    def close(self):
+        """Stops serve_forever; connections being served are not closed."""
+        self._closed.set()
+        # Closing a socket does not wake a thread blocked in accept() on Linux;
+        # shutting it down does.
+        listening_socket = getattr(self._listener._listener, "_socket", None)
+        if listening_socket is not None:
+            try:
+                listening_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._listener.close()
+
+
+class EncoderClient(object):
+    """Sends images to one or more encoder stages and returns initial states.
+
+    Calls are spread over the addresses in turn. Connections are kept open and
+    reused; a thread holds one connection for the duration of a call, so
+    concurrent calls use separate connections.
+    """
+
+    def __init__(self, addresses, authkey=None):
+        """Initializes the client; connections are opened on first use.
+        Args:
+          addresses: Addresses of the encoder stages, as passed to EncoderServer.
+          authkey: Optional bytes shared with the servers.
+        """
+        assert addresses
+        self.addresses = list(addresses)
+        self.authkey = authkey
+        self._lock = threading.Lock()
+        self._idle = [[] for _ in self.addresses]
+        self._next = 0
+
+    def _checkout(self):
+        with self._lock:
+            index = self._next % len(self.addresses)
+            self._next += 1
+            if self._idle[index]:
+                return index, self._idle[index].pop()
+        return index, connection.Client(self.addresses[index], authkey=self.authkey)
+
+    def encode(self, encoded_images):
+        """Returns the initial states of a list of encoded images.
+        Returns:
+          A float32 numpy array of shape [len(encoded_images), state_size].
+        Raises:
+          EncoderError: If the encoder stage failed to encode the images.
+        """
+        index, conn = self._checkout()
+        try:
+            conn.send_bytes(pack_images(encoded_images))
+            response = conn.recv_bytes()
+        except Exception:
+            conn.close()
+            raise
+        with self._lock:
+            self._idle[index].append(conn)
+        return unpack_states(response)
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle:
+                for conn in idle:
+                    conn.close()
+                del idle[:]
+
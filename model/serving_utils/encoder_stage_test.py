@@ -0,0 +1,93 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-13 下午2:10
+
+# @Author  : Swing
+
+
+import threading
+import unittest
+
+import numpy as np
+
+from model.serving_utils import encoder_stage
+
+
+class FakeModel(object):
+    """Model whose initial state of an image is its length and first byte."""
+
+    def feed_images(self, sess, encoded_images):
+        if not encoded_images:
+            raise ValueError("no images")
+        return np.array([[len(image), image[0]] for image in encoded_images])
+
+
+class FakeCaptioner(object):
+
+    def __init__(self):
+        self.model = FakeModel()
+        self.sess = None
+
+
+class WireFormatTest(unittest.TestCase):
+
+    def testImagesRoundTrip(self):
+        images = [b"\xff\xd8\xffjpeg", b"", memoryview(b"png")]
+        request = encoder_stage.pack_images(images)
+        self.assertEqual([b"\xff\xd8\xffjpeg", b"", b"png"],
+                         encoder_stage.unpack_images(request))
+        self.assertEqual([], encoder_stage.unpack_images(encoder_stage.pack_images([])))
+
+    def testMalformedRequestsAreRejected(self):
+        request = encoder_stage.pack_images([b"abc", b"de"])
+        for malformed in (b"", request[:2], request[:-1], request + b"x",
+                          b"\x01\x00\x00\x00\xff\xff\xff\xff"):
+            with self.assertRaises(ValueError):
+                encoder_stage.unpack_images(malformed)
+
+    def testStatesRoundTrip(self):
+        states = np.arange(6, dtype=np.float64).reshape([2, 3])
+        unpacked = encoder_stage.unpack_states(encoder_stage.pack_states(states))
+        self.assertEqual(np.float32, unpacked.dtype)
+        np.testing.assert_array_equal(states, unpacked)
+
+    def testErrorsAreRaised(self):
+        with self.assertRaisesRegex(encoder_stage.EncoderError, "bad image"):
+            encoder_stage.unpack_states(encoder_stage.pack_error("bad image"))
+
+
+class EncoderStageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = encoder_stage.EncoderServer(FakeCaptioner(), ("localhost", 0),
+                                                  authkey=b"secret", max_request_bytes=64)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = encoder_stage.EncoderClient([self.server.address], authkey=b"secret")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        self.thread.join(5)
+
+    def testEncodesOverTheConnection(self):
+        states = self.client.encode([b"abc", b"\x01"])
+        np.testing.assert_array_equal([[3, ord("a")], [1, 1]], states)
+        # The connection is reused.
+        self.client.encode([b"de"])
+        self.assertEqual(2, self.server.requests)
+        self.assertEqual(1, len(self.client._idle[0]))
+
+    def testEncoderErrorsAreRaised(self):
+        with self.assertRaisesRegex(encoder_stage.EncoderError, "no images"):
+            self.client.encode([])
+
+    def testOversizedRequestsCloseTheConnection(self):
+        # The server may close the connection before reading the whole request.
+        with self.assertRaises((EOFError, ConnectionResetError)):
+            self.client.encode([b"x" * 100])
+        self.assertEqual([[1, ord("y")]], self.client.encode([b"y"]).tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
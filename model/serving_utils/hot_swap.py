@@ -0,0 +1,135 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-3-25 下午8:30
+
+# @Author  : Swing
+
+
+import contextlib
+import threading
+
+import tensorflow as tf
+
+from model.inference_interface import Captioner
+
+
+class _Generation(object):
+    """A Captioner together with the number of requests using it."""
+
+    def __init__(self, captioner):
+        self.captioner = captioner
+        self.in_flight = 0
+        self.drained = threading.Condition()
+
+
+class SwappableCaptioner(object):
+    """Captioner that follows the latest checkpoint of a training directory.
+
+    A watcher thread polls the directory. When a new checkpoint appears, a second
+    Captioner restores it into its own graph and session and is warmed up in the
+    background, then new requests are switched to it at once. Requests already
+    running finish on the old session, which is closed when the last of them
+    returns.
+    """
+
+    def __init__(self, checkpoint_dir, vocab_file, poll_secs=60.0, **captioner_kwargs):
+        """Loads the latest checkpoint and starts the watcher thread.
+        Args:
+          checkpoint_dir: Directory containing model checkpoint files.
+          vocab_file: Text file containing the vocabulary.
+          poll_secs: How often the directory is checked for a new checkpoint.
+          **captioner_kwargs: Passed to every Captioner; warm_up defaults to True.
+        Raises:
+          ValueError: If the directory contains no checkpoint.
+        """
+        captioner_kwargs.setdefault("warm_up", True)
+        self.checkpoint_dir = checkpoint_dir
+        self.vocab_file = vocab_file
+        self.poll_secs = poll_secs
+        self._captioner_kwargs = captioner_kwargs
+
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_dir)
+        if not checkpoint_path:
+            raise ValueError("No checkpoint file found in: %s" % checkpoint_dir)
+        self.checkpoint_path = checkpoint_path
+        self._lock = threading.Lock()
+        self._current = _Generation(Captioner(checkpoint_path, vocab_file,
+                                              **captioner_kwargs))
+        self.swaps = 0
+
+        self._stopped = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, name="SwappableCaptioner")
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    @property
+    def ready(self):
+        return self._current.captioner.ready
+
+    @property
+    def model_key(self):
+        return self._current.captioner.model_key
+
+    @contextlib.contextmanager
+    def _acquire(self):
+        """Pins the current Captioner for the duration of a request."""
+        with self._lock:
+            generation = self._current
+            with generation.drained:
+                generation.in_flight += 1
+        try:
+            yield generation.captioner
+        finally:
+            with generation.drained:
+                generation.in_flight -= 1
+                generation.drained.notify_all()
+
+    def caption_image(self, encoded_image, **kwargs):
+        """See Captioner.caption_image."""
+        with self._acquire() as captioner:
+            return captioner.caption_image(encoded_image, **kwargs)
+
+    def caption_images(self, encoded_images, **kwargs):
+        """See Captioner.caption_images."""
+        with self._acquire() as captioner:
+            return captioner.caption_images(encoded_images, **kwargs)
+
+    def stream_image(self, encoded_image, **kwargs):
+        """See Captioner.stream_image. The Captioner stays pinned until the
+        generator is exhausted or closed."""
+        with self._acquire() as captioner:
+            for event in captioner.stream_image(encoded_image, **kwargs):
+                yield event
+
+    def swap(self, checkpoint_path):
+        """Restores and warms up `checkpoint_path`, then switches new requests to
+        it and closes the old Captioner once its requests have finished."""
+        tf.logging.info("Loading new checkpoint for hot swap: %s", checkpoint_path)
+        captioner = Captioner(checkpoint_path, self.vocab_file, **self._captioner_kwargs)
+
+        with self._lock:
+            old = self._current
+            self._current = _Generation(captioner)
+            self.checkpoint_path = checkpoint_path
+            self.swaps += 1
+        tf.logging.info("Switched to checkpoint: %s", checkpoint_path)
+
+        with old.drained:
+            while old.in_flight:
+                old.drained.wait()
+        old.captioner.close()
+
+    def close(self):
+        """Stops the watcher and closes the current Captioner."""
+        self._stopped.set()
+        self._watcher.join()
+        self._current.captioner.close()
+
+    def _watch(self):
+        while not self._stopped.wait(self.poll_secs):
+            try:
+                checkpoint_path = tf.train.latest_checkpoint(self.checkpoint_dir)
+                if checkpoint_path and checkpoint_path != self.checkpoint_path:
+                    self.swap(checkpoint_path)
+            except Exception as err:  # pylint: disable=broad-except
+                tf.logging.error("Checkpoint hot swap failed: %s", err)
@@ -0,0 +1,229 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-3-20 下午9:15
+
+# @Author  : Swing
+
+
+import contextlib
+import threading
+import time
+
+# Upper bounds, in seconds, of the default latency buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    """A monotonically increasing value."""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def value(self):
+        with self._lock:
+            return self._value
+
+    def snapshot(self):
+        """Returns the counter as a picklable tuple, see Registry.snapshot."""
+        return "counter", self.name, self.documentation, self.value()
+
+    def merge(self, snapshot):
+        """Adds the value of a snapshot of a counter with the same name."""
+        self.inc(snapshot[3])
+
+    def render(self):
+        """Returns the counter in the Prometheus text format."""
+        return ["# HELP %s %s" % (self.name, self.documentation),
+                "# TYPE %s counter" % self.name,
+                "%s %s" % (self.name, _format_value(self.value()))]
+
+
+class Histogram(object):
+    """Counts observations in cumulative buckets, Prometheus style."""
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * len(self.buckets)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+            self._count += 1
+            self._sum += value
+
+    def snapshot(self):
+        """Returns the histogram as a picklable tuple, see Registry.snapshot."""
+        with self._lock:
+            return ("histogram", self.name, self.documentation, self.buckets,
+                    list(self._counts), self._count, self._sum)
+
+    def merge(self, snapshot):
+        """Adds the observations of a snapshot of a histogram with the same name
+        and buckets."""
+        _, _, _, buckets, counts, count, total = snapshot
+        assert tuple(buckets) == self.buckets, "Buckets of %s differ" % self.name
+        with self._lock:
+            for i, bucket_count in enumerate(counts):
+                self._counts[i] += bucket_count
+            self._count += count
+            self._sum += total
+
+    @contextlib.contextmanager
+    def time(self):
+        """Context manager observing the seconds spent in its block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start)
+
+    def render(self):
+        """Returns the histogram in the Prometheus text format."""
+        with self._lock:
+            counts = list(self._counts)
+            count = self._count
+            total = self._sum
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s histogram" % self.name]
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, _format_value(bound), cumulative))
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, count))
+        lines.append("%s_sum %s" % (self.name, _format_value(total)))
+        lines.append("%s_count %d" % (self.name, count))
+        return lines
+
+
+class Registry(object):
+    """A set of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation):
+        """Creates and registers a Counter."""
+        return self._register(Counter(name, documentation))
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        """Creates and registers a Histogram."""
+        return self._register(Histogram(name, documentation, buckets))
+
+    def snapshot(self):
+        """Returns the current values of all metrics as a picklable list, for
+        example to send them to another process; see merge_snapshots."""
+        with self._lock:
+            metrics = list(self._metrics)
+        return [metric.snapshot() for metric in metrics]
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+
+class BeamSearchMetrics(object):
+    """Metrics recorded by a CaptionGenerator given this object as `metrics`."""
+
+    def __init__(self, registry):
+        """Creates the metrics and registers them in `registry`."""
+        self.feed_image_seconds = registry.histogram(
+            "caption_feed_image_seconds",
+            "Time of feed_image/feed_images calls: image decoding, preprocessing and "
+            "Inception, which run in one session call and are not timed separately.")
+        self.inference_step_seconds = registry.histogram(
+            "caption_inference_step_seconds", "Time of each inference_step call.")
+        self.beam_search_seconds = registry.histogram(
+            "caption_beam_search_seconds", "Time of each beam search call, feed_image included.")
+        self.beam_steps = registry.histogram(
+            "caption_beam_steps", "Inference steps run per image.", buckets=range(1, 33))
+        self.batch_size = registry.histogram(
+            "caption_batch_size", "Images per beam search call.",
+            buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+        self.steps_saved = registry.counter(
+            "caption_early_stopping_steps_saved_total", "Inference steps skipped by early stopping.")
+        self.deadline_exceeded = registry.counter(
+            "caption_deadline_exceeded_total", "Beam searches cut short by their deadline.")
+
+
+def merge_snapshots(snapshots):
+    """Returns a Registry holding the sums of registry snapshots, for example of
+    the registries of several processes. Metrics are identified by name and
+    kept in the order they first appear."""
+    registry = Registry()
+    merged = {}
+    for snapshot in snapshots:
+        for entry in snapshot:
+            kind, name, documentation = entry[:3]
+            metric = merged.get(name)
+            if metric is None:
+                if kind == "counter":
+                    metric = registry.counter(name, documentation)
+                else:
+                    metric = registry.histogram(name, documentation, entry[3])
+                merged[name] = metric
+            metric.merge(entry)
+    return registry
+
+
+def render_stats(prefix, values, documentation="", counters=()):
+    """Renders a dict of numbers, such as CaptionCache.stats(), named
+    `prefix`_`key`, in the Prometheus text format.
+    Args:
+      prefix: Prefix of the metric names.
+      values: Dict of metric values; list values are skipped.
+      documentation: Prefix of the help text, followed by the key.
+      counters: Keys of the values that are running totals. They are rendered
+        as counters named `prefix`_`key`_total; the other values as gauges.
+    """
+    lines = []
+    for key in sorted(values):
+        value = values[key]
+        if isinstance(value, (list, tuple)):
+            continue
+        name = "%s_%s" % (prefix, key)
+        metric_type = "gauge"
+        if key in counters:
+            name += "_total"
+            metric_type = "counter"
+        lines.append("# HELP %s %s%s" % (name, documentation, key.replace("_", " ")))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        lines.append("%s %s" % (name, _format_value(value)))
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+# Process-wide registry served by the web service's /metrics route.
+REGISTRY = Registry()
+
+# Beam search metrics of the Captioners of this process.
+BEAM_SEARCH_METRICS = BeamSearchMetrics(REGISTRY)
@@ -0,0 +1,72 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-12 下午4:20
+
+# @Author  : Swing
+
+
+import unittest
+
+from model.serving_utils import metrics
+
+
+class HistogramTest(unittest.TestCase):
+
+    def testBucketsAreCumulative(self):
+        histogram = metrics.Histogram("latency", "Latency.", buckets=(1, 2))
+        for value in (0.5, 1.5, 1.5, 3):
+            histogram.observe(value)
+        lines = histogram.render()
+        self.assertIn('latency_bucket{le="1.0"} 1', lines)
+        self.assertIn('latency_bucket{le="2.0"} 3', lines)
+        self.assertIn('latency_bucket{le="+Inf"} 4', lines)
+        self.assertIn("latency_sum 6.5", lines)
+        self.assertIn("latency_count 4", lines)
+
+
+class MergeSnapshotsTest(unittest.TestCase):
+
+    def testSumsMetricsOfTheSameName(self):
+        registries = [metrics.Registry(), metrics.Registry()]
+        for i, registry in enumerate(registries):
+            registry.counter("requests_total", "Requests.").inc(i + 1)
+            registry.histogram("latency", "Latency.", buckets=(1, 2)).observe(i + 0.5)
+        registries[1].counter("errors_total", "Errors.").inc()
+
+        merged = metrics.merge_snapshots([registry.snapshot() for registry in registries])
+        lines = merged.render().splitlines()
+        self.assertIn("requests_total 3.0", lines)
+        self.assertIn("errors_total 1.0", lines)
+        self.assertIn('latency_bucket{le="1.0"} 1', lines)
+        self.assertIn('latency_bucket{le="2.0"} 2', lines)
+        self.assertIn("latency_sum 2.0", lines)
+        self.assertIn("latency_count 2", lines)
+        # The snapshots are unchanged.
+        self.assertIn("requests_total 1.0", registries[0].render().splitlines())
+
+
+class RenderStatsTest(unittest.TestCase):
+
+    def testTotalsAreCounters(self):
+        text = metrics.render_stats("cache", {"hits": 3, "size": 2, "sizes": [1]},
+                                    "Cache ", counters=("hits",))
+        lines = text.splitlines()
+        self.assertIn("# TYPE cache_hits_total counter", lines)
+        self.assertIn("cache_hits_total 3.0", lines)
+        self.assertIn("# TYPE cache_size gauge", lines)
+        self.assertIn("cache_size 2.0", lines)
+        self.assertNotIn("sizes", text)
+
+
+class BeamSearchMetricsTest(unittest.TestCase):
+
+    def testRegistersEveryMetric(self):
+        registry = metrics.Registry()
+        metrics.BeamSearchMetrics(registry)
+        text = registry.render()
+        self.assertIn("# TYPE caption_beam_search_seconds histogram", text)
+        self.assertIn("# TYPE caption_deadline_exceeded_total counter", text)
+
+
+if __name__ == "__main__":
+    unittest.main()
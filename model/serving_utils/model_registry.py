@@ -0,0 +1,207 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-3-27 下午9:05
+
+# @Author  : Swing
+
+
+import collections
+import contextlib
+import threading
+
+import tensorflow as tf
+
+from model.inference_interface import Captioner
+
+
+class _Resident(object):
+    """A loaded Captioner together with the number of requests using it."""
+
+    def __init__(self, captioner):
+        self.captioner = captioner
+        self.in_flight = 0
+        self.evicted = False
+
+
+class _Loading(object):
+    """A model being loaded; `done` is set once it is resident or has failed
+    with `error`."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class _BoundModel(object):
+    """Captioner-like view of one model of a ModelRegistry."""
+
+    def __init__(self, registry, model_id):
+        self._registry = registry
+        self.model_id = model_id
+
+    def caption_image(self, encoded_image, **kwargs):
+        """See Captioner.caption_image."""
+        with self._registry.acquire(self.model_id) as captioner:
+            return captioner.caption_image(encoded_image, **kwargs)
+
+    def caption_images(self, encoded_images, **kwargs):
+        """See Captioner.caption_images."""
+        with self._registry.acquire(self.model_id) as captioner:
+            return captioner.caption_images(encoded_images, **kwargs)
+
+    def stream_image(self, encoded_image, **kwargs):
+        """See Captioner.stream_image."""
+        with self._registry.acquire(self.model_id) as captioner:
+            for event in captioner.stream_image(encoded_image, **kwargs):
+                yield event
+
+
+class ModelRegistry(object):
+    """Serves several models from one process within a memory budget.
+
+    Models are named by id and loaded on first use. The size of each model's
+    variables is counted against `memory_budget_bytes`; when loading a model
+    would exceed it, the least recently used models are unloaded. A model still
+    serving requests when evicted is closed after its last request returns.
+    """
+
+    def __init__(self, models, default_model=None, memory_budget_bytes=None,
+                 **captioner_kwargs):
+        """Initializes the registry; no model is loaded yet.
+        Args:
+          models: A dict mapping model ids to (checkpoint_path, vocab_file) pairs.
+          default_model: Id of the model used when a request names none; defaults
+            to the only model if there is just one.
+          memory_budget_bytes: Maximum total variable size of the resident
+            models, or None for no limit. The most recently used model is always
+            kept, even if it alone exceeds the budget.
+          **captioner_kwargs: Passed to every Captioner.
+        """
+        if default_model is None and len(models) == 1:
+            default_model = next(iter(models))
+        self.models = dict(models)
+        self.default_model = default_model
+        self.memory_budget_bytes = memory_budget_bytes
+        self._captioner_kwargs = captioner_kwargs
+
+        self._lock = threading.Lock()
+        self._resident = collections.OrderedDict()  # model id -> _Resident
+        self._loading = {}  # model id -> _Loading
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, model_id=None):
+        """Returns a Captioner-like object for a model.
+        Raises:
+          KeyError: If the model id is unknown.
+        """
+        return _BoundModel(self, self._resolve(model_id))
+
+    @contextlib.contextmanager
+    def acquire(self, model_id=None):
+        """Context manager yielding the loaded Captioner of a model, pinned so that
+        it is not closed while in use."""
+        resident = self._pin(self._resolve(model_id))
+        try:
+            yield resident.captioner
+        finally:
+            self._unpin(resident)
+
+    def load(self, model_id=None):
+        """Loads a model now, for example at startup, instead of on first use."""
+        with self.acquire(model_id):
+            pass
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(r.captioner.memory_bytes for r in self._resident.values())
+
+    def stats(self):
+        """Returns a dict describing the resident models."""
+        with self._lock:
+            return {"resident": list(self._resident),
+                    "resident_bytes": sum(r.captioner.memory_bytes
+                                          for r in self._resident.values()),
+                    "memory_budget_bytes": self.memory_budget_bytes,
+                    "loads": self.loads,
+                    "evictions": self.evictions}
+
+    def close(self):
+        """Closes all resident models."""
+        with self._lock:
+            residents = list(self._resident.values())
+            self._resident.clear()
+        for resident in residents:
+            resident.captioner.close()
+
+    def _resolve(self, model_id):
+        if model_id is None:
+            model_id = self.default_model
+        if model_id not in self.models:
+            raise KeyError("Unknown model: %s" % model_id)
+        return model_id
+
+    def _pin(self, model_id):
+        while True:
+            with self._lock:
+                resident = self._resident.get(model_id)
+                if resident is not None:
+                    self._resident.move_to_end(model_id)
+                    resident.in_flight += 1
+                    return resident
+                loading = self._loading.get(model_id)
+                if loading is None:
+                    loading = self._loading[model_id] = _Loading()
+                    break
+            # Another request is loading this model.
+            loading.done.wait()
+            if loading.error is not None:
+                raise loading.error
+
+        try:
+            checkpoint_path, vocab_file = self.models[model_id]
+            tf.logging.info("Loading model %s", model_id)
+            captioner = Captioner(checkpoint_path, vocab_file, **self._captioner_kwargs)
+        except Exception as err:
+            with self._lock:
+                del self._loading[model_id]
+                loading.error = err
+            loading.done.set()
+            raise
+
+        # Waiters must find the model resident as soon as it is no longer loading.
+        resident = _Resident(captioner)
+        resident.in_flight = 1
+        with self._lock:
+            del self._loading[model_id]
+            self._resident[model_id] = resident
+            self.loads += 1
+            evicted = self._evict()
+        loading.done.set()
+        for old in evicted:
+            old.captioner.close()
+        return resident
+
+    def _evict(self):
+        """Removes least recently used models until the budget is met. Returns the
+        evicted residents that can be closed now. Called with the lock held."""
+        if self.memory_budget_bytes is None:
+            return []
+        closable = []
+        total = sum(r.captioner.memory_bytes for r in self._resident.values())
+        while total > self.memory_budget_bytes and len(self._resident) > 1:
+            model_id, resident = self._resident.popitem(last=False)
+            tf.logging.info("Unloading model %s", model_id)
+            total -= resident.captioner.memory_bytes
+            resident.evicted = True
+            self.evictions += 1
+            if not resident.in_flight:
+                closable.append(resident)
+        return closable
+
+    def _unpin(self, resident):
+        with self._lock:
+            resident.in_flight -= 1
+            close = resident.evicted and not resident.in_flight
+        if close:
+            resident.captioner.close()
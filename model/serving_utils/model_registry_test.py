@@ -0,0 +1,121 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-12 下午5:40
+
+# @Author  : Swing
+
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+if tf is not None:
+    from model.serving_utils import model_registry
+
+
+class FakeCaptioner(object):
+    """Captioner whose variables take as many bytes as its checkpoint name says.
+    Loading checkpoint "broken" fails."""
+
+    builds = 0
+
+    def __init__(self, checkpoint_path, vocab_file, **kwargs):
+        FakeCaptioner.builds += 1
+        # Slow enough for concurrent loads to overlap.
+        time.sleep(0.05)
+        if checkpoint_path == "broken":
+            raise IOError("Cannot read checkpoint")
+        self.checkpoint_path = checkpoint_path
+        self.memory_bytes = int(checkpoint_path)
+        self.closed = False
+
+    def caption_image(self, encoded_image, **kwargs):
+        return [self.checkpoint_path]
+
+    def close(self):
+        self.closed = True
+
+
+@unittest.skipIf(tf is None, "TensorFlow is not installed")
+class ModelRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(model_registry, "Captioner", FakeCaptioner)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.models = {"small": ("10", "vocab"), "medium": ("20", "vocab"),
+                       "large": ("30", "vocab"), "broken": ("broken", "vocab")}
+        FakeCaptioner.builds = 0
+
+    def _load_concurrently(self, registry, model_id, num_threads=4):
+        errors = []
+
+        def _load():
+            try:
+                registry.load(model_id)
+            except IOError as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=_load) for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return errors
+
+    def testLoadsModelsOnFirstUse(self):
+        registry = model_registry.ModelRegistry(self.models, default_model="small")
+        self.assertEqual([], registry.stats()["resident"])
+        self.assertEqual(["20"], registry.get("medium").caption_image(b"image"))
+        self.assertEqual(["10"], registry.get().caption_image(b"image"))
+        self.assertEqual(["medium", "small"], registry.stats()["resident"])
+        self.assertEqual(2, registry.loads)
+
+    def testConcurrentLoadsBuildTheModelOnce(self):
+        registry = model_registry.ModelRegistry(self.models)
+        self.assertEqual([], self._load_concurrently(registry, "small"))
+        self.assertEqual(1, FakeCaptioner.builds)
+        self.assertEqual(1, registry.loads)
+        self.assertEqual(10, registry.resident_bytes())
+
+    def testFailedLoadsFailTheirWaiters(self):
+        registry = model_registry.ModelRegistry(self.models)
+        self.assertEqual(4, len(self._load_concurrently(registry, "broken")))
+        self.assertEqual([], registry.stats()["resident"])
+        self.assertEqual(0, registry.loads)
+
+    def testUnknownModel(self):
+        registry = model_registry.ModelRegistry(self.models)
+        with self.assertRaises(KeyError):
+            registry.get("huge")
+        # Several models and no default: a request must name one.
+        with self.assertRaises(KeyError):
+            registry.get()
+
+    def testEvictsLeastRecentlyUsedOverBudget(self):
+        registry = model_registry.ModelRegistry(self.models, memory_budget_bytes=50)
+        registry.load("small")
+        registry.load("medium")
+        registry.load("small")
+        registry.load("large")
+        self.assertEqual(["small", "large"], registry.stats()["resident"])
+        self.assertEqual(40, registry.resident_bytes())
+        self.assertEqual(1, registry.evictions)
+
+    def testEvictedModelIsClosedAfterItsLastRequest(self):
+        registry = model_registry.ModelRegistry(self.models, memory_budget_bytes=30)
+        with registry.acquire("small") as small:
+            registry.load("large")
+            self.assertEqual(["large"], registry.stats()["resident"])
+            self.assertFalse(small.closed)
+        self.assertTrue(small.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-3-29 下午2:45
+
+# @Author  : Swing
+
+
+import threading
+from concurrent import futures
+
+
+def _covers(leader_deadline, deadline):
+    """Returns True if a computation with `leader_deadline` runs at least until
+    `deadline`; None is no deadline."""
+    if leader_deadline is None:
+        return True
+    return deadline is not None and leader_deadline >= deadline
+
+
+class SingleFlight(object):
+    """Coalesces concurrent computations of the same key.
+
+    The first caller for a key becomes its leader and computes the value; callers
+    arriving while it is in progress wait for, and share, the leader's result.
+    A caller only joins a leader whose deadline is not earlier than its own, as
+    the leader's result may be cut short at its deadline; otherwise it leads a
+    computation of its own, which later callers join instead. Nothing is
+    remembered once the computation ends; that is the cache's job.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}  # key -> (future, deadline)
+        self.coalesced = 0
+
+    def begin(self, key, deadline=None):
+        """Joins or starts the computation of `key`.
+        Args:
+          key: Key of the computation.
+          deadline: Optional time.time() value by which the caller needs the
+            result; None for none.
+        Returns:
+          (future, leader): the Future of the computation, and whether the caller
+          is its leader and must call finish() with the future.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and _covers(flight[1], deadline):
+                self.coalesced += 1
+                return flight[0], False
+            future = futures.Future()
+            self._flights[key] = (future, deadline)
+        future.set_running_or_notify_cancel()
+        return future, True
+
+    def finish(self, key, future, result=None, exception=None):
+        """Ends the computation of `key` led with `future`, handing its outcome to
+        all callers."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight[0] is future:
+                del self._flights[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, deadline=None, shareable=None):
+        """Returns fn(), computed once for all concurrent callers with `key` whose
+        deadline is not later than the leader's. If `shareable` is given, a
+        caller handed a result for which shareable(result) is False computes its
+        own with fn() instead."""
+        future, leader = self.begin(key, deadline)
+        if not leader:
+            result = future.result()
+            if shareable is not None and not shareable(result):
+                return fn()
+            return result
+        try:
+            result = fn()
+        except Exception as err:
+            self.finish(key, future, exception=err)
+            raise
+        self.finish(key, future, result)
+        return result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
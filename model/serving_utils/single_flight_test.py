@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-12 下午6:15
+
+# @Author  : Swing
+
+
+import threading
+import unittest
+
+from model.serving_utils import single_flight
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = single_flight.SingleFlight()
+
+    def testFollowersShareTheLeadersResult(self):
+        leader_future, leader = self.flights.begin("key")
+        follower_future, follower = self.flights.begin("key")
+        self.assertTrue(leader)
+        self.assertFalse(follower)
+        self.assertIs(leader_future, follower_future)
+
+        self.flights.finish("key", leader_future, "value")
+        self.assertEqual("value", follower_future.result(0))
+        self.assertEqual(0, self.flights.in_flight())
+        self.assertEqual(1, self.flights.coalesced)
+
+    def testErrorsReachFollowers(self):
+        future, _ = self.flights.begin("key")
+        follower_future, _ = self.flights.begin("key")
+        self.flights.finish("key", future, exception=ValueError("failed"))
+        with self.assertRaises(ValueError):
+            follower_future.result(0)
+
+    def testFollowersRecomputeUnshareableResults(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def _leader():
+            started.set()
+            release.wait(5)
+            calls.append("leader")
+            return "cut short"
+
+        def _follower():
+            calls.append("follower")
+            return "complete"
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.flights.do("key", _leader)))
+        thread.start()
+        self.assertTrue(started.wait(5))
+        follower = threading.Thread(target=lambda: results.append(
+            self.flights.do("key", _follower, shareable=lambda r: r != "cut short")))
+        follower.start()
+        while not self.flights.coalesced:
+            pass
+        release.set()
+        thread.join(5)
+        follower.join(5)
+        self.assertEqual(["leader", "follower"], calls)
+        self.assertEqual(["cut short", "complete"], results)
+
+    def testKeysAreIndependent(self):
+        _, first = self.flights.begin("a")
+        _, second = self.flights.begin("b")
+        self.assertTrue(first)
+        self.assertTrue(second)
+
+    def testOnlyJoinsLeadersWithALaterDeadline(self):
+        self.assertTrue(self.flights.begin("key", deadline=10.0)[1])
+        self.assertFalse(self.flights.begin("key", deadline=5.0)[1])
+        self.assertFalse(self.flights.begin("key", deadline=10.0)[1])
+        self.assertTrue(self.flights.begin("key", deadline=20.0)[1])
+
+    def testNoDeadlineOnlyJoinsNoDeadline(self):
+        self.assertTrue(self.flights.begin("key", deadline=10.0)[1])
+        self.assertTrue(self.flights.begin("key")[1])
+        self.assertFalse(self.flights.begin("key", deadline=30.0)[1])
+        self.assertFalse(self.flights.begin("key")[1])
+
+    def testLaterLeaderReplacesEarlierOne(self):
+        early, _ = self.flights.begin("key", deadline=10.0)
+        late, _ = self.flights.begin("key", deadline=20.0)
+        # The early leader ending does not end the late leader's computation.
+        self.flights.finish("key", early, "early")
+        joined, leader = self.flights.begin("key", deadline=15.0)
+        self.assertFalse(leader)
+        self.assertIs(late, joined)
+        self.flights.finish("key", late, "late")
+        self.assertEqual(0, self.flights.in_flight())
+
+    def testDoComputesOnceForConcurrentCallers(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "value"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(self.flights.do("key", compute)))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        follower = threading.Thread(target=lambda: results.append(self.flights.do("key", compute)))
+        follower.start()
+        while not self.flights.coalesced:
+            pass
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(["value", "value"], results)
+        self.assertEqual(1, len(calls))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,359 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-3-18 下午7:52
+
+# @Author  : Swing
+
+
+import copy
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent import futures
+
+from model.serving_utils import caption_cache
+from model.serving_utils import metrics
+from model.serving_utils import single_flight
+
+
+def partition_cpus(num_workers, cpus=None):
+    """Splits CPUs into contiguous, equally sized groups, one per worker.
+    Contiguous core ids usually share a socket, so each worker stays on one NUMA
+    node when num_workers is a multiple of the number of sockets.
+    Args:
+      num_workers: Number of groups.
+      cpus: CPUs to split; defaults to the CPUs this process may run on.
+    Returns:
+      A list of num_workers lists of CPU ids.
+    """
+    if cpus is None:
+        cpus = os.sched_getaffinity(0)
+    cpus = sorted(cpus)
+    per_worker = max(1, len(cpus) // num_workers)
+    groups = []
+    for i in range(num_workers):
+        group = cpus[i * per_worker:(i + 1) * per_worker]
+        groups.append(group or [cpus[i % len(cpus)]])
+    return groups
+
+
+def _worker_main(worker_id, checkpoint_path, vocab_file, captioner_kwargs, cpus,
+                 intra_op_threads, inter_op_threads, num_threads, metrics_secs,
+                 requests, results):
+    """Serves requests of one worker process until it receives None. Every
+    metrics_secs, and once more before exiting, it also sends a snapshot of its
+    metrics registry."""
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+    # TensorFlow is only imported here, after the affinity is set, so that its
+    # thread pools are sized for and bound to this worker's CPUs.
+    import tensorflow as tf
+    from model.inference_interface import Captioner
+
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                    inter_op_parallelism_threads=inter_op_threads)
+    try:
+        captioner = Captioner(checkpoint_path, vocab_file,
+                              session_config=session_config, **captioner_kwargs)
+    except Exception as err:  # pylint: disable=broad-except
+        results.put(("failed", worker_id, repr(err)))
+        return
+    results.put(("ready", worker_id, captioner.model_key))
+
+    def _serve(request_id, encoded_image, settings):
+        try:
+            results.put(("result", request_id,
+                         captioner.caption_image(encoded_image, **settings)))
+        except Exception as err:  # pylint: disable=broad-except
+            results.put(("error", request_id, repr(err)))
+
+    def _report_metrics():
+        while not stopped.wait(metrics_secs):
+            results.put(("metrics", worker_id, metrics.REGISTRY.snapshot()))
+
+    stopped = threading.Event()
+    reporter = threading.Thread(target=_report_metrics, name="WorkerMetrics")
+    reporter.daemon = True
+    reporter.start()
+
+    # Several requests in flight let the Captioner's BatchScheduler batch them.
+    executor = futures.ThreadPoolExecutor(max_workers=num_threads)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        executor.submit(_serve, *request)
+    executor.shutdown(wait=True)
+    stopped.set()
+    reporter.join()
+    results.put(("metrics", worker_id, metrics.REGISTRY.snapshot()))
+    captioner.close()
+
+
+class WorkerPool(object):
+    """Pool of caption worker processes, each holding its own restored session.
+
+    Every worker runs its own Captioner with its own TensorFlow thread pools and,
+    optionally, pinned to a set of CPUs, so beam search bookkeeping is not
+    serialized by a single GIL. Requests are routed to the live worker with the
+    fewest outstanding requests; those of a worker that dies are failed.
+
+    The beam search metrics are recorded in the workers, which periodically send
+    snapshots of their registries; metrics_snapshots() returns the latest ones
+    for merging into this process's metrics.
+
+    Workers are started with spawn, which re-imports the main module of this
+    process in every worker. The main module must therefore not load TensorFlow
+    or start services at import time, but only under `if __name__ == '__main__'`.
+    """
+
+    def __init__(self, checkpoint_path, vocab_file, num_workers=2,
+                 intra_op_threads=0, inter_op_threads=0, worker_cpus=None,
+                 pin_cpus=False, threads_per_worker=1, cache=None,
+                 start_timeout_secs=600, health_check_secs=1.0, metrics_secs=1.0,
+                 context=None, **captioner_kwargs):
+        """Starts the worker processes and waits until they have loaded the model.
+        Args:
+          checkpoint_path: Model checkpoint file or directory containing a model
+            checkpoint file.
+          vocab_file: Text file containing the vocabulary.
+          num_workers: Number of worker processes.
+          intra_op_threads: intra_op_parallelism_threads of each worker session;
+            0 lets TensorFlow choose.
+          inter_op_threads: inter_op_parallelism_threads of each worker session;
+            0 lets TensorFlow choose.
+          worker_cpus: Optional list with, for each worker, the CPU ids it is
+            pinned to.
+          pin_cpus: If True and worker_cpus is None, the available CPUs are split
+            between the workers with partition_cpus().
+          threads_per_worker: Number of requests each worker serves concurrently;
+            set it to the Captioner's max_batch_size to batch them.
+          cache: Optional CaptionCache checked in this process before a request
+            is sent to a worker.
+          start_timeout_secs: How long to wait for each worker to load the model.
+          health_check_secs: How often the workers are checked for having died.
+          metrics_secs: How often each worker sends a snapshot of its metrics.
+          context: The multiprocessing context creating the worker processes and
+            their queues; defaults to the spawn context.
+          **captioner_kwargs: Passed to each worker's Captioner.
+        Raises:
+          RuntimeError: If a worker fails to load the model.
+        """
+        assert num_workers > 0
+        if worker_cpus is None and pin_cpus:
+            worker_cpus = partition_cpus(num_workers)
+        if worker_cpus is not None:
+            assert len(worker_cpus) == num_workers
+
+        self.cache = cache
+        self.model_key = None
+        self.health_check_secs = health_check_secs
+
+        # Workers must not inherit this process's TensorFlow runtime.
+        if context is None:
+            context = multiprocessing.get_context("spawn")
+        self._results = context.Queue()
+        self._requests = []
+        self._processes = []
+        for i in range(num_workers):
+            requests = context.Queue()
+            process = context.Process(
+                target=_worker_main,
+                name="CaptionWorker-%d" % i,
+                args=(i, checkpoint_path, vocab_file, captioner_kwargs,
+                      worker_cpus[i] if worker_cpus is not None else None,
+                      intra_op_threads, inter_op_threads, threads_per_worker,
+                      metrics_secs, requests, self._results))
+            process.daemon = True
+            process.start()
+            self._requests.append(requests)
+            self._processes.append(process)
+
+        started = 0
+        while started < num_workers:
+            status, worker_id, value = self._results.get(timeout=start_timeout_secs)
+            if status == "metrics":
+                # From a worker that started while others are still loading.
+                continue
+            if status != "ready":
+                self._terminate()
+                raise RuntimeError("Caption worker %d failed to start: %s" %
+                                   (worker_id, value))
+            self.model_key = value
+            started += 1
+
+        self._lock = threading.Lock()
+        self._flights = single_flight.SingleFlight()
+        self._next_id = 0
+        self._pending = {}  # request id -> (worker id, result key, future)
+        self._outstanding = [0] * num_workers
+        self._served = [0] * num_workers
+        self._alive = [True] * num_workers
+        self._metrics = [None] * num_workers  # latest registry snapshot per worker
+
+        self._collector = threading.Thread(target=self._collect, name="WorkerPool")
+        self._collector.daemon = True
+        self._collector.start()
+
+    def submit(self, encoded_image, beam_size=None, max_caption_length=None,
+               deadline=None):
+        """Sends an encoded image to the least-loaded worker.
+        Beam settings and deadline are passed to Captioner.caption_image. A
+        request for an image and beam settings already being captioned with a
+        deadline no earlier than its own shares that computation instead, unless
+        its result is cut short by a deadline while this request still has time.
+        Returns:
+          A concurrent.futures.Future resolving to the formatted results. It fails
+          with RuntimeError if the worker dies or no worker is alive.
+        """
+        if isinstance(encoded_image, memoryview):
+            encoded_image = encoded_image.tobytes()
+
+        key = (caption_cache.image_digest(encoded_image),
+               caption_cache.settings_key(self.model_key, beam_size, max_caption_length))
+        if self.cache is not None:
+            results = self.cache.get(key)
+            if results is not None:
+                future = futures.Future()
+                future.set_result(copy.copy(results))
+                return future
+
+        settings = {"beam_size": beam_size,
+                    "max_caption_length": max_caption_length,
+                    "deadline": deadline}
+        future, leader = self._flights.begin(key, deadline)
+        if not leader:
+            return self._follow(future, key, encoded_image, settings)
+        self._send(key, encoded_image, settings, future)
+        return future
+
+    def _follow(self, shared, key, encoded_image, settings):
+        """Returns a Future resolving to the outcome of the `shared` request, or
+        of a request of its own if the shared result was cut short by a deadline
+        (possibly of another request batched with it) and this one has time left."""
+        future = futures.Future()
+        future.set_running_or_notify_cancel()
+        deadline = settings["deadline"]
+
+        def _done(shared):
+            error = shared.exception()
+            if error is not None:
+                future.set_exception(error)
+            elif shared.result().deadline_exceeded and (deadline is None or
+                                                       time.time() < deadline):
+                self._send(key, encoded_image, settings, future)
+            else:
+                future.set_result(copy.copy(shared.result()))
+
+        shared.add_done_callback(_done)
+        return future
+
+    def _send(self, key, encoded_image, settings, future):
+        """Sends a request to the least-loaded live worker; its outcome is set on
+        `future` through the single flight of `key`."""
+        with self._lock:
+            alive = [i for i in range(len(self._alive)) if self._alive[i]]
+            if alive:
+                worker_id = min(alive, key=lambda i: self._outstanding[i])
+                request_id = self._next_id
+                self._next_id += 1
+                self._outstanding[worker_id] += 1
+                self._pending[request_id] = (worker_id, key, future)
+        if not alive:
+            self._flights.finish(key, future,
+                                 exception=RuntimeError("No caption worker is alive"))
+            return
+
+        try:
+            self._requests[worker_id].put((request_id, encoded_image, settings))
+        except Exception as err:  # pylint: disable=broad-except
+            # Callers that joined this request must not wait for it forever.
+            with self._lock:
+                if self._pending.pop(request_id, None) is not None:
+                    self._outstanding[worker_id] -= 1
+            self._flights.finish(key, future, exception=err)
+
+    def caption_image(self, encoded_image, timeout=None, **kwargs):
+        """Captions an encoded image and returns formatted results. Keyword
+        arguments are passed to submit()."""
+        return self.submit(encoded_image, **kwargs).result(timeout)
+
+    def stats(self):
+        """Returns a dict with the outstanding and served requests and whether it
+        is alive, per worker."""
+        with self._lock:
+            return {"outstanding": list(self._outstanding),
+                    "served": list(self._served),
+                    "alive": list(self._alive)}
+
+    def metrics_snapshots(self):
+        """Returns the latest metrics registry snapshot of each worker that has
+        sent one, see metrics.merge_snapshots."""
+        with self._lock:
+            return [snapshot for snapshot in self._metrics if snapshot is not None]
+
+    def close(self):
+        """Finishes the outstanding requests and stops the workers."""
+        for requests in self._requests:
+            requests.put(None)
+        for process in self._processes:
+            process.join()
+        self._results.put(None)
+        self._collector.join()
+
+    def _terminate(self):
+        for process in self._processes:
+            process.terminate()
+
+    def _fail_dead_workers(self):
+        """Fails the pending requests of workers that have exited."""
+        for worker_id, process in enumerate(self._processes):
+            if not self._alive[worker_id] or process.is_alive():
+                continue
+            with self._lock:
+                self._alive[worker_id] = False
+                lost = [request_id for request_id, pending in self._pending.items()
+                        if pending[0] == worker_id]
+                lost = [self._pending.pop(request_id) for request_id in lost]
+                self._outstanding[worker_id] = 0
+            error = RuntimeError("Caption worker %d exited with code %s" %
+                                 (worker_id, process.exitcode))
+            for _, key, future in lost:
+                self._flights.finish(key, future, exception=error)
+
+    def _collect(self):
+        last_check = time.time()
+        while True:
+            if time.time() - last_check >= self.health_check_secs:
+                self._fail_dead_workers()
+                last_check = time.time()
+            try:
+                message = self._results.get(timeout=self.health_check_secs)
+            except queue.Empty:
+                continue
+            if message is None:
+                return
+            status, request_id, value = message
+            if status == "metrics":
+                worker_id = request_id
+                with self._lock:
+                    self._metrics[worker_id] = value
+                continue
+            with self._lock:
+                pending = self._pending.pop(request_id, None)
+                if pending is None:
+                    # Already failed because its worker died.
+                    continue
+                worker_id, key, future = pending
+                self._outstanding[worker_id] -= 1
+                self._served[worker_id] += 1
+            if status == "result":
+                # Results cut short by a deadline are not kept.
+                if self.cache is not None and not value.deadline_exceeded:
+                    self.cache.put(key, copy.copy(value))
+                self._flights.finish(key, future, value)
+            else:
+                self._flights.finish(key, future, exception=RuntimeError(value))
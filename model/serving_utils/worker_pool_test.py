@@ -0,0 +1,185 @@
+# -*- coding:utf-8 -*-
+
+# @Time    : 19-4-12 下午3:30
+
+# @Author  : Swing
+
+
+import queue
+import threading
+import time
+import unittest
+from unittest import mock
+
+from model.inference_utils import caption_generator
+from model.serving_utils import caption_cache
+from model.serving_utils import worker_pool
+
+
+class PartitionCpusTest(unittest.TestCase):
+
+    def testSplitsIntoContiguousGroups(self):
+        self.assertEqual([[0, 1], [2, 3]], worker_pool.partition_cpus(2, range(4)))
+        self.assertEqual([[0, 1, 2], [3, 4, 5]], worker_pool.partition_cpus(2, [5, 3, 1, 0, 2, 4]))
+
+    def testLeftoverCpusAreUnused(self):
+        self.assertEqual([[0, 1], [2, 3], [4, 5]], worker_pool.partition_cpus(3, range(7)))
+
+    def testMoreWorkersThanCpusShareCpus(self):
+        self.assertEqual([[0], [1], [0]], worker_pool.partition_cpus(3, [0, 1]))
+
+    def testDefaultsToTheAffinityOfThisProcess(self):
+        groups = worker_pool.partition_cpus(1)
+        self.assertEqual(1, len(groups))
+        self.assertTrue(groups[0])
+
+
+class FakeProcess(object):
+    """Worker process that runs no worker: the test serves its requests."""
+
+    def __init__(self, target, name, args):
+        self.worker_id = args[0]
+        self.requests, self.results = args[-2], args[-1]
+        self.daemon = False
+        self.alive = False
+        self.exitcode = None
+
+    def start(self):
+        self.alive = True
+        self.results.put(("ready", self.worker_id,
+                          caption_cache.model_key("ckpt", "vocab", 3, 20, 0.0)))
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self):
+        self.alive = False
+
+    def terminate(self):
+        self.alive = False
+
+    def serve(self, results, timeout=5):
+        """Answers the next request of this worker with `results`."""
+        request_id, _, _ = self.requests.get(timeout=timeout)
+        self.results.put(("result", request_id, results))
+
+
+class FakeContext(object):
+    """multiprocessing context running no processes, with in-process queues."""
+
+    def __init__(self):
+        self.processes = []
+
+    def Queue(self):  # pylint: disable=invalid-name
+        return queue.Queue()
+
+    def Process(self, target, name, args):  # pylint: disable=invalid-name
+        process = FakeProcess(target, name, args)
+        self.processes.append(process)
+        return process
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = FakeContext()
+        self.pool = worker_pool.WorkerPool("ckpt", "vocab", num_workers=2,
+                                           health_check_secs=0.01, context=self.context)
+        self.workers = self.context.processes
+
+    def tearDown(self):
+        self.pool.close()
+
+    def testRoutesToTheLeastLoadedWorker(self):
+        self.pool.submit(b"a")
+        self.pool.submit(b"b")
+        self.assertEqual([1, 1], self.pool.stats()["outstanding"])
+
+    def testResultsResolveTheirRequest(self):
+        future = self.pool.submit(b"a")
+        self.workers[0].serve(caption_generator.CaptionResults(["a caption"]))
+        self.assertEqual(["a caption"], future.result(5))
+        self.assertEqual([1, 0], self.pool.stats()["served"])
+
+    def testCachesOnlyCompleteResults(self):
+        self.pool.cache = caption_cache.CaptionCache()
+        cut_short = self.pool.submit(b"a")
+        self.workers[0].serve(caption_generator.CaptionResults(["a"], deadline_exceeded=True))
+        self.assertEqual(["a"], cut_short.result(5))
+        self.assertEqual(0, len(self.pool.cache))
+
+        complete = self.pool.submit(b"a")
+        self.workers[0].serve(caption_generator.CaptionResults(["a dog"]))
+        self.assertEqual(["a dog"], complete.result(5))
+        # Answered from the cache without a worker.
+        self.assertEqual(["a dog"], self.pool.submit(b"a").result(0))
+        self.assertEqual([0, 0], self.pool.stats()["outstanding"])
+
+    def testKeepsTheLatestMetricsOfEachWorker(self):
+        self.assertEqual([], self.pool.metrics_snapshots())
+        self.workers[1].results.put(("metrics", 1, [("counter", "a", "A.", 1.0)]))
+        self.workers[1].results.put(("metrics", 1, [("counter", "a", "A.", 2.0)]))
+        for _ in range(500):
+            if self.pool.metrics_snapshots() == [[("counter", "a", "A.", 2.0)]]:
+                break
+            time.sleep(0.01)
+        self.assertEqual([[("counter", "a", "A.", 2.0)]], self.pool.metrics_snapshots())
+
+    def testDeadWorkerFailsItsRequests(self):
+        lost = self.pool.submit(b"a")
+        kept = self.pool.submit(b"b")
+        self.workers[0].alive = False
+        self.workers[0].exitcode = -9
+
+        with self.assertRaises(RuntimeError):
+            lost.result(5)
+        self.assertFalse(kept.done())
+        self.assertEqual([False, True], self.pool.stats()["alive"])
+
+        # New requests only go to the live worker.
+        self.pool.submit(b"c")
+        self.assertEqual(2, self.workers[1].requests.qsize())
+
+    def testFailsWhenNoWorkerIsAlive(self):
+        for worker in self.workers:
+            worker.alive = False
+        future = self.pool.submit(b"a")
+        with self.assertRaises(RuntimeError):
+            future.result(5)
+        # Once the health check has seen the workers die, requests fail at once.
+        time.sleep(0.1)
+        with self.assertRaisesRegex(RuntimeError, "No caption worker is alive"):
+            self.pool.submit(b"b").result(5)
+
+    def testFailedSendFailsTheRequest(self):
+        self.pool.submit(b"x")
+        with mock.patch.object(self.workers[1].requests, "put", side_effect=OSError("closed")):
+            future = self.pool.submit(b"a")
+            joined = self.pool.submit(b"a")
+        with self.assertRaises(OSError):
+            future.result(5)
+        with self.assertRaises(OSError):
+            joined.result(5)
+        self.assertEqual([1, 0], self.pool.stats()["outstanding"])
+
+    def testFollowersOnlyJoinALaterDeadline(self):
+        self.pool.submit(b"a", deadline=100.0)
+        self.pool.submit(b"a", deadline=50.0)
+        self.assertEqual([1, 0], self.pool.stats()["outstanding"])
+        self.pool.submit(b"a", deadline=200.0)
+        self.assertEqual([1, 1], self.pool.stats()["outstanding"])
+
+    def testFollowersResendResultsCutShortByADeadline(self):
+        deadline = time.time() + 60
+        leader = self.pool.submit(b"a", deadline=deadline)
+        follower = self.pool.submit(b"a", deadline=deadline)
+        self.workers[0].serve(caption_generator.CaptionResults(["a"], deadline_exceeded=True))
+        self.assertTrue(leader.result(5).deadline_exceeded)
+
+        # The follower has time left, so it is captioned again.
+        self.workers[0].serve(caption_generator.CaptionResults(["a dog"]))
+        self.assertEqual(["a dog"], follower.result(5))
+
+
+if __name__ == "__main__":
+    unittest.main()
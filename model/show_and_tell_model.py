@@ -5,15 +5,58 @@
 # @Author  : Swing
 
 
+import math
+
 import tensorflow as tf
 
 from model.image_utils import image_embedding, image_processing
+from model.inference_utils import quantization
 from model.data_utils import inputs as input_ops
 from model.configuration import ModelConfig
 from tensorflow.python.ops.rnn import dynamic_rnn
 from tensorflow.contrib import slim
 
 
+def _batch_gather(params, indices):
+    """Gathers params[b, indices[b, i]] for a [batch, k] int32 indices Tensor."""
+    batch_size = tf.shape(indices)[0]
+    k = tf.shape(indices)[1]
+    batch_indices = tf.tile(tf.expand_dims(tf.range(batch_size), 1), [1, k])
+    return tf.gather_nd(params, tf.stack([batch_indices, indices], axis=2))
+
+
+def _dequantizing_getter(getter, name, **kwargs):
+    """Custom getter restoring the quantized decoder weights as int8 values and
+    per-channel scales. The decoder reads a float local variable of the same
+    name, which is not saved in checkpoints and is assigned the dequantized
+    weights once, by the quantization.DEQUANTIZE_OP op built in build().
+
+    The session therefore holds both the int8 and the float32 weights, and the
+    steps read float32 weights: this only shrinks checkpoints and frozen graphs.
+    NumpyDecoderWrapper keeps the weights resident as int8."""
+    axis = quantization.QUANTIZED_VARIABLES.get(name)
+    if axis is None:
+        return getter(name, **kwargs)
+
+    shape = kwargs.pop('shape')
+    kwargs.pop('dtype', None)
+    kwargs.pop('initializer', None)
+    kwargs.pop('collections', None)
+    kwargs['trainable'] = False
+    quantized = getter(name + quantization.QUANTIZED_SUFFIX, shape=shape, dtype=tf.int8,
+                       initializer=tf.zeros_initializer(), **kwargs)
+    scale = getter(name + quantization.SCALE_SUFFIX, shape=[shape[axis]], dtype=tf.float32,
+                   initializer=tf.ones_initializer(), **kwargs)
+    variable = getter(name, shape=shape, dtype=tf.float32, initializer=tf.zeros_initializer(),
+                      collections=[tf.GraphKeys.LOCAL_VARIABLES], **kwargs)
+    # Reused variables are only assigned once.
+    assigned = [t.op.inputs[0].op.name for t in tf.get_collection(quantization.DEQUANTIZE_OP)]
+    if variable.op.name not in assigned:
+        dequantized = tf.to_float(quantized) * tf.expand_dims(scale, 1 - axis)
+        tf.add_to_collection(quantization.DEQUANTIZE_OP, tf.assign(variable, dequantized))
+    return variable
+
+
 class ShowAndTellModel(object):
 
     def __init__(self, config: ModelConfig, mode, train_inception=False):
@@ -48,6 +91,13 @@ class ShowAndTellModel(object):
         # A float32 Tensor with shape [batch_size, padded_length, embedding_size].
         self.seq_embeddings = None
 
+        # A float32 Tensor with shape [vocab_size, embedding_size].
+        self.embedding_map = None
+
+        # The LSTM cell and its state after feeding the image embeddings.
+        self.lstm_cell = None
+        self.initial_state = None
+
         # A float32 scalar Tensor; the total loss for the trainer to optimize.
         self.total_loss = None
 
@@ -80,7 +130,16 @@ class ShowAndTellModel(object):
             image_feed = tf.placeholder(tf.string, shape=[], name='image_feed')
             input_feed = tf.placeholder(tf.int64, shape=[None], name='input_feed')
 
-            images = tf.expand_dims(self.process_image(image_feed), 0)
+            # A batch of encoded images. When it is not fed it defaults to the
+            # single image in image_feed, so either placeholder can be used.
+            image_batch_feed = tf.placeholder_with_default(tf.expand_dims(image_feed, 0),
+                                                           shape=[None],
+                                                           name='image_batch_feed')
+
+            images = tf.map_fn(self.process_image, image_batch_feed,
+                               dtype=tf.float32,
+                               parallel_iterations=self.config.num_preprocess_threads,
+                               back_prop=False)
             input_seqs = tf.expand_dims(input_feed, 1)
 
             # No target sequences or input mask in inference mode.
@@ -125,7 +184,8 @@ class ShowAndTellModel(object):
     def build_image_embedding(self):
         inception_output = image_embedding.inception_v3(self.images,
                                                         trainable=self.train_inception,
-                                                        is_training=self.is_training())
+                                                        is_training=self.is_training(),
+                                                        add_summaries=self.mode != 'inference')
         self.inception_variables = tf.get_collection(
             tf.GraphKeys.GLOBAL_VARIABLES, scope='InceptionV3'
         )
@@ -146,6 +206,9 @@ class ShowAndTellModel(object):
 
         self.image_embeddings = image_embeddings
 
+    def quantized(self):
+        return self.mode == 'inference' and self.config.quantize_decoder_weights
+
     def build_seq_embeddings(self):
         with tf.variable_scope('seq_embedding'), tf.device('/CPU:0'):
             embedding_map = tf.get_variable(
@@ -153,18 +216,34 @@ class ShowAndTellModel(object):
                 shape=[self.config.vocab_size, self.config.embedding_size],
                 initializer=self.initializer
             )
-            seq_embeddings = tf.nn.embedding_lookup(embedding_map, self.input_seqs)
 
-        self.seq_embeddings = seq_embeddings
+        self.embedding_map = embedding_map
+        self.seq_embeddings = self.embed_words(self.input_seqs)
 
-    def build_model(self):
+    def embed_words(self, word_ids):
+        """Looks up the embeddings of a Tensor of word ids."""
+        with tf.device('/CPU:0'):
+            return tf.nn.embedding_lookup(self.embedding_map, word_ids)
+
+    def build_lstm_cell(self):
         """
-        Note that this cell is not optimized for performance. Please use
-        `tf.contrib.cudnn_rnn.CudnnLSTM` for better performance on GPU, or
-        `tf.contrib.rnn.LSTMBlockCell` and `tf.contrib.rnn.LSTMBlockFusedCell` for
-        better performance on CPU.
+        Creates the LSTM cell selected by config.lstm_implementation.
+
+        BasicLSTMCell is not optimized for performance. LSTMBlockCell computes the
+        same function (gates in i, j, f, o order, forget bias 1.0 added at run
+        time) with one fused op per step, for dynamic_rnn as well as for the single
+        inference step. Its variables have the same shapes, and the cell is given
+        BasicLSTMCell's scope name, so both read the same checkpoints.
         """
-        lstm_cell = tf.nn.rnn_cell.BasicLSTMCell(self.config.num_lstm_units, state_is_tuple=True)
+        if self.config.lstm_implementation == 'basic':
+            return tf.nn.rnn_cell.BasicLSTMCell(self.config.num_lstm_units, state_is_tuple=True)
+        if self.config.lstm_implementation == 'block':
+            return tf.contrib.rnn.LSTMBlockCell(self.config.num_lstm_units,
+                                                name='basic_lstm_cell')
+        raise ValueError('Unknown lstm_implementation: %s' % self.config.lstm_implementation)
+
+    def build_model(self):
+        lstm_cell = self.build_lstm_cell()
 
         if self.mode == 'train':
             lstm_cell = tf.nn.rnn_cell.DropoutWrapper(
@@ -175,9 +254,12 @@ class ShowAndTellModel(object):
 
         with tf.variable_scope('lstm', initializer=self.initializer) as lstm_scope:
             zero_state = lstm_cell.zero_state(
-                batch_size=self.image_embeddings.get_shape()[0], dtype=tf.float32)
+                batch_size=tf.shape(self.image_embeddings)[0], dtype=tf.float32)
             _, initial_state = lstm_cell(self.image_embeddings, zero_state)
 
+            self.lstm_cell = lstm_cell
+            self.initial_state = initial_state
+
             lstm_scope.reuse_variables()
 
             if self.mode == 'inference':
@@ -247,6 +329,143 @@ class ShowAndTellModel(object):
             self.target_cross_entropy_losses = losses  # Used in evaluation.
             self.target_cross_entropy_loss_weights = weights  # Used in evaluation.
 
+    def build_beam_search(self):
+        """
+        Build a beam search decoder that runs entirely in the graph.
+
+        The decoder reuses the seq_embedding, lstm and logits variables and
+        follows the same rules as CaptionGenerator.beam_search: every partial
+        caption proposes its beam_size most probable words, the best beam_size
+        unfinished candidates are kept and the best beam_size finished captions
+        are collected. The start and end word ids are fed through
+        `beam_search/start_id` and `beam_search/end_id`. Outputs, for each image
+        in the batch:
+          beam_search/sequences: [batch, beam_size, max_caption_length] int64 word
+            ids, including the start and end words.
+          beam_search/lengths: [batch, beam_size] int32 number of valid words.
+          beam_search/logprobs: [batch, beam_size] float32.
+          beam_search/scores: [batch, beam_size] float32; -inf for empty slots.
+        If an image has no finished caption the partial captions are returned.
+        """
+        beam_size = self.config.beam_size
+        max_length = self.config.max_caption_length
+        vocab_size = self.config.vocab_size
+        length_normalization_factor = self.config.length_normalization_factor
+        neg_inf = float('-inf')
+
+        with tf.name_scope('beam_search'):
+            start_id = tf.placeholder(tf.int64, shape=[], name='start_id')
+            end_id = tf.placeholder(tf.int64, shape=[], name='end_id')
+
+            batch_size = tf.shape(self.image_embeddings)[0]
+            num_units = self.config.num_lstm_units
+
+            def tile_beams(state):
+                # [batch, num_units] -> [batch * beam_size, num_units]
+                tiled = tf.tile(tf.expand_dims(state, 1), [1, beam_size, 1])
+                return tf.reshape(tiled, [-1, num_units])
+
+            initial_c, initial_h = self.initial_state
+            initial_seqs = tf.concat(
+                [tf.fill([batch_size, beam_size, 1], start_id),
+                 tf.zeros([batch_size, beam_size, max_length - 1], dtype=tf.int64)],
+                axis=2)
+            # Only the first beam is alive at the start.
+            initial_logprobs = tf.tile(
+                tf.constant([[0.0] + [neg_inf] * (beam_size - 1)]), [batch_size, 1])
+
+            # Parent beam of each of the beam_size * beam_size candidates.
+            candidate_parents = tf.reshape(
+                tf.tile(tf.expand_dims(tf.range(beam_size), 1), [1, beam_size]), [1, -1])
+            candidate_parents = tf.tile(candidate_parents, [batch_size, 1])
+            beam_offsets = tf.expand_dims(tf.range(batch_size) * beam_size, 1)
+
+            def step(t, seqs, logprobs, c, h, fin_seqs, fin_lengths, fin_logprobs, fin_scores):
+                words = tf.reshape(seqs[:, :, t - 1], [-1])
+                embeddings = self.embed_words(words)
+                with tf.variable_scope('lstm', reuse=True):
+                    outputs, (new_c, new_h) = self.lstm_cell(
+                        embeddings, tf.nn.rnn_cell.LSTMStateTuple(c, h))
+                with tf.variable_scope('logits', reuse=True) as logits_scope:
+                    logits = slim.fully_connected(
+                        inputs=outputs,
+                        num_outputs=vocab_size,
+                        activation_fn=None,
+                        scope=logits_scope
+                    )
+                word_logprobs = tf.reshape(tf.nn.log_softmax(logits), [-1, beam_size, vocab_size])
+
+                # The beam_size most probable words of each beam; words with a
+                # probability below 1e-12 are treated as impossible.
+                top_logprobs, top_words = tf.nn.top_k(word_logprobs, k=beam_size)
+                top_logprobs = tf.where(top_logprobs < math.log(1e-12),
+                                        tf.fill(tf.shape(top_logprobs), neg_inf),
+                                        top_logprobs)
+                candidate_logprobs = tf.reshape(
+                    tf.expand_dims(logprobs, 2) + top_logprobs, [-1, beam_size * beam_size])
+                candidate_words = tf.to_int64(tf.reshape(top_words, [-1, beam_size * beam_size]))
+                candidate_seqs = _batch_gather(seqs, candidate_parents) + (
+                    tf.reshape(tf.one_hot(t, max_length, dtype=tf.int64), [1, 1, max_length]) *
+                    tf.expand_dims(candidate_words, 2))
+
+                is_end = tf.equal(candidate_words, end_id)
+                all_neg_inf = tf.fill(tf.shape(candidate_logprobs), neg_inf)
+
+                # Keep the best unfinished candidates as the new beams.
+                new_logprobs, best = tf.nn.top_k(
+                    tf.where(is_end, all_neg_inf, candidate_logprobs), k=beam_size)
+                new_seqs = _batch_gather(candidate_seqs, best)
+                state_rows = tf.reshape(beam_offsets + _batch_gather(candidate_parents, best), [-1])
+                new_c = tf.gather(new_c, state_rows)
+                new_h = tf.gather(new_h, state_rows)
+
+                # Merge the finished candidates into the finished captions.
+                end_logprobs = tf.where(is_end, candidate_logprobs, all_neg_inf)
+                end_scores = end_logprobs
+                if length_normalization_factor > 0:
+                    end_scores /= tf.pow(tf.to_float(t + 1), length_normalization_factor)
+                merged_scores = tf.concat([fin_scores, end_scores], axis=1)
+                fin_scores, best = tf.nn.top_k(merged_scores, k=beam_size)
+                fin_logprobs = _batch_gather(tf.concat([fin_logprobs, end_logprobs], axis=1), best)
+                fin_seqs = _batch_gather(tf.concat([fin_seqs, candidate_seqs], axis=1), best)
+                fin_lengths = _batch_gather(
+                    tf.concat([fin_lengths, tf.fill(tf.shape(end_scores), t + 1)], axis=1), best)
+
+                return t + 1, new_seqs, new_logprobs, new_c, new_h, fin_seqs, fin_lengths, fin_logprobs, fin_scores
+
+            def keep_going(t, seqs, logprobs, *unused_args):
+                return tf.logical_and(t < max_length,
+                                      tf.reduce_any(tf.greater(logprobs, neg_inf)))
+
+            empty_scores = tf.fill([batch_size, beam_size], neg_inf)
+            loop_vars = [
+                tf.constant(1),
+                initial_seqs,
+                initial_logprobs,
+                tile_beams(initial_c),
+                tile_beams(initial_h),
+                tf.zeros_like(initial_seqs),
+                tf.zeros([batch_size, beam_size], dtype=tf.int32),
+                empty_scores,
+                empty_scores,
+            ]
+            # The batch dimension is only known at run time.
+            shape_invariants = [tf.TensorShape([])] + [
+                tf.TensorShape([None]).concatenate(v.get_shape()[1:]) for v in loop_vars[1:]]
+            (t, seqs, logprobs, _, _,
+             fin_seqs, fin_lengths, fin_logprobs, fin_scores) = tf.while_loop(
+                keep_going, step, loop_vars,
+                shape_invariants=shape_invariants,
+                back_prop=False)
+
+            # Fall back to the partial captions for images without a finished one.
+            has_finished = tf.greater(fin_scores[:, 0], neg_inf)
+            tf.where(has_finished, fin_seqs, seqs, name='sequences')
+            tf.where(has_finished, fin_lengths,
+                     tf.fill([batch_size, beam_size], t), name='lengths')
+            tf.where(has_finished, fin_logprobs, logprobs, name='logprobs')
+            tf.where(has_finished, fin_scores, logprobs, name='scores')
+
     def setup_inception_initializer(self):
         """
         Set up the function to restore inception variables from checkpoint.
@@ -276,9 +495,16 @@ class ShowAndTellModel(object):
     def build(self):
 
         """Create all ops for training and evaluation."""
-        self.build_inputs()
-        self.build_image_embedding()
-        self.build_seq_embeddings()
-        self.build_model()
+        custom_getter = _dequantizing_getter if self.quantized() else None
+        with tf.variable_scope(tf.get_variable_scope(), custom_getter=custom_getter):
+            self.build_inputs()
+            self.build_image_embedding()
+            self.build_seq_embeddings()
+            self.build_model()
+            if self.mode == 'inference' and self.config.in_graph_beam_search:
+                self.build_beam_search()
+        if self.quantized():
+            tf.group(*tf.get_collection(quantization.DEQUANTIZE_OP),
+                     name=quantization.DEQUANTIZE_OP)
         self.setup_inception_initializer()
         self.setup_global_step()
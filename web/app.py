@@ -5,10 +5,27 @@
 # @Author  : Swing
 
 
-from flask import Flask, render_template, request, jsonify
-from flask_uploads import UploadSet, configure_uploads, IMAGES
-from model.inference_interface import inference
+from concurrent import futures
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+from flask_uploads import UploadSet, configure_uploads, extension, IMAGES
+from werkzeug.datastructures import FileStorage
+# model.inference_interface and the modules using it (hot_swap, model_registry)
+# load TensorFlow, so they are imported where they are used: worker
+# processes started with spawn re-import this module, and must only load
+# TensorFlow after their CPU affinity is set.
+from model.serving_utils.admission_queue import AdmissionQueue, DeadlineExceededError, QueueFullError
+from model.serving_utils.caption_cache import CaptionCache
+from model.serving_utils.degradation import DegradationPolicy
+from model.serving_utils.encoder_stage import parse_address
+from model.serving_utils.metrics import REGISTRY, merge_snapshots, render_stats
+from model.serving_utils.worker_pool import WorkerPool
+import io
+import json
 import os
+import tarfile
+import threading
+import time
+import zipfile
 
 app = Flask(__name__)
 
@@ -24,6 +41,291 @@ configure_uploads(app, image)
 ckpt_dir = ''
 # word_counts.txt路径
 word_counts = ''
+# export_inference_graph.py导出的冻结推理图（含权重与词表），非空时代替ckpt_dir/word_counts加载
+frozen_graph = ''
+# 动态批处理：最大批大小与等待时间（秒）
+max_batch_size = 8
+batch_timeout_secs = 0.005
+# 描述结果缓存：最大条目数与过期时间（秒，None为不过期）
+cache_max_entries = 10000
+cache_ttl_secs = None
+
+# 是否保存上传的图片（在后台线程中异步写盘）
+save_uploads = False
+# 准入队列：工作线程数、最大排队请求数与请求超时（秒）
+num_workers = max_batch_size
+max_queue_size = 64
+request_timeout_secs = 10.0
+# 负载降级：按准入队列占用比例选择束宽与最大长度 (最低占用比例, beam_size, max_caption_length)；
+# 束搜索在请求超时前deadline_margin_secs秒结束并返回当前最好结果
+degradation_levels = DegradationPolicy.DEFAULT_LEVELS
+deadline_margin_secs = 0.5
+# 流式描述（/upload_stream）：同时进行的最大流数，已满时返回429
+max_streams = num_workers
+# 批量上传：单次请求最多图片数、单张图片与全部图片（解压后）的最大字节数、预处理线程数、
+# 每批解码图片数，以及整个批量请求在准入队列中的超时（秒）
+max_bulk_images = 500
+max_bulk_file_bytes = 20 * 1024 * 1024
+max_bulk_total_bytes = 200 * 1024 * 1024
+bulk_timeout_secs = 120.0
+bulk_preprocess_threads = 8
+bulk_batch_size = 16
+# 多进程模型工作池：进程数（0为在本进程中推理）、每个会话的intra/inter线程数、是否绑定CPU
+num_processes = 0
+intra_op_threads = 0
+inter_op_threads = 0
+pin_cpus = False
+# 束搜索解码步骤用NumPy计算（TensorFlow只运行Inception编码器），小批量时延迟更低
+numpy_decoder = False
+# 编码/解码分离部署：encoder_server.py启动的编码服务地址（"host:port"），非空时本服务只运行
+# NumPy解码器（从ckpt_dir读取解码器权重），图片送往编码服务获取LSTM初始状态。
+# 编码服务只加载一个固定的checkpoint，因此不能与models或watch_checkpoints同时使用
+encoder_addresses = []
+encoder_authkey = ''
+# 启动预热：加载模型后先用合成图片运行各批大小，预热完成后 /ready 才返回200
+warm_up = True
+# 检查点热切换：监视ckpt_dir中的新检查点，后台加载预热后切换（仅单进程模式）
+watch_checkpoints = False
+checkpoint_poll_secs = 60.0
+# 多模型：模型id -> (checkpoint文件夹, word_counts.txt路径)，请求以表单字段model选择模型；
+# 为空时只使用ckpt_dir/word_counts。常驻模型变量总大小上限（字节，None为不限）
+models = {}
+default_model = None
+model_memory_budget_bytes = None
+
+# 以下服务对象在第一个请求前由ensure_service()创建（python app.py、flask run与WSGI服务器均适用）；
+# spawn启动的工作进程会重新导入本模块但不处理请求，因此不会创建它们
+caption_cache = None
+degradation_policy = None
+upload_writer = None
+admission_queue = None
+stream_slots = None
+
+upload_parse_seconds = REGISTRY.histogram('caption_upload_parse_seconds',
+                                          'Time of reading and checking an upload request.')
+preprocess_seconds = REGISTRY.histogram('caption_preprocess_seconds',
+                                        'Time of reading and validating one image of a bulk upload.')
+requests_total = REGISTRY.counter('caption_requests_total', 'Caption requests received.')
+
+
+swappable_captioner = None
+swappable_captioner_lock = threading.Lock()
+
+
+model_registry = None
+model_registry_lock = threading.Lock()
+
+
+def get_app_captioner(model_id=None):
+    global swappable_captioner, model_registry
+    if models:
+        from model.serving_utils.model_registry import ModelRegistry
+        with model_registry_lock:
+            if model_registry is None:
+                model_registry = ModelRegistry(models,
+                                               default_model=default_model,
+                                               memory_budget_bytes=model_memory_budget_bytes,
+                                               max_batch_size=max_batch_size,
+                                               batch_timeout_secs=batch_timeout_secs,
+                                               cache=caption_cache,
+                                               warm_up=warm_up,
+                                               use_numpy_decoder=numpy_decoder,
+                                               **encoder_kwargs())
+        return model_registry.get(model_id)
+    if watch_checkpoints:
+        from model.serving_utils.hot_swap import SwappableCaptioner
+        with swappable_captioner_lock:
+            if swappable_captioner is None:
+                swappable_captioner = SwappableCaptioner(ckpt_dir,
+                                                         word_counts,
+                                                         poll_secs=checkpoint_poll_secs,
+                                                         max_batch_size=max_batch_size,
+                                                         batch_timeout_secs=batch_timeout_secs,
+                                                         cache=caption_cache,
+                                                         warm_up=warm_up,
+                                                         use_numpy_decoder=numpy_decoder,
+                                                         **encoder_kwargs())
+        return swappable_captioner
+    from model.inference_interface import get_captioner
+    return get_captioner(ckpt_dir,
+                         word_counts,
+                         max_batch_size=max_batch_size,
+                         batch_timeout_secs=batch_timeout_secs,
+                         cache=caption_cache,
+                         warm_up=warm_up,
+                         frozen_graph_file=frozen_graph or None,
+                         use_numpy_decoder=numpy_decoder,
+                         **encoder_kwargs())
+
+
+def encoder_kwargs():
+    """Returns the Captioner arguments connecting it to the encoder stages.
+    Raises:
+      ValueError: If encoder stages are combined with several or changing
+        checkpoints, whose decoders would not match the encoder's checkpoint.
+    """
+    if not encoder_addresses:
+        return {}
+    if models or watch_checkpoints:
+        raise ValueError('encoder_addresses can not be combined with models or '
+                         'watch_checkpoints!')
+    return {'encoder_addresses': [parse_address(address) for address in encoder_addresses],
+            'encoder_authkey': encoder_authkey.encode('utf-8') or None}
+
+
+worker_pool = None
+service_ready = threading.Event()
+service_error = None
+service_started = False
+service_lock = threading.Lock()
+
+
+def start_service():
+    """Loads and warms up the model(s), then marks the service ready. A failure
+    is logged and kept in service_error, and the service never becomes ready."""
+    global worker_pool, service_error
+    try:
+        if num_processes > 0:
+            worker_pool = WorkerPool(ckpt_dir,
+                                     word_counts,
+                                     num_workers=num_processes,
+                                     intra_op_threads=intra_op_threads,
+                                     inter_op_threads=inter_op_threads,
+                                     pin_cpus=pin_cpus,
+                                     threads_per_worker=max_batch_size,
+                                     cache=caption_cache,
+                                     max_batch_size=max_batch_size,
+                                     batch_timeout_secs=batch_timeout_secs,
+                                     warm_up=warm_up,
+                                     frozen_graph_file=frozen_graph or None,
+                                     use_numpy_decoder=numpy_decoder,
+                                     **encoder_kwargs())
+        elif models:
+            get_app_captioner()
+            if model_registry.default_model is not None:
+                model_registry.load(model_registry.default_model)
+        else:
+            get_app_captioner()
+    except Exception as err:
+        app.logger.exception('Failed to start the caption service')
+        service_error = repr(err)
+        return
+    service_ready.set()
+
+
+def beam_settings():
+    """Returns the beam settings for a new request under the current load."""
+    queue_stats = admission_queue.stats()
+    return degradation_policy.settings(queue_stats['queue_depth'], queue_stats['max_queue_size'])
+
+
+def beam_kwargs(settings, deadline):
+    return {'beam_size': settings['beam_size'],
+            'max_caption_length': settings['max_caption_length'],
+            'deadline': deadline}
+
+
+def result_settings(settings, results):
+    """Returns the request's settings with the beam settings its results were
+    actually produced with, and whether they are truncated or were cut short by
+    a deadline."""
+    return dict(settings, **results.settings())
+
+
+def request_deadline():
+    return time.time() + request_timeout_secs - deadline_margin_secs
+
+
+def request_model():
+    """Returns the model id named by the request, or None for the default.
+    Raises:
+      ValueError: If the named model is not configured, or requests are served by
+        worker processes, which only hold the default model.
+    """
+    model_id = request.form.get('model') or None
+    if model_id is not None:
+        if num_processes > 0:
+            raise ValueError('Model selection is not available with worker processes!')
+        if model_id not in models:
+            raise ValueError('Unknown model!')
+    return model_id
+
+
+def handle_request(item, deadline):
+    """Admission queue handler. The item is (function, args); the function is
+    called with args and the beam search deadline, deadline_margin_secs before
+    the request's deadline."""
+    function, args = item
+    return function(*args, deadline=deadline - deadline_margin_secs)
+
+
+def caption_image(data, settings, model_id, deadline):
+    kwargs = beam_kwargs(settings, deadline)
+    if num_processes > 0:
+        # request_model() rejects named models: the workers hold only the default.
+        assert model_id is None, 'Worker processes only serve the default model'
+        return worker_pool.caption_image(data, **kwargs)
+    return get_app_captioner(model_id).caption_image(data, **kwargs)
+
+
+def caption_bulk(images, settings, model_id, deadline):
+    """Captions the images of a bulk upload. Returns, for each image, its results
+    or the exception raised while captioning it."""
+    kwargs = beam_kwargs(settings, deadline)
+    if num_processes > 0:
+        pending = [worker_pool.submit(data, **kwargs) for data in images]
+        results = []
+        for future in pending:
+            try:
+                err = future.exception(timeout=max(0.0, deadline + deadline_margin_secs - time.time()))
+            except futures.TimeoutError:
+                err = TimeoutError('Image not captioned before the deadline')
+            results.append(err if err is not None else future.result())
+        return results
+    return get_app_captioner(model_id).caption_images(images, batch_size=bulk_batch_size,
+                                                      **kwargs)
+
+
+def init_service():
+    """Creates the cache, admission queue and upload writer of the service."""
+    global caption_cache, degradation_policy, upload_writer, admission_queue, stream_slots
+    caption_cache = CaptionCache(max_entries=cache_max_entries, ttl_secs=cache_ttl_secs)
+    degradation_policy = DegradationPolicy(degradation_levels)
+    upload_writer = futures.ThreadPoolExecutor(max_workers=1)
+    admission_queue = AdmissionQueue(handle_request,
+                                     num_workers=num_workers,
+                                     max_queue_size=max_queue_size,
+                                     default_timeout_secs=request_timeout_secs)
+    stream_slots = threading.BoundedSemaphore(max_streams)
+
+
+def ensure_service():
+    """Initializes the service and starts loading the model(s) in the background,
+    once. Runs before the first request rather than at import time, so worker
+    processes re-importing this module with spawn do neither."""
+    global service_started
+    if service_started:
+        return
+    with service_lock:
+        if service_started:
+            return
+        init_service()
+        threading.Thread(target=start_service, name='start_service', daemon=True).start()
+        service_started = True
+
+
+@app.before_request
+def before_request():
+    ensure_service()
+
+
+def persist_upload(data, filename):
+    """Writes an uploaded image to the upload folder, off the request path."""
+    with app.app_context():
+        try:
+            image.save(FileStorage(io.BytesIO(data), filename=filename), folder='image')
+        except Exception as err:
+            print(err)
 
 
 @app.route('/')
@@ -33,15 +335,31 @@ def index():
 
 @app.route('/upload', methods=['post', 'get'])
 def image_upload():
+    requests_total.inc()
     if 'image' in request.files:
         try:
-            filename = image.save(request.files['image'], folder='image')
+            with upload_parse_seconds.time():
+                upload = request.files['image']
+                if not image.extension_allowed(extension(upload.filename)):
+                    return jsonify({'success': False, 'message': 'File type not allowed!'})
 
-            results = inference(image.path(filename),
-                                ckpt_dir,
-                                word_counts)
+                data = upload.read()
+            try:
+                model_id = request_model()
+            except ValueError as err:
+                return jsonify({'success': False, 'message': str(err)}), 400
+            if save_uploads:
+                upload_writer.submit(persist_upload, data, upload.filename)
 
-            return jsonify({'success': True, 'results': results})
+            settings = beam_settings()
+            results = admission_queue.call((caption_image, (data, settings, model_id)))
+
+            return jsonify({'success': True, 'results': results,
+                            'settings': result_settings(settings, results)})
+        except QueueFullError:
+            return jsonify({'success': False, 'message': 'Server busy, try again later!'}), 429
+        except DeadlineExceededError:
+            return jsonify({'success': False, 'message': 'Request timed out!'}), 503
         except Exception as err:
             print(err)
             return jsonify({'success': False, 'message': 'Unknown error!'})
@@ -49,5 +367,241 @@ def image_upload():
     return jsonify({'success': False, 'message': 'No file found!'})
 
 
+def sse_event(event, data):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+
+@app.route('/upload_stream', methods=['post'])
+def image_upload_stream():
+    """Server-Sent Events: a 'partial' event with the best partial caption after
+    each beam search step, then a 'final' event with the results. The search
+    stops when the client disconnects. At most max_streams streams run at once;
+    they hold a stream slot instead of going through the admission queue."""
+    requests_total.inc()
+    if 'image' not in request.files:
+        return jsonify({'success': False, 'message': 'No file found!'})
+
+    with upload_parse_seconds.time():
+        upload = request.files['image']
+        if not image.extension_allowed(extension(upload.filename)):
+            return jsonify({'success': False, 'message': 'File type not allowed!'})
+
+        data = upload.read()
+    try:
+        model_id = request_model()
+    except ValueError as err:
+        return jsonify({'success': False, 'message': str(err)}), 400
+    if not stream_slots.acquire(blocking=False):
+        return jsonify({'success': False, 'message': 'Server busy, try again later!'}), 429
+    if save_uploads:
+        upload_writer.submit(persist_upload, data, upload.filename)
+
+    settings = beam_settings()
+    kwargs = beam_kwargs(settings, request_deadline())
+
+    def generate():
+        try:
+            if num_processes > 0:
+                # Worker processes only return final results.
+                results = worker_pool.caption_image(data, timeout=request_timeout_secs, **kwargs)
+                yield sse_event('final', {'success': True, 'results': results,
+                                          'settings': result_settings(settings, results)})
+                return
+            for kind, value in get_app_captioner(model_id).stream_image(data, **kwargs):
+                if kind == 'partial':
+                    yield sse_event('partial', {'caption': value})
+                else:
+                    yield sse_event('final', {'success': True, 'results': value,
+                                              'settings': result_settings(settings, value)})
+        except Exception as err:
+            print(err)
+            yield sse_event('final', {'success': False, 'message': 'Unknown error!'})
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Released once the stream has ended or the client has disconnected.
+    response.call_on_close(stream_slots.release)
+    return response
+
+
+def upload_size(upload):
+    """Returns the size in bytes of an uploaded file, without reading it."""
+    stream = upload.stream
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+def read_tar_member(archive, member, lock):
+    # All members are read through the archive's single file object.
+    with lock:
+        return archive.extractfile(member).read()
+
+
+def bulk_items(files):
+    """Returns (name, load) pairs for the uploaded images; each load() returns the
+    image bytes. Zip and tar archives are expanded into their member files, which
+    are only read or decompressed by load().
+    Raises:
+      ValueError: If there are more than max_bulk_images images, or an image or
+        all of them are larger than max_bulk_file_bytes or max_bulk_total_bytes.
+        These are checked against the sizes in the archive headers, before
+        anything is read.
+    """
+    items = []
+    total_bytes = 0
+
+    def add(name, size, load):
+        nonlocal total_bytes
+        if len(items) >= max_bulk_images:
+            raise ValueError('Too many images (max %d)!' % max_bulk_images)
+        if size > max_bulk_file_bytes:
+            raise ValueError('%s is too large (max %d bytes)!' % (name, max_bulk_file_bytes))
+        total_bytes += size
+        if total_bytes > max_bulk_total_bytes:
+            raise ValueError('Images are too large in total (max %d bytes)!' %
+                             max_bulk_total_bytes)
+        items.append((name, load))
+
+    for upload in files:
+        filename = upload.filename or ''
+        lower = filename.lower()
+        if lower.endswith('.zip'):
+            # Reads of a member stop at the size in its header.
+            archive = zipfile.ZipFile(io.BytesIO(upload.read()))
+            for info in archive.infolist():
+                if not info.is_dir():
+                    add(info.filename, info.file_size,
+                        lambda a=archive, n=info.filename: a.read(n))
+        elif lower.endswith(('.tar', '.tar.gz', '.tgz')):
+            archive = tarfile.open(fileobj=io.BytesIO(upload.read()))
+            lock = threading.Lock()
+            for member in archive:
+                if member.isfile():
+                    add(member.name, member.size,
+                        lambda a=archive, m=member, l=lock: read_tar_member(a, m, l))
+        else:
+            add(filename, upload_size(upload), lambda u=upload: u.read())
+    return items
+
+
+def load_bulk_item(item):
+    from model.inference_interface import validate_image
+    name, load = item
+    with preprocess_seconds.time():
+        data = load()
+        validate_image(data, 'png' if extension(name) == 'png' else 'jpeg')
+    return data
+
+
+@app.route('/upload_batch', methods=['post'])
+def image_upload_batch():
+    """Captions many images per request, sent as several 'images' parts and/or
+    zip/tar archives. Returns one result per image, with per-image errors."""
+    requests_total.inc()
+    files = request.files.getlist('images')
+    if not files:
+        return jsonify({'success': False, 'message': 'No file found!'})
+    try:
+        model_id = request_model()
+    except ValueError as err:
+        return jsonify({'success': False, 'message': str(err)}), 400
+
+    try:
+        with upload_parse_seconds.time():
+            items = bulk_items(files)
+    except (zipfile.BadZipFile, tarfile.TarError):
+        return jsonify({'success': False, 'message': 'Invalid archive!'})
+    except ValueError as err:
+        return jsonify({'success': False, 'message': str(err)}), 413
+
+    outputs = [{'name': name} for name, _ in items]
+    allowed = []
+    for i, (name, _) in enumerate(items):
+        if image.extension_allowed(extension(name)):
+            allowed.append(i)
+        else:
+            outputs[i].update({'success': False, 'message': 'File type not allowed'})
+
+    # Read and validate the images concurrently.
+    with futures.ThreadPoolExecutor(max_workers=bulk_preprocess_threads) as executor:
+        loaded = {i: executor.submit(load_bulk_item, items[i]) for i in allowed}
+    valid = []
+    for i in allowed:
+        err = loaded[i].exception()
+        if err is not None:
+            outputs[i].update({'success': False, 'message': str(err)})
+        else:
+            valid.append(i)
+
+    images = [loaded[i].result() for i in valid]
+    settings = beam_settings()
+    try:
+        results = admission_queue.call((caption_bulk, (images, settings, model_id)),
+                                       timeout_secs=bulk_timeout_secs)
+    except QueueFullError:
+        return jsonify({'success': False, 'message': 'Server busy, try again later!'}), 429
+    except DeadlineExceededError:
+        return jsonify({'success': False, 'message': 'Request timed out!'}), 503
+    except Exception as err:
+        print(err)
+        return jsonify({'success': False, 'message': 'Unknown error!'})
+
+    for i, result in zip(valid, results):
+        if isinstance(result, TimeoutError):
+            outputs[i].update({'success': False, 'message': 'Timed out'})
+        elif isinstance(result, Exception):
+            print(result)
+            outputs[i].update({'success': False, 'message': 'Caption failed'})
+        else:
+            outputs[i].update({'success': True, 'results': result, 'truncated': result.truncated,
+                               'deadline_exceeded': result.deadline_exceeded})
+            settings.update(beam_size=result.beam_size,
+                            max_caption_length=result.max_caption_length)
+    return jsonify({'success': True, 'results': outputs, 'settings': settings})
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text format metrics of this process and, with worker_pool, the
+    sums of the latest metrics its caption workers sent."""
+    snapshots = [REGISTRY.snapshot()]
+    if worker_pool is not None:
+        # 集束搜索的指标记录在各个 worker 进程里
+        snapshots += worker_pool.metrics_snapshots()
+    text = merge_snapshots(snapshots).render()
+    text += render_stats('caption_cache', caption_cache.stats(), 'Caption cache ',
+                         counters=('hits', 'misses', 'evictions'))
+    text += render_stats('caption_queue', admission_queue.stats(), 'Admission queue ',
+                         counters=('admitted', 'rejected', 'expired', 'served', 'failed'))
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/ready')
+def ready():
+    """Readiness probe for the load balancer: 200 once the model is loaded and
+    warmed up, 503 before or if it failed to load."""
+    if service_ready.is_set():
+        return jsonify({'ready': True})
+    if service_error is not None:
+        return jsonify({'ready': False, 'error': service_error}), 503
+    return jsonify({'ready': False}), 503
+
+
+@app.route('/stats')
+def stats():
+    results = {'queue': admission_queue.stats(), 'cache': caption_cache.stats()}
+    if worker_pool is not None:
+        results['workers'] = worker_pool.stats()
+    if model_registry is not None:
+        results['models'] = model_registry.stats()
+    return jsonify(results)
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    # 启动时即开始加载模型，不等第一个请求
+    ensure_service()
+    # 不使用reloader：它会在子进程中再次运行本模块，重复启动模型与工作进程池
+    app.run(debug=True, threaded=True, use_reloader=False)